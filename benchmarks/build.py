@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of couchapp released under the Apache 2 license.
+# See the NOTICE for more information.
+'''
+Build time of ``LocalDoc.doc()`` on a synthetic app of NFUNCS functions
+including a shared library with ``!code`` and templates with ``!json``,
+without the build cache, with a cold one, a warm one, and a warm one
+after one library file changed, then without the cache but with JOBS
+processes expanding the macros (one per CPU by default). The best time
+of REPEAT builds is printed, except for the first build after a
+change::
+
+    $ python benchmarks/build.py [NFUNCS] [JOBS] [REPEAT]
+'''
+
+from __future__ import print_function
+
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from couchapp.localdoc import LocalDoc
+
+NLIBS = 30
+
+
+def write(path, content, age=3600):
+    dirname = os.path.dirname(path)
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    with open(path, 'w') as f:
+        f.write(content)
+    # out of the racy window of the caches
+    mtime = time.time() - age
+    os.utime(path, (mtime, mtime))
+
+
+def make_app(path, nfuncs):
+    write(os.path.join(path, '_id'), '_design/bench')
+    for i in range(NLIBS):
+        write(os.path.join(path, 'lib', 'helpers', 'h%02d.js' % i),
+              'function h%d(x) {\n  return x + %d;\n}\n' % (i, i) * 20)
+    write(os.path.join(path, 'templates', 'page.html'),
+          '<html><body>{{ content }}</body></html>\n' * 50)
+    write(os.path.join(path, 'meta.json'), '{"version": 1}')
+
+    for i in range(nfuncs):
+        kind = ('shows', 'lists')[i % 2]
+        write(os.path.join(path, kind, 'f%04d.js' % i),
+              'function(doc, req) {\n'
+              '  // !code lib/helpers/*.js\n'
+              '  // !json templates.page\n'
+              '  return templates.page.replace("x", %d);\n'
+              '}\n' % i)
+        write(os.path.join(path, 'views', 'v%04d' % i, 'map.js'),
+              'function(doc) {\n'
+              '  // !code lib/helpers/h%02d.js\n'
+              '  emit(doc._id, %d);\n'
+              '}\n' % (i % NLIBS, i))
+
+
+def bench(name, path, use_cache, jobs=1, repeat=1):
+    elapsed = []
+    for _ in range(repeat):
+        start = time.time()
+        doc = LocalDoc(path, use_cache=use_cache, jobs=jobs).doc()
+        elapsed.append(time.time() - start)
+    print('%-22s %8.3fs' % (name, min(elapsed)))
+    doc.pop('_rev', None)
+    return doc
+
+
+def main():
+    nfuncs = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    repeat = int(sys.argv[3]) if len(sys.argv) > 3 else 5
+    path = tempfile.mkdtemp()
+    try:
+        make_app(path, nfuncs)
+        print('%d functions, %d views' % (nfuncs, nfuncs))
+
+        ref = bench('no cache', path, False, repeat=repeat)
+        bench('cold cache', path, True)
+        warm = bench('warm cache', path, True, repeat=repeat)
+
+        write(os.path.join(path, 'lib', 'helpers', 'h00.js'),
+              'function h0(x) {\n  return x;\n}\n', age=7200)
+        changed = bench('warm, one lib changed', path, True)
+        fresh = bench('no cache, lib changed', path, False, repeat=repeat)
+
+        if warm != ref or changed != fresh:
+            print('the cached builds differ from the uncached ones')
+            return 1
+
+        jobs = int(sys.argv[2]) if len(sys.argv) > 2 else \
+            multiprocessing.cpu_count()
+        if bench('no cache, %d jobs' % jobs, path, False, jobs,
+                 repeat) != fresh:
+            print('the parallel build differs from the sequential one')
+            return 1
+        return 0
+    finally:
+        shutil.rmtree(path)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of couchapp released under the Apache 2 license.
+# See the NOTICE for more information.
+'''
+Build time and size of the design document of the synthetic app of
+``build.py``, with the libraries included by ``!code`` inlined in each
+function, and required as CommonJS modules (``push --commonjs``). The
+views include ``lib/``, which they can't require, so they're inlined in
+both::
+
+    $ python benchmarks/commonjs.py [NFUNCS]
+'''
+
+from __future__ import print_function
+
+import json
+import shutil
+import sys
+import tempfile
+import time
+
+from build import make_app
+
+from couchapp.localdoc import LocalDoc
+
+
+def bench(name, path, commonjs):
+    start = time.time()
+    doc = LocalDoc(path, use_cache=False, commonjs=commonjs).doc()
+    elapsed = time.time() - start
+    size = len(json.dumps(doc))
+    functions = sum(len(json.dumps(doc[field])) for field in
+                    ('shows', 'lists'))
+    print('%-10s %8.3fs %10d bytes, shows and lists %10d bytes' %
+          (name, elapsed, size, functions))
+
+
+def main():
+    nfuncs = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    path = tempfile.mkdtemp()
+    try:
+        make_app(path, nfuncs)
+        print('%d shows and lists, %d views' % (nfuncs, nfuncs))
+        bench('inline', path, False)
+        bench('commonjs', path, True)
+    finally:
+        shutil.rmtree(path)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of couchapp released under the Apache 2 license.
+# See the NOTICE for more information.
+'''
+Cost of ``.couchappignore`` checks on a synthetic 50k-file tree with
+30 patterns, the compiled ``IgnoreMatcher`` against the former
+per-pattern, per-run-of-components ``re.match`` loop::
+
+    $ python benchmarks/ignores.py [NFILES]
+'''
+
+from __future__ import print_function
+
+import random
+import re
+import sys
+import time
+
+from copy import copy
+from itertools import chain
+
+from couchapp.ignores import IgnoreMatcher
+from couchapp.util import split_path
+
+PATTERNS = [
+    r'.*~', r'.*\.swp', r'.*\.bak', r'.*\.orig', r'.*\.rej', r'.*\.pyc',
+    r'\.DS_Store', r'Thumbs\.db', r'CVS', r'\.svn', r'node_modules',
+    r'bower_components', r'tmp', r'.*\.log', r'build/.*\.map',
+    r'/dist', r'coverage', r'.*\.tmp', r'docs/_build', r'.*/test/.*\.html',
+    r'^npm-debug', r'.*\.psd', r'.*\.sketch', r'\.idea', r'\.vscode',
+    r'.*\.min\.js\.gz', r'vendor/.*/src', r'lib/.*\.ts', r'spec',
+    r'fixtures',
+]
+
+DIRS = ['app', 'lib', 'views', 'shows', 'style', 'img', 'js', 'build',
+        'src', 'test', 'vendor', 'ui', 'core', 'fixtures', 'tmp']
+EXTS = ['.js', '.css', '.html', '.png', '.json', '.map', '.swp', '~']
+
+
+def make_tree(nfiles, seed=42):
+    rnd = random.Random(seed)
+    paths = []
+    for i in range(nfiles):
+        depth = rnd.randint(1, 6)
+        parts = ['_attachments'] + [rnd.choice(DIRS) for _ in range(depth)]
+        parts.append('file%d%s' % (i, rnd.choice(EXTS)))
+        paths.append('/'.join(parts))
+    return paths
+
+
+def legacy_check(ignores, item):
+    ''' the former ``LocalDoc.check_ignore`` '''
+    def combine_dir(ls):
+        ret = tuple()
+        while ls:
+            ret += (ls.pop(0),)
+            yield '/'.join(ret)
+
+    def combine_path(p):
+        ls = split_path(p)
+        while ls:
+            for i in combine_dir(copy(ls)):
+                yield i
+            ls.pop(0)
+
+    for pattern in ignores:
+        paths = chain(combine_path(item), combine_path('/' + item))
+        if any(re.match(pattern + '$', i) for i in paths):
+            return True
+    return False
+
+
+def bench(name, check, paths):
+    start = time.time()
+    verdicts = [check(p) for p in paths]
+    elapsed = time.time() - start
+    print('%-10s %8.3fs  %6.1f us/path  %d ignored' % (
+        name, elapsed, elapsed * 1e6 / len(paths), sum(verdicts)))
+    return verdicts
+
+
+def main():
+    nfiles = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    paths = make_tree(nfiles)
+    print('%d paths, %d patterns' % (len(paths), len(PATTERNS)))
+
+    legacy = bench('legacy', lambda p: legacy_check(PATTERNS, p), paths)
+    matcher = IgnoreMatcher(PATTERNS)
+    compiled = bench('compiled', matcher.match, paths)
+
+    if legacy != compiled:
+        diff = [p for p, a, b in zip(paths, legacy, compiled) if a != b]
+        print('verdicts differ on %d paths, e.g. %s' % (len(diff), diff[:5]))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
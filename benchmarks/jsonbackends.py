@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of couchapp released under the Apache 2 license.
+# See the NOTICE for more information.
+'''
+Encode and decode times of the available json backends, on the design
+document built from a synthetic app (about 20 MB of json with the
+default NFUNCS), or on a given json file::
+
+    $ python benchmarks/jsonbackends.py [NFUNCS | FILE]
+'''
+
+from __future__ import print_function
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from couchapp.jsonbackend import BACKENDS, available_backends
+from couchapp.localdoc import LocalDoc
+
+import build
+
+ROUNDS = 3
+
+
+def best_of(func, *args):
+    times = []
+    for _ in range(ROUNDS):
+        start = time.time()
+        result = func(*args)
+        times.append(time.time() - start)
+    return min(times), result
+
+
+def load_doc(arg):
+    if os.path.isfile(arg):
+        with open(arg, 'rb') as f:
+            return f.read()
+
+    path = tempfile.mkdtemp()
+    try:
+        build.make_app(path, int(arg))
+        doc = LocalDoc(path, use_cache=False).doc()
+    finally:
+        shutil.rmtree(path)
+    return BACKENDS[-1]().dumps(doc)
+
+
+def main():
+    payload = load_doc(sys.argv[1] if len(sys.argv) > 1 else '500')
+    print('%.1f MB of json, best of %d' % (len(payload) / 1e6, ROUNDS))
+
+    ref = BACKENDS[-1]().loads(payload)
+    ref_out = BACKENDS[-1]().dumps(ref, sort_keys=True)
+    status = 0
+    for cls in BACKENDS:
+        if cls.name not in available_backends():
+            print('%-12s not available' % cls.name)
+            continue
+        backend = cls()
+        decode, doc = best_of(backend.loads, payload)
+        encode, out = best_of(backend.dumps, doc)
+        print('%-12s decode %7.3fs  encode %7.3fs' % (cls.name, decode,
+                                                       encode))
+        if doc != ref or backend.dumps(doc, sort_keys=True) != ref_out:
+            print('%-12s output differs from the json module' % cls.name)
+            status = 1
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of couchapp released under the Apache 2 license.
+# See the NOTICE for more information.
+'''
+Expansion of the ``!code`` and ``!json`` macros of the synthetic app of
+``build.py``, with one :class:`~couchapp.macros.MacroContext` per function,
+as before it was shared, and with one for the whole build. The reads and
+globs done by each are counted.
+
+Then the expansion of NFUNCS functions of NDIRECTIVES ``!code`` and as
+many ``!json`` macros each::
+
+    $ python benchmarks/macros.py [NFUNCS] [NDIRECTIVES]
+'''
+
+from __future__ import print_function
+
+import copy
+import glob
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from build import make_app, write
+
+from couchapp import macros, util
+from couchapp.localdoc import LocalDoc
+
+READ = util.read
+GLOB = glob.glob
+
+
+class Counter(object):
+    def __init__(self, func):
+        self.func = func
+        self.calls = 0
+
+    def __call__(self, *args, **kwargs):
+        self.calls += 1
+        return self.func(*args, **kwargs)
+
+
+def expand(doc, app_dir, shared):
+    doc = copy.deepcopy(doc)
+    ctx = macros.MacroContext() if shared else None
+    objs = {}
+    for funs in ('shows', 'lists'):
+        if shared:
+            macros.package_shows(doc, doc[funs], app_dir, objs, ctx=ctx)
+        else:
+            for name in list(doc[funs]):
+                funcs = {name: doc[funs][name]}
+                macros.package_shows(doc, funcs, app_dir, objs)
+                doc[funs].update(funcs)
+    macros.package_views(doc, doc['views'], app_dir, objs, ctx=ctx)
+    return doc
+
+
+def bench(name, doc, app_dir, shared):
+    reads = util.read = Counter(READ)
+    globs = glob.glob = Counter(GLOB)
+    try:
+        start = time.time()
+        result = expand(doc, app_dir, shared)
+        elapsed = time.time() - start
+    finally:
+        util.read = READ
+        glob.glob = GLOB
+    print('%-18s %8.3fs %8d reads %8d globs' %
+          (name, elapsed, reads.calls, globs.calls))
+    return result
+
+
+def make_directives_app(path, nfuncs, ndirectives):
+    write(os.path.join(path, '_id'), '_design/directives')
+    source = ['function(doc, req) {']
+    for i in range(ndirectives):
+        write(os.path.join(path, 'lib', 'd%03d.js' % i),
+              'var d%d = %d;\n' % (i, i))
+        write(os.path.join(path, 'templates', 't%03d.html' % i),
+              '<p>%d</p>' % i)
+        source.append('  // !code lib/d%03d.js' % i)
+        source.append('  // !json templates.t%03d' % i)
+    source.append('  return "%d";\n}\n')
+    source = '\n'.join(source)
+    for i in range(nfuncs):
+        write(os.path.join(path, 'shows', 'f%04d.js' % i), source % i)
+
+
+def bench_directives(nfuncs, ndirectives):
+    path = tempfile.mkdtemp()
+    try:
+        make_directives_app(path, nfuncs, ndirectives)
+        doc = LocalDoc(path, use_cache=False).dir_to_fields(path)
+        print('%d shows of %d !code and %d !json' %
+              (nfuncs, ndirectives, ndirectives))
+        best = None
+        for i in range(3):
+            shows = copy.deepcopy(doc['shows'])
+            start = time.time()
+            macros.package_shows(doc, shows, path, {},
+                                 ctx=macros.MacroContext())
+            elapsed = time.time() - start
+            best = elapsed if best is None else min(best, elapsed)
+        print('%-18s %8.3fs' % ('many directives', best))
+    finally:
+        shutil.rmtree(path)
+
+
+def main():
+    nfuncs = int(sys.argv[1]) if len(sys.argv) > 1 else 400
+    path = tempfile.mkdtemp()
+    try:
+        make_app(path, nfuncs)
+        # the fields of the document, before the macros
+        doc = LocalDoc(path, use_cache=False).dir_to_fields(path)
+        print('%d shows and lists, %d views' % (nfuncs, nfuncs))
+
+        ref = bench('per function', doc, path, False)
+        if bench('shared context', doc, path, True) != ref:
+            print('the expansions differ')
+            return 1
+    finally:
+        shutil.rmtree(path)
+
+    print()
+    ndirectives = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    bench_directives(nfuncs, ndirectives)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
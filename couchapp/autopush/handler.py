@@ -11,6 +11,7 @@ import time
 from watchdog.events import FileSystemEventHandler
 
 from couchapp.autopush import DEFAULT_UPDATE_DELAY
+from couchapp.localdoc import report
 from couchapp.util import json, remove_comments
 
 
@@ -50,7 +51,8 @@ class CouchappEventHandler(FileSystemEventHandler):
         diff = time.time() - self.last_update
         if diff >= self.update_delay:
             log.info("synchronize changes")
-            self.doc.push(self.dbs, noatomic=self.noatomic, noindex=True)
+            report(self.doc.push(self.dbs, noatomic=self.noatomic,
+                                 noindex=True))
             self.last_update = None
 
     def dispatch(self, ev):
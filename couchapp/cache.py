@@ -0,0 +1,309 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of couchapp released under the Apache 2 license.
+# See the NOTICE for more information.
+
+from __future__ import with_statement
+
+import copy
+import logging
+import os
+import random
+import threading
+import time
+import urlparse
+
+from hashlib import md5
+
+from couchapp import util
+
+CACHE_DIR = os.path.join('.couchapp', 'cache')
+
+# files modified less than ``RACY_DELAY`` seconds ago are never cached:
+# another write within the same mtime tick would go unnoticed
+RACY_DELAY = 2
+
+# number of documents of the journal of a database whose revisions are
+# checked before a push, see ``PushJournal.docs``
+JOURNAL_SAMPLE = 10
+
+logger = logging.getLogger(__name__)
+
+
+def stat_key(st):
+    '''
+    Build the cache validation key from a stat result
+
+    :return: list ``[inode, size, mtime_ns]``
+    '''
+    mtime_ns = getattr(st, 'st_mtime_ns', None)
+    if mtime_ns is None:
+        mtime_ns = int(st.st_mtime * 1e9)
+    return [st.st_ino, st.st_size, mtime_ns]
+
+
+def is_racy(st):
+    '''
+    :return: ``True`` if the file was modified too recently to be cached
+    '''
+    return time.time() - st.st_mtime <= RACY_DELAY
+
+
+def digest(obj):
+    '''
+    :return: md5 hexdigest of the json serialization of ``obj``
+    '''
+    return md5(util.json.dumps(obj, sort_keys=True)).hexdigest()
+
+
+class FileCache(object):
+    '''
+    A json store living in ``<app>/.couchapp/cache/<name>``.
+
+    The store is versioned; a cache file written by another version,
+    or one that can't be parsed, is silently discarded.
+    '''
+    name = None
+    version = 1
+
+    def __init__(self, docdir, enabled=True):
+        self.path = os.path.join(docdir, CACHE_DIR, self.name)
+        self.enabled = enabled
+        self.entries = self.load() if enabled else {}
+        self.dirty = False
+
+    def load(self):
+        if not os.path.isfile(self.path):
+            return {}
+
+        try:
+            with open(self.path, 'rb') as f:
+                data = util.json.loads(f.read())
+        except (IOError, ValueError):
+            logger.debug("discard invalid cache %s", self.path)
+            return {}
+
+        if not isinstance(data, dict) or data.get('version') != self.version:
+            return {}
+        return data.get('entries') or {}
+
+    def save(self):
+        if not self.enabled or not self.dirty:
+            return
+
+        dirname = os.path.dirname(self.path)
+        tmp = '%s.tmp' % self.path
+        try:
+            if not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            util.write_json(tmp, {'version': self.version,
+                                  'entries': self.entries})
+            if util.is_windows() and os.path.exists(self.path):
+                os.remove(self.path)
+            os.rename(tmp, self.path)
+        except (IOError, OSError), e:
+            # a cache we can't write is not an error, just a slower push
+            logger.warning("can't write cache %s: %s", self.path, e)
+            return
+        self.dirty = False
+
+
+class SignatureCache(FileCache):
+    '''
+    Cache of attachment signatures, keyed by attachment name and
+    validated against the inode, size and mtime of the file, so an
+    unchanged file costs one ``stat`` instead of a full read.
+    '''
+    name = 'signatures.json'
+
+    def __init__(self, docdir, enabled=True):
+        super(SignatureCache, self).__init__(docdir, enabled=enabled)
+        self.seen = set()
+
+    def sign(self, name, filepath, st=None):
+        '''
+        :param name: the attachment name
+        :param st: optional stat result of ``filepath``
+        :return: md5 hexdigest of the file content, as ``util.sign``
+        '''
+        if not self.enabled:
+            return util.sign(filepath)
+
+        self.seen.add(name)
+        st = st if st is not None else os.stat(filepath)
+        key = stat_key(st)
+
+        entry = self.entries.get(name)
+        if entry is not None and entry[:3] == key:
+            return entry[3]
+
+        signature = util.sign(filepath)
+        if isinstance(signature, basestring) and not is_racy(st):
+            self.entries[name] = key + [signature]
+            self.dirty = True
+        elif name in self.entries:
+            del self.entries[name]
+            self.dirty = True
+        return signature
+
+    def save(self):
+        '''
+        Drop the entries of attachments gone since the last save,
+        then write the cache.
+        '''
+        for name in set(self.entries) - self.seen:
+            del self.entries[name]
+            self.dirty = True
+        super(SignatureCache, self).save()
+
+
+class BuildCache(FileCache):
+    '''
+    Cache of the decoded content of the field files of a document,
+    validated like the signatures.
+
+    The macro expansions are not cached: with the files read and the
+    libraries expanded once per build by
+    :class:`~couchapp.macros.MacroContext`, expanding all the functions
+    again costs less than loading their expansions.
+    '''
+    name = 'build.json'
+    version = 2
+
+    def __init__(self, docdir, enabled=True):
+        super(BuildCache, self).__init__(docdir, enabled=enabled)
+        self.fields = self.entries.setdefault('fields', {})
+        self.seen = set()
+
+    def content(self, rel_path, st, load):
+        '''
+        :param rel_path: path of the field file, relative to the document
+        :param st: stat result of the file
+        :param load: callable returning ``(content, cacheable)``
+        :return: the content of the file, from the cache if it's unchanged
+        '''
+        if not self.enabled:
+            return load()[0]
+
+        self.seen.add(rel_path)
+        key = stat_key(st)
+        entry = self.fields.get(rel_path)
+        if entry is not None and entry[0] == key:
+            # the caller may modify it, e.g. by running the macros
+            return copy.deepcopy(entry[1])
+
+        content, cacheable = load()
+        if cacheable and not is_racy(st):
+            self.fields[rel_path] = [key, copy.deepcopy(content)]
+            self.dirty = True
+        elif rel_path in self.fields:
+            del self.fields[rel_path]
+            self.dirty = True
+        return content
+
+    def save(self):
+        '''
+        Drop the entries of files gone since the last save, then write
+        the cache.
+        '''
+        for rel_path in set(self.fields) - self.seen:
+            del self.fields[rel_path]
+            self.dirty = True
+        super(BuildCache, self).save()
+
+
+class PushJournal(FileCache):
+    '''
+    Journal of the pushes of a ``_docs`` directory: the hash and the
+    revision of each document last pushed, by database. The next push
+    sends only the documents whose hash changed and deletes the ones
+    removed from the directory, with the revisions of the journal
+    instead of the ones of the database.
+
+    The journal of a database is dropped when the database was recreated
+    since, or when a sample of its documents changed in it: the documents
+    it lists would be skipped while they're missing or stale there.
+
+    The databases are pushed to in threads, so it's updated and saved
+    under a lock.
+    '''
+    name = 'pushdocs.json'
+    version = 2
+
+    def __init__(self, docdir, enabled=True):
+        super(PushJournal, self).__init__(docdir, enabled=enabled)
+        self._lock = threading.Lock()
+        # the ``instance_start_time`` of the databases, by key
+        self._instances = {}
+
+    @staticmethod
+    def db_key(db):
+        '''
+        :return: the url of ``db``, without its credentials
+        '''
+        u = urlparse.urlparse(db.raw_uri)
+        return urlparse.urlunparse(u._replace(netloc=u.netloc.split('@')[-1]))
+
+    def instance(self, db):
+        '''
+        :return: the ``instance_start_time`` of ``db``, which changes when
+                 it's recreated
+        '''
+        key = self.db_key(db)
+        with self._lock:
+            if key in self._instances:
+                return self._instances[key]
+        instance = db.info().get('instance_start_time')
+        with self._lock:
+            self._instances[key] = instance
+        return instance
+
+    def docs(self, db):
+        '''
+        :return: dict of ``[hash, rev]`` by docid, the documents pushed
+                 to ``db``, or ``{}`` if the journal of ``db`` is dropped
+        '''
+        if not self.enabled:
+            return {}
+        key = self.db_key(db)
+        with self._lock:
+            entry = self.entries.get(key)
+        if not entry:
+            return {}
+
+        docs = entry['docs']
+        sample = random.sample(sorted(docs), min(JOURNAL_SAMPLE, len(docs)))
+        revs = db.last_revs(sample) if sample else {}
+        if self.instance(db) != entry['instance'] or \
+                any(revs.get(docid) != docs[docid][1] for docid in sample):
+            logger.warning("%s changed since the last push, all the "
+                           "documents are pushed", db.dbname)
+            with self._lock:
+                self.entries.pop(key, None)
+                self.dirty = True
+            return {}
+        return dict(docs)
+
+    def update(self, db, docs):
+        '''
+        Record a push to ``db`` and save the journal.
+
+        :param docs: list of ``(docid, hash, rev)``, ``rev`` is ``None``
+                     for the documents deleted or not saved, which are
+                     dropped from the journal
+        '''
+        if not self.enabled:
+            return
+        instance = self.instance(db)
+        with self._lock:
+            entry = self.entries.setdefault(self.db_key(db), {})
+            if 'docs' not in entry or entry['instance'] != instance:
+                entry.update({'instance': instance, 'docs': {}})
+            for docid, hash, rev in docs:
+                if rev is None:
+                    entry['docs'].pop(docid, None)
+                else:
+                    entry['docs'][docid] = [hash, rev]
+            self.dirty = True
+            self.save()
+
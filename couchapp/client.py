@@ -7,8 +7,14 @@ from __future__ import with_statement
 import base64
 import itertools
 import logging
+import os
 import re
+import socket
+import threading
 import types
+import uuid
+
+from functools import partial
 
 try:
     import desktopcouch
@@ -22,13 +28,15 @@ except ImportError:
 from restkit import Resource, ClientResponse, ResourceError
 from restkit import util
 from restkit import oauth2 as oauth
+from restkit.conn import Connection
 from restkit.filters import OAuthFilter
+from socketpool import ConnectionPool
 
 from couchapp import __version__
 from couchapp.errors import ResourceNotFound, ResourceConflict, \
     PreconditionFailed, RequestFailed, BulkSaveError, Unauthorized, \
     InvalidAttachment, AppError
-from couchapp.util import json
+from couchapp.util import json, prefetch
 
 USER_AGENT = "couchapp/{0}".format(__version__)
 
@@ -39,6 +47,25 @@ aliases = {
 
 UNKNOWN_VERSION = tuple()
 
+# size of the buffer used to stream attachments from disk
+STREAM_BUFSIZE = 64 * 1024
+
+# maximum number of keep-alive connections kept for each server
+POOL_SIZE = 10
+
+# number of keys sent by each ``_all_docs`` request of ``last_revs``
+KEYS_BATCH = 1000
+
+# maximum number of documents and size in bytes of a ``_bulk_docs``
+# request of ``save_docs``, a bigger document is sent alone
+BULK_SIZE = 1000
+BULK_BYTES = 8 * 1024 * 1024
+
+# the connection pools, uuids and databases of the process, by uri, see
+# ``get_db``
+_registry = {'pools': {}, 'uuids': {}, 'dbs': {}}
+_registry_lock = threading.Lock()
+
 logger = logging.getLogger(__name__)
 
 
@@ -192,11 +219,29 @@ class Database(object):
     A Database object can act as a Dict object.
     """
 
-    def __init__(self, uri, create=True, **client_opts):
+    def __init__(self, uri, create=True, bufsize=STREAM_BUFSIZE, uuids=None,
+                 bulk_size=BULK_SIZE, bulk_bytes=BULK_BYTES, bulk_workers=1,
+                 **client_opts):
+        """
+        @param uuids: the `Uuids` of the server to use, a new one by
+        default
+        @param bulk_size: maximum number of documents by ``_bulk_docs``
+        request, see `save_docs`
+        @param bulk_bytes: maximum size of a ``_bulk_docs`` request
+        @param bulk_workers: number of ``_bulk_docs`` requests sent at the
+        same time
+        """
         if uri.endswith("/"):
             uri = uri[:-1]
 
         self.raw_uri = uri
+        self.bufsize = bufsize
+        self.bulk_size = bulk_size
+        self.bulk_bytes = bulk_bytes
+        self.bulk_workers = bulk_workers
+        # length of the bodies of the requests saving docs and attachments
+        self.bytes_sent = 0
+        self._count_lock = threading.Lock()
         if uri.startswith("desktopcouch://"):
             if not desktopcouch:
                 raise AppError("Desktopcouch isn't available on this" +
@@ -219,14 +264,20 @@ class Database(object):
         self.res = CouchdbResource(uri=uri, **client_opts)
         self.server_uri, self.dbname = uri.rsplit('/', 1)
 
-        self.uuids = Uuids(self.server_uri, **client_opts)
+        self.uuids = uuids if uuids is not None else \
+            Uuids(self.server_uri, **client_opts)
 
+        self.created = False
         if create:
-            # create the db
-            try:
-                self.res.head()
-            except ResourceNotFound:
-                self.res.put()
+            self.create()
+
+    def create(self):
+        """ Create the database if it doesn't exist """
+        try:
+            self.res.head()
+        except ResourceNotFound:
+            self.res.put()
+        self.created = True
 
     def delete(self):
         self.res.delete()
@@ -269,7 +320,8 @@ class Database(object):
             return wrapper(resp.json_body)
         return resp.json_body
 
-    def save_doc(self, doc, encode=False, force_update=False, **params):
+    def save_doc(self, doc, encode=False, force_update=False,
+                 multipart=False, **params):
         """ Save a document. It will use the `_id` member of the document
         or request a new uuid from CouchDB. IDs are attached to
         documents on the client side because POST has the curious property of
@@ -283,6 +335,9 @@ class Database(object):
         with latest revision
         @param encode: Encode attachments if needed (depends on couchdb
         version)
+        @param multipart: send the :class:`FileAttachment` data as raw
+        parts of a ``multipart/related`` request instead of base64 in the
+        json (needs CouchDB >= 1.1)
 
         @return: new doc with updated revision an id
         """
@@ -292,24 +347,32 @@ class Database(object):
         headers = params.get('headers', {})
         headers.setdefault('Content-Type', 'application/json')
         params['headers'] = headers
+        encode_body = self.encode_multipart if multipart else \
+            self.encode_body
 
         if '_id' in doc:
             docid = escape_docid(doc['_id'])
             try:
-                resp = self.res.put(docid, payload=json.dumps(doc), **params)
+                resp = self.res.put(docid,
+                                    payload=self._count(
+                                        encode_body(doc, headers)),
+                                    **params)
             except ResourceConflict:
                 if not force_update:
                     raise
                 rev = self.last_rev(doc['_id'])
                 doc['_rev'] = rev
-                resp = self.res.put(docid, payload=json.dumps(doc), **params)
+                resp = self.res.put(docid,
+                                    payload=self._count(
+                                        encode_body(doc, headers)),
+                                    **params)
         else:
-            json_doc = json.dumps(doc)
+            payload = self._count(encode_body(doc, headers))
             try:
                 doc['_id'] = self.uuids.next()
-                resp = self.res.put(doc['_id'], payload=json_doc, **params)
+                resp = self.res.put(doc['_id'], payload=payload, **params)
             except ResourceConflict:
-                resp = self.res.post(payload=json_doc, **params)
+                resp = self.res.post(payload=payload, **params)
 
         json_res = resp.json_body
         doc1 = {}
@@ -319,6 +382,110 @@ class Database(object):
         doc.update(doc1)
         return doc
 
+    def _count(self, payload):
+        """ Add the length of a request body to `bytes_sent`
+
+        @return: `payload`
+        """
+        length = len(payload) if isinstance(payload, basestring) else \
+            getattr(payload, 'length', 0)
+        with self._count_lock:
+            self.bytes_sent += length
+        return payload
+
+    def encode_body(self, obj, headers):
+        """ Serialize ``obj`` to json for a request body.
+
+        If ``obj`` holds :class:`FileAttachment` data, the attachments are
+        streamed from disk and base64 encoded on the fly, ``self.bufsize``
+        bytes at a time, so the memory used doesn't depend on their size.
+
+        @param headers: dict, request headers, ``Content-Length`` is set
+        when needed.
+
+        @return: str or :class:`StreamBody`
+        """
+        parts = self._body_parts(obj)
+        if len(parts) == 1:
+            return parts[0][1]
+
+        body = StreamBody(parts)
+        headers['Content-Length'] = str(body.length)
+        return body
+
+    def _body_parts(self, obj):
+        """ Serialize ``obj`` to json, see `encode_body`.
+
+        @return: list of ``(length, source)``, see :class:`StreamBody`,
+        a single str when ``obj`` holds no :class:`FileAttachment`
+        """
+        files = {}
+        marker = uuid.uuid4().hex
+        obj = _mark_files(obj, marker, files)
+        payload = json.dumps(obj)
+        if not files:
+            return [(len(payload), payload)]
+
+        parts = []
+        for i, chunk in enumerate(re.split('"%s-(\\d+)"' % marker, payload)):
+            if i % 2 == 0:
+                parts.append((len(chunk), chunk))
+                continue
+            att = files[int(chunk)]
+            parts.extend([(1, '"'),
+                          (att.b64_length,
+                           partial(att.b64_chunks, self.bufsize)),
+                          (1, '"')])
+        return parts
+
+    def encode_multipart(self, doc, headers):
+        """ Serialize ``doc`` to a ``multipart/related`` request body.
+
+        The :class:`FileAttachment` data are replaced by ``follows`` stubs
+        in the json part and sent raw, in the same order, in the next
+        parts. Other attachments stay inline.
+
+        @param headers: dict, request headers, ``Content-Type`` and
+        ``Content-Length`` are set when needed.
+
+        @return: str or :class:`StreamBody`
+        """
+        atts = doc.get('_attachments') or {}
+        stubs, files = {}, {}
+        for name, att in atts.iteritems():
+            if isinstance(att, dict) and isinstance(att.get('data'),
+                                                    FileAttachment):
+                files[name] = att['data']
+                stubs[name] = dict((k, v) for k, v in att.iteritems()
+                                   if k != 'data')
+                stubs[name].update(follows=True, length=files[name].length)
+            else:
+                stubs[name] = att
+        if not files:
+            return self.encode_body(doc, headers)
+
+        boundary = uuid.uuid4().hex
+        head = '--%s\r\nContent-Type: application/json\r\n\r\n' % boundary
+        payload = json.dumps(dict(doc, _attachments=stubs))
+        parts = [(len(head), head), (len(payload), payload)]
+
+        # the json encoder walks ``stubs`` in this same order, which is
+        # the order CouchDB expects the attachment parts in
+        head = '\r\n--%s\r\n\r\n' % boundary
+        for name in stubs:
+            if name in files:
+                att = files[name]
+                parts.extend([(len(head), head),
+                              (att.length, partial(att.chunks, self.bufsize))])
+        tail = '\r\n--%s--' % boundary
+        parts.append((len(tail), tail))
+
+        body = StreamBody(parts)
+        headers['Content-Type'] = 'multipart/related; boundary="%s"' % \
+            boundary
+        headers['Content-Length'] = str(body.length)
+        return body
+
     def last_rev(self, docid):
         """ Get last revision from docid (the '_rev' member)
         @param docid: str, undecoded document id.
@@ -333,6 +500,25 @@ class Database(object):
         doc = self.open_doc(docid)
         return doc['_rev']
 
+    def last_revs(self, docids, batch=KEYS_BATCH):
+        """ Get the last revisions of several documents, `batch` of them
+        by ``_all_docs`` request instead of a request by document.
+
+        @param docids: list of str, undecoded document ids.
+
+        @return: dict, the last revision of the documents of `docids` in
+        the database, by id. The missing and deleted ones are left out.
+        """
+        revs = {}
+        for i in range(0, len(docids), batch):
+            res = self.all_docs(keys=docids[i:i + batch])
+            for row in res['rows']:
+                value = row.get('value')
+                if 'error' in row or value is None or value.get('deleted'):
+                    continue
+                revs[row['id']] = value['rev']
+        return revs
+
     def delete_doc(self, id_or_doc):
         """ Delete a document
         @param id_or_doc: docid string or document dict
@@ -358,8 +544,11 @@ class Database(object):
         @param all_or_nothing: In the case of a power failure, when the
         database restarts either all the changes will have been saved or none
         of them. However, it does not do conflict checking, so the documents
-        will.
+        will. The docs are sent in one request.
 
+        The docs are sent in chunks of at most `bulk_size` docs and
+        `bulk_bytes` bytes, `bulk_workers` chunks at a time. The errors of
+        all the chunks are raised together.
 
         @return doc lists updated with new revision or raise BulkSaveError
         exception. You can access to doc created and docs in error as
@@ -380,28 +569,75 @@ class Database(object):
                 if nextid:
                     doc['_id'] = nextid
 
-        payload = {"docs": docs}
-        if all_or_nothing:
-            payload["all-or-nothing"] = True
+        def post(chunk):
+            start, payload, headers = chunk
+            res = self.res.post('/_bulk_docs', payload=payload,
+                                headers=headers)
+            return start, res.json_body
 
-        # update docs
-        res = self.res.post('/_bulk_docs', payload=json.dumps(payload),
-                            headers={'Content-Type': 'application/json'})
+        chunks = self._bulk_chunks(docs, all_or_nothing)
+        if self.bulk_workers > 1:
+            results = prefetch(post, chunks, self.bulk_workers)
+        else:
+            results = itertools.imap(post, chunks)
 
-        json_res = res.json_body
         errors = []
-        for i, r in enumerate(json_res):
+        for start, json_res in results:
+            errors.extend(self._update_docs(docs, start, json_res))
+
+        if errors:
+            raise BulkSaveError(docs, errors)
+
+    def _bulk_chunks(self, docs, all_or_nothing=False):
+        """ Split the ``_bulk_docs`` requests of `save_docs`.
+
+        @return: iterator of ``(start, payload, headers)``, ``start``
+        being the index of the first doc of the request in `docs`
+        """
+        def request(start, parts):
+            head = '{"docs": ['
+            tail = '], "all-or-nothing": true}' if all_or_nothing else ']}'
+            parts = [(len(head), head)] + parts + [(len(tail), tail)]
+            headers = {'Content-Type': 'application/json'}
+            if all(isinstance(source, basestring) for _, source in parts):
+                payload = ''.join(source for _, source in parts)
+            else:
+                payload = StreamBody(parts)
+                headers['Content-Length'] = str(payload.length)
+            return start, self._count(payload), headers
+
+        start, parts, size = 0, [], 0
+        for i, doc in enumerate(docs):
+            doc_parts = self._body_parts(doc)
+            doc_size = sum(length for length, _ in doc_parts)
+            if parts and not all_or_nothing and \
+                    (i - start >= self.bulk_size or
+                     size + doc_size > self.bulk_bytes):
+                yield request(start, parts)
+                start, parts, size = i, [], 0
+            if parts:
+                parts.append((2, ', '))
+            parts.extend(doc_parts)
+            size += doc_size + 2
+        yield request(start, parts)
+
+    @staticmethod
+    def _update_docs(docs, start, json_res):
+        """ Update the docs saved by a ``_bulk_docs`` request.
+
+        @return: list of the docs not saved
+        """
+        errors = []
+        for i, r in enumerate(json_res, start):
             if 'error' in r:
+                # no revision is given for the documents not saved
                 doc1 = docs[i]
-                doc1.update({'_id': r['id'],
-                             '_rev': r['rev']})
+                doc1['_id'] = r['id']
                 errors.append(doc1)
             else:
                 docs[i].update({'_id': r['id'],
                                 '_rev': r['rev']})
-
-        if errors:
-            raise BulkSaveError(docs, errors)
+        return errors
 
     def delete_docs(self, docs, all_or_nothing=False, use_uuids=True):
         """ multiple doc delete."""
@@ -424,10 +660,12 @@ class Database(object):
         else:
             docid = id_or_doc['_id']
 
-        return self.res.get("%s/%s" % (escape_docid(docid), name),
+        return self.res.get("%s/%s" % (escape_docid(docid),
+                                       util.url_quote(name, safe="")),
                             headers=headers)
 
-    def put_attachment(self, doc, content=None, name=None, headers=None):
+    def put_attachment(self, doc, content=None, name=None, headers=None,
+                       refresh=False):
         """ Add attachement to a document. All attachments are streamed.
 
         @param doc: dict, document object
@@ -435,10 +673,13 @@ class Database(object):
         @param name: name or attachment (file name).
         @param headers: optionnal headers like `Content-Length`
         or `Content-Type`
+        @param refresh: if True, fetch the whole document again once the
+        attachment is saved. Otherwise only its `_rev` is updated, from
+        the response, and a stub of the attachment is added.
 
         @return: updated document object
         """
-        headers = {}
+        headers = headers or {}
         content = content or ""
 
         if name is None:
@@ -447,27 +688,42 @@ class Database(object):
             else:
                 raise InvalidAttachment('You should provid a valid ' +
                                         'attachment name')
-        name = util.url_quote(name, safe="")
-        res = self.res.put("%s/%s" % (escape_docid(doc['_id']), name),
-                           payload=content, headers=headers, rev=doc['_rev'])
+        res = self.res.put("%s/%s" % (escape_docid(doc['_id']),
+                                      util.url_quote(name, safe="")),
+                           payload=self._count(content), headers=headers,
+                           rev=doc['_rev'])
         json_res = res.json_body
 
-        if 'ok' in json_res:
-            return doc.update(self.open_doc(doc['_id']))
-        return False
+        if 'ok' not in json_res:
+            return False
+        if refresh:
+            doc.update(self.open_doc(doc['_id']))
+        else:
+            doc['_rev'] = json_res['rev']
+            attachments = doc.get('_attachments') or {}
+            attachments[name] = {'stub': True}
+            doc['_attachments'] = attachments
+        return doc
 
-    def delete_attachment(self, doc, name):
+    def delete_attachment(self, doc, name, refresh=False):
         """ delete attachement to the document
 
         @param doc: dict, document object in python
         @param name: name of attachement
+        @param refresh: if True, fetch the whole document again once the
+        attachment is deleted. Otherwise only its `_rev` is updated.
 
         @return: updated document object
         """
-        name = util.url_quote(name, safe="")
-        self.res.delete("%s/%s" % (escape_docid(doc['_id']), name),
-                        rev=doc['_rev']).json_body
-        return doc.update(self.open_doc(doc['_id']))
+        json_res = self.res.delete("%s/%s" % (escape_docid(doc['_id']),
+                                              util.url_quote(name, safe="")),
+                                   rev=doc['_rev']).json_body
+        if refresh:
+            doc.update(self.open_doc(doc['_id']))
+        else:
+            doc['_rev'] = json_res['rev']
+            (doc.get('_attachments') or {}).pop(name, None)
+        return doc
 
     def view(self, view_name, **params):
         try:
@@ -478,13 +734,93 @@ class Database(object):
 
         if "keys" in params:
             keys = params.pop("keys")
-            return self.res.post(path,
-                                 json.dumps({"keys":
-                                             keys}, **params)).json_body
+            payload = json.dumps({"keys": keys})
+            return self.res.post(path, payload=self._count(payload),
+                                 headers={'Content-Type':
+                                          'application/json'},
+                                 **params).json_body
 
         return self.res.get(path, **params).json_body
 
 
+class NoDelayConnection(Connection):
+    """ A restkit `Connection` with Nagle's algorithm disabled.
+
+    restkit sends the headers of a request, then its body when it's a
+    file-like object such as `StreamBody`. Otherwise the body would wait
+    for the server to acknowledge the headers, 40ms or more with delayed
+    acknowledgements, on each request.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(NoDelayConnection, self).__init__(*args, **kwargs)
+        try:
+            self._s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        except (socket.error, AttributeError):
+            pass
+
+
+def get_pool(server_uri, pool_size=POOL_SIZE):
+    """
+    @return: the pool of the keep-alive connections to `server_uri`,
+    shared by the `Database` objects of the process. Its size is the one
+    of the first call.
+    """
+    with _registry_lock:
+        pools = _registry['pools']
+        if server_uri not in pools:
+            pools[server_uri] = ConnectionPool(factory=NoDelayConnection,
+                                               max_size=pool_size)
+        return pools[server_uri]
+
+
+def get_db(uri, create=True, bufsize=STREAM_BUFSIZE, pool_size=POOL_SIZE,
+           bulk_size=BULK_SIZE, bulk_bytes=BULK_BYTES, bulk_workers=1,
+           **client_opts):
+    """
+    Like `Database`, but the object is shared by the process: commands,
+    hooks and ``_docs`` pushes to the same database reuse it, without
+    checking again that it exists. The databases of a server share one
+    pool of connections and one `Uuids`.
+
+    @param pool_size: maximum number of keep-alive connections to the
+    server, see `get_pool`
+    @param bulk_size, bulk_bytes, bulk_workers: see `Database`
+    @param client_opts: options of the `CouchdbResource`, they must be
+    hashable
+    """
+    uri = uri.rstrip('/')
+    server_uri = uri.rsplit('/', 1)[0]
+    bulk = dict(bulk_size=bulk_size, bulk_bytes=bulk_bytes,
+                bulk_workers=bulk_workers)
+    key = (uri, bufsize, tuple(sorted(bulk.items())),
+           tuple(sorted(client_opts.items())))
+    with _registry_lock:
+        db = _registry['dbs'].get(key)
+    if db is None:
+        client_opts.setdefault('pool', get_pool(server_uri, pool_size))
+        with _registry_lock:
+            uuids = _registry['uuids'].get(server_uri)
+        client_opts.update(bulk)
+        db = Database(uri, create=create, bufsize=bufsize, uuids=uuids,
+                      **client_opts)
+        with _registry_lock:
+            _registry['uuids'].setdefault(server_uri, db.uuids)
+            db = _registry['dbs'].setdefault(key, db)
+    if create and not db.created:
+        db.create()
+    return db
+
+
+def clear_registry():
+    """ Forget the databases, uuids and connection pools of `get_db` """
+    with _registry_lock:
+        for pool in _registry['pools'].values():
+            pool.release_all()
+        for registry in _registry.values():
+            registry.clear()
+
+
 def encode_params(params):
     """ encode parameters in json if needed """
     _params = {}
@@ -504,6 +840,8 @@ def escape_docid(docid):
         docid = docid[1:]
     if docid.startswith('_design'):
         docid = '_design/%s' % util.url_quote(docid[8:], safe='')
+    elif docid.startswith('_local/'):
+        docid = '_local/%s' % util.url_quote(docid[7:], safe='')
     else:
         docid = util.url_quote(docid, safe='')
     return docid
@@ -511,9 +849,129 @@ def escape_docid(docid):
 
 def encode_attachments(attachments):
     for k, v in attachments.iteritems():
-        if v.get('stub', False):
+        if v.get('stub', False) or isinstance(v.get('data'), FileAttachment):
             continue
         else:
             re_sp = re.compile('\s')
             v['data'] = re_sp.sub('', base64.b64encode(v['data']))
     return attachments
+
+
+def _mark_files(obj, marker, files):
+    """ Return a copy of ``obj`` (a doc, a list of docs or a ``_bulk_docs``
+    payload) where the :class:`FileAttachment` data are replaced by
+    the string ``"<marker>-<n>"``, ``files[n]`` being the attachment.
+    Only the containers leading to a ``FileAttachment`` are copied.
+    """
+    if isinstance(obj, list):
+        return [_mark_files(o, marker, files) for o in obj]
+    elif not isinstance(obj, dict):
+        return obj
+
+    if 'docs' in obj and isinstance(obj['docs'], list):
+        obj = obj.copy()
+        obj['docs'] = _mark_files(obj['docs'], marker, files)
+        return obj
+
+    atts = obj.get('_attachments')
+    if not isinstance(atts, dict):
+        return obj
+
+    marked = None
+    for name, att in atts.iteritems():
+        if isinstance(att, dict) and isinstance(att.get('data'),
+                                                FileAttachment):
+            if marked is None:
+                marked = atts.copy()
+            files[len(files)] = att['data']
+            marked[name] = dict(att, data='%s-%d' % (marker, len(files) - 1))
+
+    if marked is None:
+        return obj
+    obj = obj.copy()
+    obj['_attachments'] = marked
+    return obj
+
+
+class FileAttachment(object):
+    """ Data of an attachment, read from disk only when sent. """
+
+    def __init__(self, path, length=None):
+        self.path = path
+        self.length = length if length is not None else \
+            os.path.getsize(path)
+
+    @property
+    def b64_length(self):
+        return 4 * ((self.length + 2) // 3)
+
+    def chunks(self, bufsize=STREAM_BUFSIZE):
+        with open(self.path, 'rb') as f:
+            while True:
+                data = f.read(bufsize)
+                if not data:
+                    break
+                yield data
+
+    def b64_chunks(self, bufsize=STREAM_BUFSIZE):
+        """ base64 encode the file, ``bufsize`` bytes at a time """
+        bufsize = max(3, bufsize - bufsize % 3)
+        rest = ''
+        for data in self.chunks(bufsize):
+            data = rest + data
+            cut = len(data) - len(data) % 3
+            data, rest = data[:cut], data[cut:]
+            if data:
+                yield base64.b64encode(data)
+        if rest:
+            yield base64.b64encode(rest)
+
+    def b64encode(self):
+        with open(self.path, 'rb') as f:
+            return base64.b64encode(f.read())
+
+
+class StreamBody(object):
+    """ File-like request body, concatenation of strings and of iterables
+    of strings, read chunk by chunk by the http client.
+
+    @param parts: list of ``(length, source)`` where ``source`` is a str
+    or a callable returning an iterable of str.
+    """
+
+    def __init__(self, parts):
+        self.parts = parts
+        self.length = sum(length for length, _ in parts)
+        self.seek(0)
+
+    def _iter_chunks(self):
+        for _, source in self.parts:
+            if isinstance(source, basestring):
+                yield source
+            else:
+                for chunk in source():
+                    yield chunk
+
+    def seek(self, offset, whence=0):
+        if offset or whence:
+            raise IOError("a StreamBody can only be rewound")
+        self._chunks = self._iter_chunks()
+        self._buf = ''
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            data, self._buf = self._buf + ''.join(self._chunks), ''
+            return data
+
+        bufs, buflen = [self._buf], len(self._buf)
+        while buflen < size:
+            try:
+                chunk = next(self._chunks)
+            except StopIteration:
+                break
+            bufs.append(chunk)
+            buflen += len(chunk)
+
+        data = ''.join(bufs)
+        data, self._buf = data[:size], data[size:]
+        return data
@@ -11,7 +11,7 @@ import os
 from hashlib import md5
 
 from couchapp import client, util
-from couchapp.errors import AppError, MissingContent
+from couchapp.errors import AppError, MissingContent, ResourceNotFound
 
 
 logger = logging.getLogger(__name__)
@@ -111,8 +111,19 @@ class clone(object):
             - self.manifest
             - self.signatures
             - self.objects: objects refs
+
+        They're read from the ``_local`` document ``couchapp.metadata``
+        refers to, if any.
         '''
         metadata = self.doc.get('couchapp', {})
+        if 'metadata' in metadata:
+            try:
+                metadata = self.db.open_doc(metadata['metadata'])
+            except ResourceNotFound:
+                logger.warning('missing metadata document %s, the '
+                               'macros are left expanded',
+                               metadata['metadata'])
+                metadata = {}
 
         self.manifest = metadata.get('manifest', [])
         self.signatures = metadata.get('signatures', {})
@@ -325,6 +336,8 @@ class clone(object):
             - ``manifest``
             - ``objects``
             - ``length``
+            - ``metadata``
+            - ``hash``
         '''
         if 'couchapp' not in self.doc:
             logger.warning('missing `couchapp` property in document')
@@ -340,6 +353,10 @@ class clone(object):
             del app_meta['objects']
         if 'length' in app_meta:
             del app_meta['length']
+        if 'metadata' in app_meta:
+            del app_meta['metadata']
+        if 'hash' in app_meta:
+            del app_meta['hash']
 
         couchapp_file = os.path.join(self.path, 'couchapp.json')
         util.write_json(couchapp_file, app_meta)
@@ -8,10 +8,12 @@ from __future__ import print_function
 import logging
 import os
 
-from couchapp import clone_app, generator, util
+from couchapp import clone_app, generator, loader, puller, util
 from couchapp.autopush.command import autopush, DEFAULT_UPDATE_DELAY
-from couchapp.errors import ResourceNotFound, AppError, BulkSaveError
-from couchapp.localdoc import document
+from couchapp.cache import PushJournal, digest
+from couchapp.errors import AppError, BulkSaveError
+from couchapp.localdoc import PARALLEL_PUSHES, READ_AHEAD_WORKERS, \
+    document, push_targets, report
 from couchapp.vendors import vendor_install, vendor_update
 
 logger = logging.getLogger(__name__)
@@ -66,6 +68,11 @@ def push(conf, path, *args, **opts):
     noatomic = opts.get('no_atomic', False)
     browse = opts.get('browse', False)
     force = opts.get('force', False)
+    use_cache = not opts.get('no_cache', False)
+    multipart = opts.get('multipart', False)
+    jobs = opts.get('jobs', 1)
+    parallel = opts.get('parallel', PARALLEL_PUSHES)
+    workers = opts.get('workers', READ_AHEAD_WORKERS)
     dest = None
     doc_path = None
     if len(args) < 2:
@@ -85,8 +92,13 @@ def push(conf, path, *args, **opts):
         raise AppError("You aren't in a couchapp.")
 
     conf.update(doc_path)
+    commonjs = opts.get('commonjs', False) or conf.get('commonjs', False)
+    local_metadata = opts.get('local_metadata', False) or \
+        conf.get('local_metadata', False)
 
-    doc = document(doc_path, create=False, docid=opts.get('docid'))
+    doc = document(doc_path, create=False, docid=opts.get('docid'),
+                   use_cache=use_cache, jobs=jobs, commonjs=commonjs,
+                   local_metadata=local_metadata)
     if export:
         if opts.get('output'):
             util.write_json(opts.get('output'), doc)
@@ -97,38 +109,51 @@ def push(conf, path, *args, **opts):
     dbs = conf.get_dbs(dest)
 
     hook(conf, doc_path, "pre-push", dbs=dbs)
-    doc.push(dbs, noatomic, browse, force)
-    hook(conf, doc_path, "post-push", dbs=dbs)
+    results = doc.push(dbs, noatomic, browse, force, multipart=multipart,
+                       parallel=parallel, workers=workers)
+    status = report(results)
+    hook(conf, doc_path, "post-push",
+         dbs=[result.db for result in results if result.error is None])
 
     docspath = os.path.join(doc_path, '_docs')
     if os.path.exists(docspath):
-        pushdocs(conf, docspath, dest, *args, **opts)
-    return 0
+        status = pushdocs(conf, docspath, dest, *args, **opts) or status
+    return status
 
 
 def pushapps(conf, source, dest=None, *args, **opts):
     export = opts.get('export', False)
     noatomic = opts.get('no_atomic', False)
     browse = opts.get('browse', False)
+    use_cache = not opts.get('no_cache', False)
+    jobs = opts.get('jobs', 1)
+    parallel = opts.get('parallel', PARALLEL_PUSHES)
+    workers = opts.get('workers', READ_AHEAD_WORKERS)
+    commonjs = opts.get('commonjs', False) or conf.get('commonjs', False)
+    local_metadata = opts.get('local_metadata', False) or \
+        conf.get('local_metadata', False)
     dbs = conf.get_dbs(dest) if not export else None
     apps = []
+    status = 0
     source = os.path.normpath(os.path.join(os.getcwd(), source))
     appdirs = util.discover_apps(source)
 
     logger.debug('Discovered apps: {0}'.format(appdirs))
 
     for appdir in appdirs:
-        doc = document(appdir)
+        doc = document(appdir, use_cache=use_cache, jobs=jobs,
+                       commonjs=commonjs, local_metadata=local_metadata)
         # if export mode, the ``dbs`` will be None
         hook(conf, appdir, "pre-push", dbs=dbs, pushapps=True)
         if export or not noatomic:
             apps.append(doc)
         else:
-            doc.push(dbs, True, browse)
+            status = report(doc.push(dbs, True, browse, parallel=parallel,
+                                     workers=workers)) or status
         hook(conf, appdir, "post-push", dbs=dbs, pushapps=True)
 
     if not apps:
-        return 0
+        return status
 
     if export:
         docs = [doc.doc() for doc in apps]
@@ -139,29 +164,44 @@ def pushapps(conf, source, dest=None, *args, **opts):
             print(util.json.dumps(jsonobj))
         return 0
 
-    for db in dbs:
-        docs = [doc.doc(db) for doc in apps]
-        try:
-            db.save_docs(docs)
-        except BulkSaveError as e:
-            docs1 = []
-            for doc in e.errors:
-                try:
-                    doc['_rev'] = db.last_rev(doc['_id'])
-                    docs1.append(doc)
-                except ResourceNotFound:
-                    pass
-            if docs1:
-                db.save_docs(docs1)
-    return 0
+    # built once, only the revisions and the attachments differ by db
+    for app in apps:
+        app.build()
+
+    def push_db(db, result):
+        docs = []
+        changed = []
+        for app in apps:
+            doc, unchanged, metadoc = app.prepare(db, stream=True)
+            if unchanged:
+                logger.info("%s unchanged in %s", app.docid, db.dbname)
+            else:
+                docs.append(doc)
+                changed.append((app, metadoc))
+        if not docs:
+            return
+        save_docs(db, docs)
+        for app, metadoc in changed:
+            app.save_metadata(db, metadoc)
+        result.docs = len(docs)
+
+    return report(push_targets(push_db, dbs, parallel)) or status
 
 
 def pushdocs(conf, source, dest, *args, **opts):
     export = opts.get('export', False)
     noatomic = opts.get('no_atomic', False)
     browse = opts.get('browse', False)
+    use_cache = not opts.get('no_cache', False)
+    jobs = opts.get('jobs', 1)
+    parallel = opts.get('parallel', PARALLEL_PUSHES)
+    workers = opts.get('workers', READ_AHEAD_WORKERS)
+    commonjs = opts.get('commonjs', False) or conf.get('commonjs', False)
+    local_metadata = opts.get('local_metadata', False) or \
+        conf.get('local_metadata', False)
     dbs = conf.get_dbs(dest)
     docs = []
+    status = 0
     for d in os.listdir(source):
         docdir = os.path.join(source, d)
         if d.startswith('.'):
@@ -178,11 +218,15 @@ def pushdocs(conf, source, dest, *args, **opts):
                     for db in dbs:
                         db.save_doc(doc, force_update=True)
         else:
-            doc = document(docdir, is_ddoc=False)
+            doc = document(docdir, is_ddoc=False, use_cache=use_cache,
+                           jobs=jobs, commonjs=commonjs,
+                           local_metadata=local_metadata)
             if export or not noatomic:
                 docs.append(doc)
             else:
-                doc.push(dbs, True, browse)
+                status = report(doc.push(dbs, True, browse,
+                                         parallel=parallel,
+                                         workers=workers)) or status
     if docs:
         if export:
             docs1 = []
@@ -197,35 +241,139 @@ def pushdocs(conf, source, dest, *args, **opts):
             else:
                 print(util.json.dumps(jsonobj))
         else:
-            for db in dbs:
+            hashes = []
+            for doc in docs:
+                if hasattr(doc, 'build'):
+                    hashes.append(doc.build().doc['couchapp']['hash'])
+                else:
+                    hashes.append(digest(doc))
+            journal = PushJournal(source, enabled=use_cache)
+
+            def push_db(db, result):
                 docs1 = []
-                for doc in docs:
+                hashes1 = []
+                metadocs = []
+                pushed = journal.docs(db)
+                if pushed:
+                    revs = dict((docid, rev)
+                                for docid, (_, rev) in pushed.iteritems())
+                else:
+                    # the revisions of the json docs, in a few requests
+                    revs = db.last_revs([doc['_id'] for doc in docs
+                                         if not hasattr(doc, 'doc')])
+                docids = set()
+                for doc, dochash in zip(docs, hashes):
+                    if hasattr(doc, 'doc'):
+                        docid = doc.docid
+                    else:
+                        docid = doc['_id']
+                    docids.add(docid)
+                    if pushed.get(docid, [None])[0] == dochash:
+                        continue
                     if hasattr(doc, 'doc'):
-                        docs1.append(doc.doc(db))
+                        newdoc, _, metadoc = doc.prepare(db, stream=True)
+                        metadocs.append((doc, metadoc))
                     else:
                         newdoc = doc.copy()
-                        try:
-                            rev = db.last_rev(doc['_id'])
-                            newdoc.update({'_rev': rev})
-                        except ResourceNotFound:
-                            pass
-                        docs1.append(newdoc)
-                try:
-                    db.save_docs(docs1)
-                except BulkSaveError, e:
-                    # resolve conflicts
-                    docs1 = []
-                    for doc in e.errors:
-                        try:
-                            doc['_rev'] = db.last_rev(doc['_id'])
-                            docs1.append(doc)
-                        except ResourceNotFound:
-                            pass
-                if docs1:
-                    db.save_docs(docs1)
+                        if docid in revs:
+                            newdoc['_rev'] = revs[docid]
+                    docs1.append(newdoc)
+                    hashes1.append(dochash)
+                skipped = len(docs) - len(hashes1)
+                if skipped:
+                    logger.info("%d docs unchanged since the last push to %s,"
+                                " --no-cache pushes them", skipped, db.dbname)
+                # the docs removed from the directory since the last push
+                for docid in sorted(set(pushed) - docids):
+                    docs1.append({'_id': docid, '_rev': revs[docid],
+                                  '_deleted': True})
+                    hashes1.append(None)
+                if not docs1:
+                    return
+
+                failed = set(id(doc) for doc in save_docs(db, docs1))
+                result.docs = len(docs1)
+                for doc, metadoc in metadocs:
+                    doc.save_metadata(db, metadoc)
+                journal.update(db, [
+                    (doc['_id'], dochash,
+                     None if dochash is None or id(doc) in failed
+                     else doc.get('_rev'))
+                    for doc, dochash in zip(docs1, hashes1)])
+
+            status = report(push_targets(push_db, dbs, parallel)) or status
+    return status
+
+
+def pulldocs(conf, source, dest, *args, **opts):
+    '''
+    Pull the documents of the database ``source`` into the directory
+    ``dest``, in the layout of ``pushdocs``, see :mod:`couchapp.puller`.
+    '''
+    dbs = conf.get_dbs(source)
+    if len(dbs) > 1:
+        raise AppError("pull the documents of one database at a time.")
+
+    count = puller.pulldocs(dbs[0], dest,
+                            page_size=opts.get('page_size',
+                                               puller.PAGE_SIZE),
+                            workers=opts.get('workers', puller.WORKERS),
+                            resume=opts.get('resume', False),
+                            design=opts.get('design', False))
+    logger.info("%d docs pulled from %s into %s", count, dbs[0].dbname,
+                dest)
     return 0
 
 
+def save_docs(db, docs):
+    '''
+    Bulk save ``docs`` to ``db``. The documents in conflict are saved
+    again over their last revisions, looked up together, the ones
+    missing from ``db`` are left out.
+
+    :return: list of the docs left out
+    '''
+    try:
+        db.save_docs(docs)
+    except BulkSaveError, e:
+        revs = db.last_revs([doc['_id'] for doc in e.errors])
+        conflicts = []
+        missing = []
+        for doc in e.errors:
+            if doc['_id'] in revs:
+                doc['_rev'] = revs[doc['_id']]
+                conflicts.append(doc)
+            else:
+                missing.append(doc)
+        if conflicts:
+            db.save_docs(conflicts)
+        return missing
+    return []
+
+
+def load(conf, source, dest=None, *args, **opts):
+    '''
+    Load the documents of the NDJSON file ``source``, ``-`` for stdin,
+    into the databases of ``dest``, see :mod:`couchapp.loader`.
+    '''
+    dbs = conf.get_dbs(dest)
+    if source == '-' and len(dbs) > 1:
+        raise AppError("stdin can only be loaded into one database.")
+
+    status = 0
+    for db in dbs:
+        lines = loader.open_source(source, opts.get('gzip') or None)
+        stats = loader.load(db, lines,
+                            writers=opts.get('writers', loader.WRITERS),
+                            batch_size=opts.get('batch_size',
+                                                loader.BATCH_SIZE),
+                            adaptive=not opts.get('fixed_batch', False))
+        logger.info("%s: %r", db.dbname, stats)
+        if stats.failed:
+            status = 1
+    return status
+
+
 def clone(conf, source, *args, **opts):
     dest = args[0] if len(args) > 0 else None
 
@@ -343,6 +491,35 @@ def browse(conf, path, *args, **opts):
     doc.browse(dbs)
 
 
+def deps(conf, path=None, *args, **opts):
+    '''
+    Print the files and the document fields included by the ``!code``
+    and ``!json`` macros of each function, directly or not.
+    '''
+    doc_path = os.path.normpath(os.path.join(os.getcwd(), path or '.'))
+    if not util.iscouchapp(doc_path):
+        raise AppError("Dir '{0}' is not a couchapp.".format(doc_path))
+
+    conf.update(doc_path)
+
+    doc = document(doc_path, create=False, docid=opts.get('docid'),
+                   use_cache=not opts.get('no_cache', False))
+    graph = doc.dependency_graph()
+
+    if opts.get('json', False):
+        print(util.json.dumps(graph, sort_keys=True, indent=4,
+                              separators=(',', ': ')))
+        return 0
+
+    for name in sorted(graph):
+        print(name)
+        for filename in graph[name]['files']:
+            print('    {0}'.format(filename))
+        for field in graph[name]['fields']:
+            print('    !json {0}'.format(field))
+    return 0
+
+
 def version(conf, *args, **opts):
     from couchapp import __version__
 
@@ -420,7 +597,20 @@ pushopts = [
     ('', 'export', False, "don't do push, just export doc to stdout"),
     ('', 'output', '', "if export is selected, output to the file"),
     ('b', 'browse', False, "open the couchapp in the browser"),
-    ('', 'force', False, "force attachments sending")
+    ('', 'force', False, "force attachments sending"),
+    ('', 'no-cache', False, "don't use the local build and signature caches"),
+    ('', 'multipart', False,
+     "send the attachments raw in a multipart request (CouchDB >= 1.1)"),
+    ('', 'jobs', 1,
+     "number of processes expanding the macros, 0 for one per CPU"),
+    ('', 'commonjs', False,
+     "make the libraries included by !code CommonJS modules"),
+    ('', 'local-metadata', False,
+     "keep the manifest, signatures and objects in a _local document"),
+    ('', 'parallel', PARALLEL_PUSHES,
+     "number of databases pushed to at the same time"),
+    ('', 'workers', READ_AHEAD_WORKERS,
+     "number of attachments read ahead of their upload by --no-atomic")
 ]
 
 table = {
@@ -450,6 +640,29 @@ table = {
         pushopts,
         "[OPTION]... SOURCE DEST"
     ),
+    "load": (
+        load,
+        [('', 'writers', loader.WRITERS,
+          "number of _bulk_docs requests sent at the same time"),
+         ('', 'batch-size', loader.BATCH_SIZE,
+          "number of documents of the first request"),
+         ('', 'fixed-batch', False,
+          "don't adapt the batch size to the latency of the requests"),
+         ('z', 'gzip', False,
+          "the input is gzip compressed, the default for .gz files")],
+        "[OPTION]... SOURCE DEST"
+    ),
+    "pulldocs": (
+        pulldocs,
+        [('', 'resume', False,
+          "start after the last document of an interrupted pull"),
+         ('', 'design', False, "pull the design documents too"),
+         ('', 'page-size', puller.PAGE_SIZE,
+          "number of documents of an _all_docs request"),
+         ('', 'workers', puller.WORKERS,
+          "number of attachments downloaded at the same time")],
+        "[OPTION]... SOURCE DEST"
+    ),
     "startapp": (
         startapp,
         [],
@@ -471,6 +684,13 @@ table = {
         [],
         "[COUCHAPPDIR] DEST"
     ),
+    "deps": (
+        deps,
+        [('', 'json', False, "print the graph as json"),
+         ('', 'no-cache', False, "don't use the local build cache"),
+         ('', 'docid', '', "set docid")],
+        "[OPTION]... [COUCHAPPDIR]"
+    ),
     "autopush": (
         autopush,
         [('', 'no-atomic', False, "send attachments one by one"),
@@ -9,7 +9,8 @@ import os
 
 from copy import deepcopy
 
-from .client import Database
+from .client import BULK_BYTES, BULK_SIZE, POOL_SIZE, STREAM_BUFSIZE, \
+    get_db
 from .errors import AppError
 from . import util
 
@@ -40,6 +41,7 @@ class Config(object):
 
         self.conf = self.global_conf.copy()
         self.conf.update(self.local_conf)
+        util.json.use(self.conf.get('json_backend'))
 
     def load(self, path, default=None):
         """
@@ -91,6 +93,7 @@ class Config(object):
         self.conf = self.global_conf.copy()
         self.local_conf.update(self.load_local(path))
         self.conf.update(self.local_conf)
+        util.json.use(self.conf.get('json_backend'))
 
     def get(self, key, default=None):
         try:
@@ -170,7 +173,16 @@ class Config(object):
 
         use_proxy = any(k in os.environ for k in ('http_proxy', 'https_proxy'))
 
-        return [Database(dburl, use_proxy=use_proxy) for dburl in dburls]
+        bufsize = int(self.conf.get('buffer_size', STREAM_BUFSIZE))
+        pool_size = int(self.conf.get('pool_size', POOL_SIZE))
+        bulk_size = int(self.conf.get('bulk_size', BULK_SIZE))
+        bulk_bytes = int(self.conf.get('bulk_bytes', BULK_BYTES))
+        bulk_workers = int(self.conf.get('bulk_workers', 1))
+
+        return [get_db(dburl, use_proxy=use_proxy, bufsize=bufsize,
+                       pool_size=pool_size, bulk_size=bulk_size,
+                       bulk_bytes=bulk_bytes, bulk_workers=bulk_workers)
+                for dburl in dburls]
 
     def get_app_name(self, dbstring=None, default=None):
         dbstring = dbstring or ''
@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of couchapp released under the Apache 2 license.
+# See the NOTICE for more information.
+'''
+Matching of paths against the ``.couchappignore`` patterns.
+
+A path is ignored if a pattern matches (as ``re.match(pattern + '$')``)
+any run of its components, e.g. ``foo/bar/baz.json`` is checked against
+``foo``, ``foo/bar``, ``foo/bar/baz.json``, ``bar``, ``bar/baz.json``,
+``baz.json``, and also ``/foo``, ``/foo/bar`` and ``/foo/bar/baz.json``
+for the patterns anchored at the document root.
+
+Rather than trying every run of components, the patterns are compiled
+once into a single regex searched over ``'/' + path``, where ``^`` and
+``$`` are rewritten to match at component boundaries.
+'''
+
+import logging
+import os
+import re
+
+logger = logging.getLogger(__name__)
+
+# start and end of a run of components in ``'/' + path``
+_START = r'(?:^|(?<=/))'
+_END = r'(?=/|$)(?!^)'
+
+# inline flags and back references don't survive being merged
+# with other patterns in one regex
+_INLINE_FLAGS = 'iLmsux'
+
+
+def translate(pattern):
+    '''
+    Rewrite the anchors of ``pattern + '$'`` to component boundaries
+
+    >>> translate('bar')
+    '(?:^|(?<=/))(?:bar(?=/|$)(?!^))'
+
+    >>> translate('^CVS|[$^]')
+    '(?:^|(?<=/))(?:(?:^|(?<=/))CVS|[$^](?=/|$)(?!^))'
+
+    :return: the regex, to be searched over ``'/' + path``
+    '''
+    return _translate(pattern)[0]
+
+
+def _translate(pattern):
+    '''
+    :return: tuple ``(regex, standalone)``. ``standalone`` is ``True``
+             if the regex can't be merged with other ones.
+    '''
+    pattern += '$'
+    out = []
+    standalone = False
+    in_class = False
+    i, n = 0, len(pattern)
+
+    while i < n:
+        c = pattern[i]
+        if c == '\\':
+            nxt = pattern[i + 1:i + 2]
+            if not in_class and nxt == 'A':
+                out.append(_START)
+            elif not in_class and nxt == 'Z':
+                out.append(_END)
+            else:
+                if not in_class and nxt in '123456789' and nxt:
+                    standalone = True
+                out.append(pattern[i:i + 2])
+            i += 2
+            continue
+
+        if in_class:
+            if c == ']':
+                in_class = False
+            out.append(c)
+        elif c == '[':
+            in_class = True
+            out.append(c)
+            # ``[]...]`` and ``[^]...]``: the first ``]`` is a literal
+            j = i + 1
+            if pattern[j:j + 1] == '^':
+                j += 1
+            if pattern[j:j + 1] == ']':
+                j += 1
+            out.append(pattern[i + 1:j])
+            i = j
+            continue
+        elif c == '^':
+            out.append(_START)
+        elif c == '$':
+            out.append(_END)
+        else:
+            if c == '(' and pattern[i + 1:i + 2] == '?':
+                nxt = pattern[i + 2:i + 3]
+                if (nxt and nxt in _INLINE_FLAGS) or \
+                        pattern[i + 2:i + 4] == 'P=':
+                    standalone = True
+            out.append(c)
+        i += 1
+
+    return '%s(?:%s)' % (_START, ''.join(out)), standalone
+
+
+def normalize(path):
+    '''
+    >>> normalize('foo//bar/')
+    'foo/bar'
+    '''
+    path = os.path.normpath(path)
+    if os.sep != '/':
+        path = path.replace(os.sep, '/')
+    return path
+
+
+class IgnoreMatcher(object):
+    '''
+    Compiled form of a list of ignore patterns.
+
+    Verdicts of the parent directories are memoized: once a directory is
+    ignored, everything below it is too, without running any regex.
+
+    :param patterns: list of regexps, as found in ``.couchappignore``
+    '''
+
+    def __init__(self, patterns):
+        self.patterns = list(patterns)
+        self.regexes = self.compile(self.patterns)
+        self._verdicts = {}
+
+    @staticmethod
+    def compile(patterns):
+        '''
+        :return: list of compiled regexes, usually only one
+        '''
+        merged, regexes = [], []
+        for pattern in patterns:
+            regex, standalone = _translate(pattern)
+            if standalone:
+                regexes.append(re.compile(regex))
+            else:
+                merged.append(regex)
+
+        if merged:
+            try:
+                regexes.insert(0, re.compile('|'.join(merged)))
+            except (re.error, AssertionError, OverflowError):
+                # e.g. python 2 allows at most 100 groups per regex
+                regexes[0:0] = [re.compile(r) for r in merged]
+        return regexes
+
+    def _search(self, path):
+        path = '/' + path
+        for regex in self.regexes:
+            if regex.search(path):
+                return True
+        return False
+
+    def _dir_ignored(self, path):
+        try:
+            return self._verdicts[path]
+        except KeyError:
+            pass
+
+        head = path.rpartition('/')[0]
+        verdict = bool(head and self._dir_ignored(head)) or \
+            self._search(path)
+        self._verdicts[path] = verdict
+        return verdict
+
+    def match(self, path):
+        '''
+        :param path: path relative to the document directory
+        :return: ``True`` if ``path`` must be ignored
+        '''
+        if not self.regexes:
+            return False
+
+        path = normalize(path)
+        head = path.rpartition('/')[0]
+        if head and self._dir_ignored(head):
+            return True
+        return self._search(path)
+
+    __call__ = match
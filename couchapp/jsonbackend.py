@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of couchapp released under the Apache 2 license.
+# See the NOTICE for more information.
+'''
+Pluggable json backends behind ``couchapp.util.json``.
+
+The fastest available backend is used, unless one is forced by the
+``json_backend`` setting of ``.couchapprc`` or ``~/.couchapp.conf``, or
+by the ``COUCHAPP_JSON`` environment variable.
+
+All the backends output the same json as the ``json`` module. ``ujson``
+rounds floats and can't encode big integers, so it's only used to
+decode, and falls back on the ``json`` module for what it can't parse.
+'''
+
+import logging
+import os
+
+from couchapp.errors import AppError
+
+logger = logging.getLogger(__name__)
+
+
+class Backend(object):
+    '''
+    A json implementation: its ``dumps`` and ``loads``, set by the
+    constructor, which raises ``ImportError`` if it isn't available.
+    '''
+    name = None
+
+
+class StdlibBackend(Backend):
+    name = 'json'
+
+    def __init__(self):
+        import json
+        self.dumps = json.dumps
+        self.loads = json.loads
+
+
+class SimplejsonBackend(Backend):
+    name = 'simplejson'
+
+    def __init__(self):
+        import simplejson
+        # without its C extension, simplejson is slower than ``json``
+        from simplejson import _speedups
+        self.dumps = simplejson.dumps
+        self.loads = simplejson.loads
+
+
+class UjsonBackend(Backend):
+    name = 'ujson'
+
+    def __init__(self):
+        import json
+        import ujson
+        self._loads = ujson.loads
+        self._fallback = json.loads
+        self.dumps = json.dumps
+
+    def loads(self, s):
+        try:
+            return self._loads(s, precise_float=True)
+        except (ValueError, OverflowError):
+            # e.g. integers too big for a long long; the ``json`` module
+            # gives the same error message as the other backends too
+            return self._fallback(s)
+
+
+# by preference order
+BACKENDS = (UjsonBackend, SimplejsonBackend, StdlibBackend)
+
+
+def available_backends():
+    '''
+    :return: list of the names of the available backends
+    '''
+    names = []
+    for cls in BACKENDS:
+        try:
+            cls()
+        except ImportError:
+            continue
+        names.append(cls.name)
+    return names
+
+
+class JSON(object):
+    '''
+    ``couchapp.util.json``: ``dumps`` and ``loads`` of the selected
+    backend. Modules keep a reference to this object, so the backend
+    can be changed once the configuration is loaded.
+    '''
+
+    def __init__(self):
+        self.backend = None
+        try:
+            self.use()
+        except AppError, e:
+            logger.warning("%s, using 'json'", e)
+            self.backend = StdlibBackend()
+
+    def use(self, name=None):
+        '''
+        Select the backend set in ``COUCHAPP_JSON``, else ``name``, else
+        the fastest available one.
+
+        :raise AppError: if the backend is unknown or not available
+        '''
+        name = os.environ.get('COUCHAPP_JSON') or name or \
+            available_backends()[0]
+        if self.backend is not None and self.backend.name == name:
+            return
+
+        for cls in BACKENDS:
+            if cls.name != name:
+                continue
+            try:
+                self.backend = cls()
+            except ImportError, e:
+                raise AppError("json backend '%s' isn't available: %s" %
+                               (name, e))
+            logger.debug("json backend: %s", name)
+            return
+        raise AppError("unknown json backend '%s', use one of: %s" %
+                       (name, ', '.join(cls.name for cls in BACKENDS)))
+
+    @property
+    def name(self):
+        return self.backend.name
+
+    def dumps(self, obj, **kwargs):
+        return self.backend.dumps(obj, **kwargs)
+
+    def loads(self, s):
+        return self.backend.loads(s)
@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of couchapp released under the Apache 2 license.
+# See the NOTICE for more information.
+'''
+Load the documents of a NDJSON file, one json document by line, into a
+database. The file is read as the documents are sent: the lines are
+parsed, grouped in batches and saved by a few ``_bulk_docs`` requests
+at a time, so the memory used doesn't depend on the size of the file.
+'''
+
+from __future__ import with_statement
+
+import logging
+import sys
+import time
+import zlib
+
+from couchapp import util
+from couchapp.errors import AppError, BulkSaveError
+
+# number of documents of the first ``_bulk_docs`` request
+BATCH_SIZE = 500
+
+# bounds of the number of documents of a request
+MIN_BATCH = 10
+MAX_BATCH = 10000
+
+# time taken by a ``_bulk_docs`` request the batch size is adapted to
+TARGET_LATENCY = 1.0
+
+# number of ``_bulk_docs`` requests sent at the same time
+WRITERS = 4
+
+# log the progress of the load every ``PROGRESS_STEP`` seconds
+PROGRESS_STEP = 10
+
+# size of the chunks read from a gzip compressed stream
+READ_BUFSIZE = 64 * 1024
+
+logger = logging.getLogger(__name__)
+
+
+def open_source(path, compressed=None):
+    '''
+    :param path: the NDJSON file, ``-`` for stdin
+    :param compressed: if the file is gzip compressed, by default if its
+                       name ends with ``.gz``
+    :return: iterable of the lines of the file
+    '''
+    if compressed is None:
+        compressed = path.endswith('.gz')
+    if path == '-':
+        f = sys.stdin
+    else:
+        try:
+            f = open(path, 'rb')
+        except IOError, e:
+            raise AppError("can't read {0}: {1}".format(path, e))
+    return gunzip_lines(f) if compressed else f
+
+
+def gunzip_lines(f, bufsize=READ_BUFSIZE):
+    '''
+    The lines of a gzip compressed stream, decompressed ``bufsize`` bytes
+    at a time. Unlike ``gzip.GzipFile``, it doesn't seek, so it reads
+    pipes, and the members of concatenated files.
+    '''
+    def decompressor():
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    z = decompressor()
+    rest = ''
+    for chunk in iter(lambda: f.read(bufsize), ''):
+        data = ''
+        while chunk:
+            try:
+                data += z.decompress(chunk)
+            except zlib.error, e:
+                raise AppError("invalid gzip data: {0}".format(e))
+            chunk = z.unused_data
+            if chunk:
+                data += z.flush()
+                z = decompressor()
+        lines = (rest + data).split('\n')
+        rest = lines.pop()
+        for line in lines:
+            yield line + '\n'
+    rest += z.flush()
+    for line in rest.splitlines(True):
+        yield line
+
+
+def read_docs(lines):
+    '''
+    Parse a NDJSON stream, the blank lines are skipped.
+
+    :param lines: iterable of str
+    :return: iterator of dict
+    '''
+    for lineno, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            doc = util.json.loads(line)
+        except ValueError, e:
+            raise AppError("line {0}: invalid json: {1}".format(lineno, e))
+        if not isinstance(doc, dict):
+            raise AppError("line {0}: not a json object".format(lineno))
+        yield doc
+
+
+class BatchSizer(object):
+    '''
+    Number of documents of the next ``_bulk_docs`` request, adapted to
+    the latency of the previous ones: it grows while the requests take
+    less than ``target`` seconds and shrinks when they take more. It
+    changes by a factor of 2 at most each time, so a single slow
+    request doesn't collapse it.
+    '''
+
+    def __init__(self, size=BATCH_SIZE, target=TARGET_LATENCY,
+                 min_size=MIN_BATCH, max_size=MAX_BATCH, adaptive=True):
+        self.min_size = min(min_size, size)
+        self.max_size = max(max_size, size)
+        self.size = size
+        self.target = target
+        self.adaptive = adaptive
+
+    def update(self, count, elapsed):
+        '''
+        :param count: number of documents of a request
+        :param elapsed: its duration, in seconds
+        '''
+        if not self.adaptive or not count:
+            return
+        ideal = count * self.target / max(elapsed, 1e-3)
+        ideal = min(max(ideal, self.size / 2.0), self.size * 2.0)
+        # smoothed, the latency of one request is noisy
+        size = int((self.size + ideal) / 2)
+        self.size = min(max(size, self.min_size), self.max_size)
+
+
+def batches(docs, sizer):
+    '''
+    Group ``docs`` in lists of ``sizer.size`` documents, the size being
+    read again for each batch.
+    '''
+    batch = []
+    for doc in docs:
+        batch.append(doc)
+        if len(batch) >= sizer.size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class LoadStats(object):
+    '''
+    Throughput of a load.
+
+    :attr docs: number of documents saved
+    :attr failed: number of documents rejected, by a conflict with a
+                  document of the database or its validation function
+    :attr batches: number of batches saved
+    :attr bytes: length of the request bodies sent
+    '''
+
+    def __init__(self):
+        self.docs = 0
+        self.failed = 0
+        self.batches = 0
+        self.bytes = 0
+        self.start = time.time()
+
+    @property
+    def elapsed(self):
+        return max(time.time() - self.start, 1e-6)
+
+    def __repr__(self):
+        return '%d docs loaded in %.2fs, %.0f docs/s, %.1f KB/s, ' \
+            '%d batches, %d failed' % (
+                self.docs, self.elapsed, self.docs / self.elapsed,
+                self.bytes / self.elapsed / 1024, self.batches, self.failed)
+
+
+def load(db, source, writers=WRITERS, batch_size=BATCH_SIZE, adaptive=True):
+    '''
+    Save the documents of ``source`` in ``db``.
+
+    The documents without ``_id`` get one from CouchDB. The documents
+    rejected are counted and logged, not saved again: the others are
+    still loaded.
+
+    :param source: file object of a NDJSON stream, see :func:`open_source`
+    :param writers: number of ``_bulk_docs`` requests sent at the same
+                    time, the batches are read at most ``2 * writers``
+                    ahead of them
+    :param batch_size: number of documents of the first request
+    :param adaptive: if the batch size is adapted to the latency of the
+                     requests, see :class:`BatchSizer`
+    :return: :class:`LoadStats`
+    '''
+    # one batch, one request, see ``Database.save_docs``
+    sizer = BatchSizer(batch_size, adaptive=adaptive,
+                       max_size=min(MAX_BATCH, db.bulk_size))
+    stats = LoadStats()
+
+    def write(batch):
+        start = time.time()
+        failed = []
+        try:
+            db.save_docs(batch, use_uuids=False)
+        except BulkSaveError, e:
+            failed = e.errors
+        return len(batch), failed, time.time() - start
+
+    sent = db.bytes_sent
+    progress = time.time()
+    results = util.prefetch(write, batches(read_docs(source), sizer),
+                            max(writers, 1))
+    try:
+        for count, failed, elapsed in results:
+            sizer.update(count, elapsed)
+            stats.batches += 1
+            stats.docs += count - len(failed)
+            stats.failed += len(failed)
+            for doc in failed:
+                logger.debug("%s not saved", doc.get('_id'))
+            if time.time() - progress >= PROGRESS_STEP:
+                progress = time.time()
+                logger.info("%d docs loaded, %.0f docs/s, batches of %d",
+                            stats.docs, stats.docs / stats.elapsed,
+                            sizer.size)
+    finally:
+        stats.bytes = db.bytes_sent - sent
+    return stats
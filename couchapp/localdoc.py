@@ -6,16 +6,18 @@
 from __future__ import with_statement
 
 import base64
+import binascii
 import logging
 import mimetypes
 import os
 import os.path
 import re
+import threading
+import time
 import urlparse
 import webbrowser
 
-from copy import copy
-from itertools import chain
+from hashlib import md5
 
 try:
     import desktopcouch
@@ -28,8 +30,12 @@ except ImportError:
 
 
 from couchapp import util
+from couchapp.cache import BuildCache, SignatureCache
+from couchapp.client import STREAM_BUFSIZE, FileAttachment, StreamBody
 from couchapp.errors import ResourceNotFound, AppError
-from couchapp.macros import package_shows, package_views
+from couchapp.ignores import IgnoreMatcher
+from couchapp.macros import MacroContext, package_functions, view_groups
+from couchapp.scanner import Snapshot
 
 if os.name == 'nt':
     def _replace_backslash(name):
@@ -48,16 +54,184 @@ DEFAULT_IGNORE = """[
   // ".*\\\\.bak"
 ]"""
 
+# log the progress of a no-atomic push every ``PROGRESS_STEP`` attachments
+PROGRESS_STEP = 100
+
+# number of databases pushed to at the same time by default
+PARALLEL_PUSHES = 4
+
+# number of attachments read ahead of their upload by a no-atomic push by
+# default, ``1`` reading each one only while it's sent, and how many chunks
+# of each are read ahead at most
+READ_AHEAD_WORKERS = 1
+READ_AHEAD_CHUNKS = 16
+
+# fields of ``couchapp`` kept in the ``_local`` document of the metadata
+METADATA_FIELDS = ('manifest', 'objects', 'signatures')
 
 logger = logging.getLogger(__name__)
 
 
+def metadata_docid(docid):
+    '''
+    :return: the id of the ``_local`` document of the metadata of the
+             document ``docid``
+    '''
+    return '_local/couchapp/%s' % docid
+
+
+def attachment_digest(signature):
+    '''
+    :param signature: md5 hexdigest of an attachment, see ``util.sign``
+    :return: the ``digest`` of its stub in CouchDB, ``md5-<base64>``
+    '''
+    return 'md5-%s' % base64.b64encode(binascii.unhexlify(signature))
+
+
+def read_once(chunks, source):
+    '''
+    :param chunks: iterator of the content of an attachment, read ahead
+    :param source: callable returning an iterator of the same content
+    :return: a source of :class:`~couchapp.client.StreamBody` giving
+             ``chunks`` the first time, then ``source()`` if the body is
+             sent again
+    '''
+    pending = [chunks]
+
+    def read():
+        return pending.pop() if pending else source()
+    return read
+
+
+class Build(object):
+    '''
+    The parts of a document which don't depend on the database it's
+    pushed to, see :meth:`LocalDoc.build`.
+
+    :attr doc: the document, without ``_rev`` nor ``_attachments``
+    :attr attachments: list of ``(name, filepath, size)``
+    :attr signatures: the md5 hexdigests of the attachments, by name
+    :attr metadoc: the ``_local`` document of the metadata, or ``None``
+    :attr stubs: the attachment stubs encoded so far, by
+                 ``(name, stream)``
+    '''
+
+    def __init__(self, doc, attachments, signatures, metadoc=None):
+        self.doc = doc
+        self.attachments = attachments
+        self.signatures = signatures
+        self.metadoc = metadoc
+        self.stubs = {}
+
+
+class PushResult(object):
+    '''
+    Outcome of a push to one database.
+
+    :attr db: the database
+    :attr rev: the revision of the document pushed, if there's one
+    :attr docs: number of documents saved
+    :attr bytes: length of the request bodies sent
+    :attr duration: in seconds
+    :attr error: the exception raised, or ``None``
+    '''
+
+    def __init__(self, db):
+        self.db = db
+        self.rev = None
+        self.docs = 0
+        self.bytes = 0
+        self.duration = 0
+        self.error = None
+
+    def __repr__(self):
+        if self.error is not None:
+            return '%s: failed: %s' % (self.db.dbname, self.error)
+        if not self.docs:
+            return '%s: unchanged' % self.db.dbname
+        summary = '%d docs' % self.docs if self.rev is None \
+            else 'rev %s' % self.rev
+        return '%s: %s, %d bytes in %.2fs' % (self.db.dbname, summary,
+                                              self.bytes, self.duration)
+
+
+def push_targets(func, dbs, parallel=PARALLEL_PUSHES):
+    '''
+    Call ``func(db, result)`` for each of ``dbs``, ``parallel`` of them
+    at a time, in threads. ``func`` fills the :class:`PushResult`, its
+    exceptions are caught and recorded in it, so a database failing
+    doesn't stop the push to the others.
+
+    :return: list of :class:`PushResult`, in the order of ``dbs``
+    '''
+    def run(db):
+        result = PushResult(db)
+        sent = db.bytes_sent
+        start = time.time()
+        try:
+            func(db, result)
+        except Exception, e:
+            logger.debug("push to %s failed", db.dbname, exc_info=True)
+            result.error = e
+        result.duration = time.time() - start
+        result.bytes = db.bytes_sent - sent
+        return result
+
+    parallel = min(parallel, len(dbs))
+    if parallel > 1:
+        return list(util.prefetch(run, dbs, parallel))
+    return [run(db) for db in dbs]
+
+
+def report(results):
+    '''
+    Log the outcome of a push to several databases.
+
+    :param results: list of :class:`PushResult`
+    :return: ``0`` if the push succeeded everywhere, ``1`` if it failed
+             for some databases
+    :raise: the error of the first database, if it failed for all
+    '''
+    failed = [result for result in results if result.error is not None]
+    if len(results) > 1:
+        for result in results:
+            if result.error is None:
+                logger.info("%r", result)
+            else:
+                logger.error("%r", result)
+    if failed and len(failed) == len(results):
+        raise failed[0].error
+    return 1 if failed else 0
+
+
 class LocalDoc(object):
 
-    def __init__(self, path, create=False, docid=None, is_ddoc=True):
+    def __init__(self, path, create=False, docid=None, is_ddoc=True,
+                 use_cache=True, jobs=1, commonjs=False,
+                 local_metadata=False):
         self.docdir = path
         self.ignores = self._load_ignores()
+        self._ignore_matcher = None
         self.is_ddoc = is_ddoc
+        self.use_cache = use_cache
+        # number of processes expanding the macros
+        self.jobs = jobs
+        # make the libraries included by !code CommonJS modules
+        self.commonjs = commonjs
+        # keep the manifest, signatures and objects in a _local document,
+        # not replicated nor loaded by the query servers
+        self.local_metadata = local_metadata
+        self.metadoc = None
+        self.olddoc = {}
+        self.oldmeta = {}
+        # the last build, pushed to each database by :meth:`prepare`
+        self.built = None
+        # the builds of the threads pushing to several databases
+        self._lock = threading.Lock()
+        self.snapshot = None
+        self.buildcache = None
+        # functions of the last build to the files and fields they include
+        self.dependencies = {}
         self.docid = docid if docid else self.get_id()
         self._doc = {'_id': self.docid}
 
@@ -120,29 +294,59 @@ class LocalDoc(object):
             logger.info("CouchApp already initialized in %s.", self.docdir)
 
     def push(self, dbs, noatomic=False, browser=False, force=False,
-             noindex=False):
+             noindex=False, multipart=False, parallel=PARALLEL_PUSHES,
+             workers=READ_AHEAD_WORKERS):
         """
         Push a doc to a list of database ``dbs``.
 
         :param noatomic: If true, each attachments will be sent one by one.
         :param browser: If true, open browser after pushed.
+        :param multipart: If true, the doc and its attachments are sent
+            raw in one ``multipart/related`` request.
+        :param parallel: number of databases pushed to at the same time.
+        :param workers: number of attachments read ahead of their upload,
+            with ``noatomic``, see :meth:`send_attachments`.
+        :return: list of :class:`PushResult`, see :func:`report`
         """
-        for db in dbs:
+        # the index page of the doc pushed, by database
+        indexes = {}
+
+        def push_db(db, result):
             if noatomic:
-                doc = self.doc(db, with_attachments=False, force=force)
+                doc, unchanged, metadoc = self.prepare(
+                    db, with_attachments=False, force=force)
+                # the attachments are sent after the doc, an interrupted
+                # push must not leave the doc looking up to date
+                del doc['couchapp']['hash']
                 db.save_doc(doc, force_update=True)
 
                 attachments = doc.get('_attachments') or {}
-
-                for name, filepath in self.attachments():
-                    if name not in attachments:
-                        logger.debug("attach %s ", name)
-                        db.put_attachment(doc, open(filepath, "r"),
-                                          name=name)
+                self.send_attachments(db, doc,
+                                      [(name, filepath)
+                                       for name, filepath in self.attachments()
+                                       if name not in attachments],
+                                      workers=workers)
+                self.save_metadata(db, metadoc)
+                result.docs = 1
             else:
-                doc = self.doc(db, force=force)
-                db.save_doc(doc, force_update=True)
-            indexurl = self.index(db.raw_uri, doc['couchapp'].get('index'))
+                doc, unchanged, metadoc = self.prepare(db, force=force,
+                                                       stream=True)
+                if not force and unchanged:
+                    logger.info("%s unchanged in %s", self.docid, db.dbname)
+                else:
+                    db.save_doc(doc, force_update=True, multipart=multipart)
+                    self.save_metadata(db, metadoc)
+                    result.docs = 1
+            result.rev = doc.get('_rev')
+            indexes[db.raw_uri] = doc['couchapp'].get('index')
+
+        self.build()
+        results = push_targets(push_db, dbs, parallel)
+        for result in results:
+            if result.error is not None:
+                continue
+            indexurl = self.index(result.db.raw_uri,
+                                  indexes[result.db.raw_uri])
             if indexurl and not noindex:
                 if "@" in indexurl:
                     u = urlparse.urlparse(indexurl)
@@ -154,6 +358,72 @@ class LocalDoc(object):
                 logger.info("Visit your CouchApp here:\n%s", indexurl)
                 if browser:
                     self.browse_url(indexurl)
+        return results
+
+    def prepare(self, db, **kwargs):
+        '''
+        :meth:`doc` for ``db`` from the last :meth:`build`, shared by the
+        threads pushing to several databases. The document is built
+        first if it's not.
+
+        :param kwargs: see :meth:`target`
+        :return: tuple ``(doc, unchanged, metadoc)``, ``unchanged`` as
+                 :meth:`is_unchanged` and ``metadoc`` as
+                 :attr:`metadoc` for this database
+        '''
+        with self._lock:
+            built = self.built or self.build()
+        doc, olddoc, oldmeta, metadoc = self.target(built, db, **kwargs)
+        return doc, self.unchanged(doc, olddoc, oldmeta, metadoc), metadoc
+
+    def send_attachments(self, db, doc, attachments,
+                         workers=READ_AHEAD_WORKERS):
+        """
+        Upload ``attachments`` one by one to ``doc``.
+
+        Each upload needs the revision created by the previous one, so the
+        requests are sent in order. The files are streamed, a chunk at a
+        time; with ``workers > 1``, the next ``workers`` files are read by
+        threads while the current one is sent, each at most
+        ``READ_AHEAD_CHUNKS`` chunks ahead, so the reads overlap the
+        uploads.
+
+        :param attachments: list of ``(name, filepath)``
+        """
+        streams = None
+        if workers > 1:
+            streams = util.read_ahead([filepath for _, filepath
+                                       in attachments], workers,
+                                      READ_AHEAD_CHUNKS, STREAM_BUFSIZE)
+
+        total, size = len(attachments), 0
+        start = time.time()
+        try:
+            for i, (name, filepath) in enumerate(attachments, 1):
+                logger.debug("attach %s ", name)
+                data = FileAttachment(filepath)
+                source = data.chunks
+                if streams is not None:
+                    source = read_once(next(streams), data.chunks)
+                ctype = ';'.join(filter(None, mimetypes.guess_type(name)))
+                db.put_attachment(doc, StreamBody([(data.length, source)]),
+                                  name=name,
+                                  headers={'Content-Type': ctype or
+                                           'application/octet-stream',
+                                           'Content-Length':
+                                           str(data.length)})
+                size += data.length
+                if i % PROGRESS_STEP == 0 and i < total:
+                    logger.info("%d/%d attachments sent", i, total)
+        finally:
+            if streams is not None:
+                streams.close()
+
+        if total:
+            elapsed = max(time.time() - start, 1e-6)
+            logger.info("%d attachments sent (%d bytes) in %.2fs, "
+                        "%.1f KB/s", total, size, elapsed,
+                        size / elapsed / 1024)
 
     def browse(self, dbs):
         for db in dbs:
@@ -182,123 +452,327 @@ class LocalDoc(object):
                                                     url[15:])
         webbrowser.open_new_tab(url)
 
-    def attachment_stub(self, name, filepath):
-        att = {}
-        with open(filepath, "rb") as f:
-            re_sp = re.compile('\s')
-            att = {"data": re_sp.sub('', base64.b64encode(f.read())),
-                   "content_type":
-                   ';'.join(filter(None, mimetypes.guess_type(name)))}
-
-        return att
+    def attachment_stub(self, name, filepath, stream=False):
+        '''
+        :param stream: If ``True``, the data is a
+            :class:`~couchapp.client.FileAttachment`, read and encoded
+            only while the document is sent.
+        '''
+        data = FileAttachment(filepath)
+        return {"data": data if stream else data.b64encode(),
+                "content_type":
+                ';'.join(filter(None, mimetypes.guess_type(name)))}
 
-    def doc(self, db=None, with_attachments=True, force=False):
+    def doc(self, db=None, with_attachments=True, force=False, stream=False):
         """
         Function to retrieve document object from document directory.
 
         :param with_attachments: If ``True``,
             attachments will be included and encoded
+        :param stream: If ``True``, attachments are streamed from disk
+            when the document is saved, see ``attachment_stub``.
         """
+        built = self.build()
+        self._doc, self.olddoc, self.oldmeta, self.metadoc = \
+            self.target(built, db, with_attachments, force, stream)
+        return self._doc
+
+    def build(self):
+        '''
+        Build the fields, the functions with their macros expanded and
+        the signatures of the attachments: the parts of the document
+        which are the same for all the databases it's pushed to.
+
+        :return: :class:`Build`, kept in :attr:`built`
+        '''
         manifest = []
         objects = {}
         signatures = {}
-        attachments = {}
+        attachments = []
 
-        self._doc = {'_id': self.docid}
+        doc = {'_id': self.docid}
+        snapshot = self.scan()
+        self.buildcache = BuildCache(self.docdir, enabled=self.use_cache)
+        macros = MacroContext(commonjs=self.commonjs)
 
         # get designdoc
-        self._doc.update(self.dir_to_fields(self.docdir, manifest=manifest))
+        doc.update(self.dir_to_fields(self.docdir, manifest=manifest))
 
-        if not 'couchapp' in self._doc:
-            self._doc['couchapp'] = {}
+        if not 'couchapp' in doc:
+            doc['couchapp'] = {}
 
-        self.olddoc = {}
+        sigcache = SignatureCache(self.docdir, enabled=self.use_cache)
+        for name, entry in snapshot.attachments():
+            st = entry.stat()
+            signatures[name] = sigcache.sign(name, entry.path, st)
+            attachments.append((name, entry.path, st.st_size))
+        sigcache.save()
+
+        doc['couchapp'].update({
+            'manifest': manifest,
+            'objects': objects,
+            'signatures': signatures
+        })
+
+        if self.docid.startswith('_design/'):  # process macros
+            self.expand_functions(doc, manifest, objects, macros)
+
+        self.dependencies = macros.dependencies(self.docdir)
+        self.buildcache.save()
+
+        metadoc = None
+        if self.local_metadata:
+            doc['couchapp']['metadata'] = metadata_docid(self.docid)
+        # the hash covers the metadata, wherever it's stored
+        doc['couchapp']['hash'] = self.doc_hash(doc)
+        if self.local_metadata:
+            metadoc = self.split_metadata(doc)
+        self.built = Build(doc, attachments, signatures, metadoc)
+        return self.built
+
+    def expand_functions(self, doc, manifest, objects, macros):
+        '''
+        Expand the macros of the functions of the design document ``doc``
+        in place, the empty and malformed views being removed from ``doc``
+        and ``manifest``.
+
+        :param objects: ``dict`` filled with the sources of the functions
+                        changed, see
+                        :func:`~couchapp.macros.package_functions`
+        :param macros: the :class:`~couchapp.macros.MacroContext` of the
+                       build
+        '''
+        groups = []
+        for funs in ['shows', 'lists', 'updates', 'filters', 'spatial']:
+            if funs in doc:
+                groups.append((funs, doc[funs]))
+
+        tmp_dict = None
+        if 'validate_doc_update' in doc:
+            tmp_dict = {'validate_doc_update':
+                        doc["validate_doc_update"]}
+            groups.append(('', tmp_dict))
+
+        if 'views' in doc:
+            # clean views
+            # we remove empty views and malformed from the list
+            # of pushed views. We also clean manifest
+            views = {}
+            dmanifest = {}
+            for i, fname in enumerate(manifest):
+                if fname.startswith("views/") and fname != "views/":
+                    name, ext = os.path.splitext(fname)
+                    if name.endswith('/'):
+                        name = name[:-1]
+                    dmanifest[name] = i
+
+            for vname, value in doc['views'].iteritems():
+                if value and isinstance(value, dict):
+                    views[vname] = value
+                else:
+                    del manifest[dmanifest["views/%s" % vname]]
+            doc['views'] = views
+            groups.extend(view_groups(doc["views"]))
+
+        if "fulltext" in doc:
+            groups.extend(view_groups(doc["fulltext"], 'fulltext'))
+
+        package_functions(doc, groups, self.docdir, objects, ctx=macros,
+                          jobs=self.jobs)
+        if tmp_dict is not None:
+            doc.update(tmp_dict)
+
+    def dependency_graph(self):
+        '''
+        The dependency graph of the functions, as :attr:`dependencies`
+        after a build, without signing the attachments nor writing the
+        caches.
+        '''
+        manifest = []
+        doc = {'_id': self.docid}
+        self.scan()
+        # read only, it's not saved
+        self.buildcache = BuildCache(self.docdir, enabled=self.use_cache)
+        macros = MacroContext(commonjs=self.commonjs)
+        doc.update(self.dir_to_fields(self.docdir, manifest=manifest))
+        if self.docid.startswith('_design/'):
+            self.expand_functions(doc, manifest, {}, macros)
+        self.dependencies = macros.dependencies(self.docdir)
+        return self.dependencies
+
+    def target(self, built, db=None, with_attachments=True, force=False,
+               stream=False):
+        '''
+        The document of ``built`` for ``db``, ``built`` is left as is.
+
+        The stubs of the attachments of the remote doc are kept when
+        they're up to date, the others are replaced or, without
+        ``with_attachments``, left out to be sent one by one. The stubs
+        are encoded once for all the databases.
+
+        :param built: :class:`Build`
+        :return: tuple ``(doc, olddoc, oldmeta, metadoc)``, the document
+                 and the ``_local`` document of its metadata (or
+                 ``None``) to save, and their versions in ``db``
+        '''
+        doc = dict(built.doc)
+        doc['couchapp'] = dict(doc['couchapp'])
+        metadoc = dict(built.metadoc) if built.metadoc is not None else None
+        olddoc = {}
+        oldmeta = {}
+        attachments = {}
         if db is not None:
             try:
-                self.olddoc = db.open_doc(self._doc['_id'])
-                attachments = self.olddoc.get('_attachments') or {}
-                self._doc.update({'_rev': self.olddoc['_rev']})
+                olddoc = db.open_doc(doc['_id'])
+                attachments = dict(olddoc.get('_attachments') or {})
+                doc['_rev'] = olddoc['_rev']
             except ResourceNotFound:
-                self.olddoc = {}
+                olddoc = {}
+            oldmeta = self.open_metadata(db, olddoc)
+            if metadoc is not None and '_rev' in oldmeta:
+                metadoc['_rev'] = oldmeta['_rev']
+
+        old_signatures = {}
+        if 'couchapp' in olddoc:
+            old_signatures = olddoc['couchapp'].get('signatures')
+            if old_signatures is None:
+                old_signatures = oldmeta.get('signatures', {})
+
+        for name, filepath, size in built.attachments:
+            if not force and self.is_uploaded(attachments.get(name),
+                                              built.signatures[name], size,
+                                              old_signatures.get(name)):
+                continue
+            attachments.pop(name, None)
+            if with_attachments:
+                logger.debug("attach %s ", name)
+                stub = built.stubs.get((name, stream))
+                if stub is None:
+                    stub = self.attachment_stub(name, filepath, stream)
+                    built.stubs[(name, stream)] = stub
+                attachments[name] = dict(stub)
 
-        if 'couchapp' in self.olddoc:
-            old_signatures = self.olddoc['couchapp'].get('signatures', {})
-        else:
-            old_signatures = {}
+        for name in list(attachments):
+            if name not in built.signatures:
+                logger.debug("detach %s ", name)
+                del attachments[name]
 
-        for name, filepath in self.attachments():
-            signatures[name] = util.sign(filepath)
-            if with_attachments and not old_signatures:
-                logger.debug("attach %s ", name)
-                attachments[name] = self.attachment_stub(name, filepath)
-
-        if old_signatures:
-            for name, signature in old_signatures.items():
-                cursign = signatures.get(name)
-                if not cursign:
-                    logger.debug("detach %s ", name)
-                    del attachments[name]
-                elif cursign != signature:
-                    logger.debug("detach %s ", name)
-                    del attachments[name]
-                else:
-                    continue
+        doc['_attachments'] = attachments
+        return doc, olddoc, oldmeta, metadoc
 
-            if with_attachments:
-                for name, filepath in self.attachments():
-                    if old_signatures.get(name) != \
-                            signatures.get(name) or force:
-                        logger.debug("attach %s ", name)
-                        attachments[name] = self.attachment_stub(name,
-                                                                 filepath)
+    @staticmethod
+    def is_uploaded(stub, signature, size, old_signature=None):
+        '''
+        :param stub: the stub of the attachment in the remote doc, if any
+        :param signature: md5 hexdigest of the local file
+        :param size: size of the local file
+        :param old_signature: the signature of the attachment recorded
+                              by the last push, if any
+        :return: ``True`` if the stub is the content of the local file.
+                 The ``digest`` and ``length`` of the stub are compared
+                 when CouchDB gives a md5 digest, so it doesn't depend on
+                 the signatures of the last push, which may be stale or
+                 missing if the doc was changed by another tool. The
+                 digest of an attachment CouchDB stores compressed is
+                 the one of the compressed data, so the signature is
+                 compared along with the ``length``, which is the one
+                 of the original data.
+        '''
+        if not stub or not isinstance(signature, basestring):
+            return False
+        digest = stub.get('digest') or ''
+        if 'encoding' in stub:
+            return old_signature == signature and \
+                stub.get('length', size) == size
+        if digest.startswith('md5-'):
+            return digest == attachment_digest(signature) and \
+                stub.get('length') == size
+        return old_signature == signature
+
+    def open_metadata(self, db, olddoc=None):
+        '''
+        :param olddoc: the document in ``db``, :attr:`olddoc` by default
+        :return: the ``_local`` document of the metadata in ``db``, the
+                 one the document in ``db`` refers to, or ``{}``
+        '''
+        olddoc = self.olddoc if olddoc is None else olddoc
+        meta = olddoc.get('couchapp')
+        docid = meta.get('metadata') if isinstance(meta, dict) else None
+        if docid is None:
+            if not self.local_metadata:
+                return {}
+            docid = metadata_docid(self.docid)
+        try:
+            return db.open_doc(docid)
+        except ResourceNotFound:
+            return {}
 
-        self._doc['_attachments'] = attachments
+    def split_metadata(self, doc):
+        '''
+        Move the fields of ``doc['couchapp']`` in :data:`METADATA_FIELDS`
+        to a new ``_local`` document, along with the hash of ``doc``.
 
-        self._doc['couchapp'].update({
-            'manifest': manifest,
-            'objects': objects,
-            'signatures': signatures
-        })
+        :return: the ``_local`` document
+        '''
+        meta = doc['couchapp']
+        metadoc = {'_id': meta['metadata'], 'hash': meta['hash']}
+        for field in METADATA_FIELDS:
+            metadoc[field] = meta.pop(field)
+        return metadoc
 
-        if self.docid.startswith('_design/'):  # process macros
-            for funs in ['shows', 'lists', 'updates', 'filters', 'spatial']:
-                if funs in self._doc:
-                    package_shows(self._doc, self._doc[funs], self.docdir,
-                                  objects)
-
-            if 'validate_doc_update' in self._doc:
-                tmp_dict = {'validate_doc_update':
-                            self._doc["validate_doc_update"]}
-                package_shows(self._doc, tmp_dict, self.docdir, objects)
-                self._doc.update(tmp_dict)
-
-            if 'views' in self._doc:
-                # clean views
-                # we remove empty views and malformed from the list
-                # of pushed views. We also clean manifest
-                views = {}
-                dmanifest = {}
-                for i, fname in enumerate(manifest):
-                    if fname.startswith("views/") and fname != "views/":
-                        name, ext = os.path.splitext(fname)
-                        if name.endswith('/'):
-                            name = name[:-1]
-                        dmanifest[name] = i
-
-                for vname, value in self._doc['views'].iteritems():
-                    if value and isinstance(value, dict):
-                        views[vname] = value
-                    else:
-                        del manifest[dmanifest["views/%s" % vname]]
-                self._doc['views'] = views
-                package_views(self._doc, self._doc["views"], self.docdir,
-                              objects)
-
-            if "fulltext" in self._doc:
-                package_views(self._doc, self._doc["fulltext"], self.docdir,
-                              objects)
+    def save_metadata(self, db, metadoc=None):
+        '''
+        Save the ``_local`` document of the metadata built by the last
+        call of :meth:`doc`, if any. It's saved after the document, an
+        interrupted push leaves its hash behind and the next one sends
+        the document again.
 
-        return self._doc
+        :param metadoc: the ``_local`` document to save instead, see
+                        :meth:`prepare`
+        '''
+        metadoc = metadoc if metadoc is not None else self.metadoc
+        if metadoc is not None:
+            db.save_doc(metadoc, force_update=True)
+
+    @staticmethod
+    def doc_hash(doc):
+        '''
+        Canonical hash of a built document: the md5 of its json
+        serialization with sorted keys, without ``_rev``, the hash
+        itself and ``_attachments``, whose signatures are in
+        ``couchapp``.
+        '''
+        doc = dict(doc)
+        doc.pop('_rev', None)
+        doc.pop('_attachments', None)
+        doc['couchapp'] = dict(doc.get('couchapp') or {})
+        doc['couchapp'].pop('hash', None)
+        return md5(util.json.dumps(doc, sort_keys=True)).hexdigest()
+
+    def is_unchanged(self, doc):
+        '''
+        :param doc: the document built by ``self.doc(db)``
+        :return: ``True`` if the document in ``db`` has the same hash
+        '''
+        return self.unchanged(doc, self.olddoc, self.oldmeta, self.metadoc)
+
+    @staticmethod
+    def unchanged(doc, olddoc, oldmeta, metadoc):
+        '''
+        :return: ``True`` if ``olddoc`` and ``oldmeta``, the documents in
+                 the database, have the hashes of ``doc`` and ``metadoc``
+                 and ``olddoc`` has the attachments of ``doc``: the hash
+                 doesn't cover the attachments changed or deleted in the
+                 database, found by :meth:`target`
+        '''
+        meta = olddoc.get('couchapp')
+        if not isinstance(meta, dict) or \
+                meta.get('hash') != doc['couchapp']['hash']:
+            return False
+        if (doc.get('_attachments') or {}) != \
+                (olddoc.get('_attachments') or {}):
+            return False
+        return metadoc is None or oldmeta.get('hash') == metadoc['hash']
 
     def check_ignore(self, item):
         '''
@@ -310,44 +784,26 @@ class LocalDoc(object):
             * ``foo/bar/baz.json`` vs ``bar`` -> False
             * ``bar/baz.json`` vs ``bar`` -> True, then return
             * ``baz.json`` vs ``bar`` -> not checked
-        '''
-        item = os.path.normpath(item)
 
-        for pattern in self.ignores:
-            # ('/' + item) is for abs path, some duplicated generated but work
-            paths = chain(self._combine_path(item),
-                          self._combine_path('/' +item))
-            matches = (re.match(pattern + '$', i) for i in paths)
-            if any(matches):
-                logger.debug("ignoring %s", item)
-                return True
-        return False
-
-    @classmethod
-    def _combine_path(cls, p):
+        See :mod:`couchapp.ignores` for the details.
         '''
-        >>> tuple(LocalDoc._combine_path('foo/bar/qaz'))
-        ('foo', 'foo/bar', 'foo/bar/qaz', 'bar', 'bar/qaz', 'qaz')
+        matcher = self._ignore_matcher
+        if matcher is None or matcher.patterns != self.ignores:
+            matcher = self._ignore_matcher = IgnoreMatcher(self.ignores)
 
-        >>> tuple(LocalDoc._combine_path('/foo/bar/qaz'))
-        ('/foo', '/foo/bar', '/foo/bar/qaz', 'bar', 'bar/qaz', 'qaz')
-        '''
-        ls = util.split_path(p)
-        while ls:
-            for i in cls._combine_dir(copy(ls)):
-                yield i
-            ls.pop(0)
+        if matcher.match(item):
+            logger.debug("ignoring %s", item)
+            return True
+        return False
 
-    @staticmethod
-    def _combine_dir(ls):
+    def scan(self):
         '''
-        >>> tuple(LocalDoc._combine_dir(['foo', 'bar', 'qaz']))
-        ('foo', 'foo/bar', 'foo/bar/qaz')
+        Take a new :class:`~couchapp.scanner.Snapshot` of the document
+        directory. ``dir_to_fields`` and ``attachments`` work on the
+        latest snapshot.
         '''
-        ret = tuple()
-        while ls:
-            ret += (ls.pop(0),)
-            yield '/'.join(ret)
+        self.snapshot = Snapshot(self.docdir, ignore=self.check_ignore)
+        return self.snapshot
 
     def dir_to_fields(self, current_dir=None, depth=0, manifest=None):
         """
@@ -358,11 +814,15 @@ class LocalDoc(object):
         fields = {}  # return value
         manifest = manifest if manifest is not None else []
         current_dir = current_dir if current_dir else self.docdir
+        snapshot = self.snapshot or self.scan()
+
+        rel_dir = _replace_backslash(util.relpath(current_dir, self.docdir))
+        rel_dir = '' if rel_dir == '.' else rel_dir + '/'
 
-        for name in os.listdir(current_dir):
-            current_path = os.path.join(current_dir, name)
-            rel_path = _replace_backslash(util.relpath(current_path,
-                                                       self.docdir))
+        for entry in snapshot.listdir(current_dir):
+            name = entry.name
+            current_path = entry.path
+            rel_path = rel_dir + name
             if name.startswith('.'):
                 continue
             elif self.check_ignore(rel_path):
@@ -384,7 +844,7 @@ class LocalDoc(object):
 
                 fields, content = self._meta_to_fields(fields, content)
 
-            elif os.path.isdir(current_path):
+            elif entry.is_dir():
                 manifest.append('%s/' % rel_path)
                 fields[name] = self.dir_to_fields(
                     current_path, depth=depth + 1, manifest=manifest)
@@ -399,10 +859,27 @@ class LocalDoc(object):
                                    {'name': _name, 'fqn': rel_path})
                 else:
                     manifest.append(rel_path)
-                    fields[_name] = self._encode_content(name, current_path)
+                    fields[_name] = self._field_content(entry, rel_path)
 
         return fields
 
+    def _field_content(self, entry, rel_path):
+        '''
+        The content of a field file, from the build cache if the file is
+        unchanged since the last build.
+
+        This is a private subroutine for ``dir_to_fields``
+        '''
+        if self.buildcache is None:
+            return self._encode_content(entry.name, entry.path)
+
+        def load():
+            content = self._encode_content(entry.name, entry.path)
+            # an invalid json file is not cached, to get the error again
+            return content, content != '' or not entry.name.endswith('.json')
+
+        return self.buildcache.content(rel_path, entry.stat(), load)
+
     @staticmethod
     def _meta_to_fields(fields, content):
         '''
@@ -418,7 +895,7 @@ class LocalDoc(object):
         content = content.copy()
         fields = fields.copy()
 
-        for f in ('signatures', 'manifest', 'objects', 'length'):
+        for f in ('signatures', 'manifest', 'objects', 'length', 'hash'):
             if f in content:
                 del content[f]
 
@@ -456,35 +933,6 @@ class LocalDoc(object):
 
         return content
 
-    def _process_attachments(self, path, vendor=None):
-        """
-        Processing directory to yield attachments.
-        """
-        if not os.path.isdir(path):
-            raise StopIteration()
-
-        for root, dirs, files in os.walk(path):
-            for dir_ in dirs:
-                _relpath = util.relpath(os.path.join(root, dir_),
-                                        self.docdir)
-                if self.check_ignore(_relpath):
-                    dirs.remove(dir_)
-
-            if not files:
-                continue
-
-            for filename in files:
-                filepath = os.path.join(root, filename)
-                _relpath = util.relpath(filepath, self.docdir)
-                if self.check_ignore(_relpath):
-                    continue
-
-                name = util.relpath(filepath, path)
-                if vendor is not None:
-                    name = os.path.join('vendor', vendor, name)
-                name = _replace_backslash(name)
-                yield (name, filepath)
-
     def attachments(self):
         """
         This function yield a tuple (name, filepath) corresponding
@@ -495,24 +943,9 @@ class LocalDoc(object):
         attachments are processed later to allow us to send attachments inline
         or one by one.
         """
-        # process main attachments
-        dir_ = os.path.join(self.docdir, "_attachments")
-        for attachment in self._process_attachments(dir_):
-            yield attachment
-
-        vendordir = os.path.join(self.docdir, 'vendor')
-        if not os.path.isdir(vendordir):
-            logger.debug("%s don't exist", vendordir)
-            return
-
-        for name in os.listdir(vendordir):
-            current_path = os.path.join(vendordir, name)
-            if os.path.isdir(current_path):
-                attachdir = os.path.join(current_path, '_attachments')
-                if os.path.isdir(attachdir):
-                    for attachment in self._process_attachments(attachdir,
-                                                                vendor=name):
-                        yield attachment
+        snapshot = self.snapshot or self.scan()
+        for name, entry in snapshot.attachments():
+            yield (name, entry.path)
 
     def index(self, dburl, index):
         if index is not None:
@@ -526,6 +959,8 @@ class LocalDoc(object):
         return self.__str__()
 
 
-def document(path, create=False, docid=None, is_ddoc=True):
+def document(path, create=False, docid=None, is_ddoc=True, use_cache=True,
+             jobs=1, commonjs=False, local_metadata=False):
     return LocalDoc(os.path.realpath(path), create=create, docid=docid,
-                    is_ddoc=is_ddoc)
+                    is_ddoc=is_ddoc, use_cache=use_cache, jobs=jobs,
+                    commonjs=commonjs, local_metadata=local_metadata)
@@ -6,6 +6,7 @@
 import glob
 from hashlib import md5
 import logging
+import multiprocessing
 import os
 import re
 
@@ -14,125 +15,667 @@ from couchapp import util
 
 logger = logging.getLogger(__name__)
 
+# ``!code`` and ``!json`` macros: the macro, the comment, the macro name
+# and its argument
+RE_MACRO = re.compile('((\/\/|#)\ ?!(code|json) (.*))')
 
-def package_shows(doc, funcs, app_dir, objs):
-    apply_lib(doc, funcs, app_dir, objs)
+# below this number of functions to expand, a pool of processes costs
+# more than it saves
+PARALLEL_MIN = 64
 
+# top level declarations of a library, exported by its CommonJS module
+RE_DECLARATION = re.compile('^(?:function\s+([A-Za-z_$][\w$]*)|'
+                            'var\s+([A-Za-z_$][\w$]*))', re.M)
 
-def package_views(doc, views, app_dir, objs):
-    for view, funcs in views.iteritems():
-        if hasattr(funcs, "items"):
-            apply_lib(doc, funcs, app_dir, objs)
+# fields of a design document whose files can't be CommonJS modules
+FUNCTION_FIELDS = ('couchapp', 'filters', 'fulltext', 'lists', 'shows',
+                   'spatial', 'updates', 'validate_doc_update', 'views')
 
 
-def apply_lib(doc, funcs, app_dir, objs):
-    for k, v in funcs.items():
-        if not isinstance(v, basestring):
-            continue
-        else:
-            logger.debug("process function: %s" % k)
-            old_v = v
-            try:
-                funcs[k] = run_json_macros(doc,
-                                           run_code_macros(v, app_dir),
-                                           app_dir)
-            except ValueError, e:
-                raise MacroError("Error running !code or !json on " +
-                                 "function \"%s\": %s" % (k, e))
-            if old_v != funcs[k]:
-                objs[md5(util.to_bytestring(funcs[k])).hexdigest()] = old_v
-
-
-def run_code_macros(f_string, app_dir):
-    def rreq(mo):
-        # just read the file and return it
-        path = os.path.join(app_dir, mo.group(2).strip())
-        library = ''
-        filenum = 0
-        for filename in glob.iglob(path):
-            logger.debug("process code macro: %s" % filename)
+class MacroDeps(object):
+    '''
+    What the expansion of a function depends on.
+
+    :attr globs: ``dict`` of the ``!code`` and ``!json`` patterns to the
+                 list of files they matched
+    :attr fields: ``set`` of the dotted paths of the document fields
+                  included by ``!json``
+    :attr modules: ``dict`` of the ids of the CommonJS modules required
+                   to the files they're made of
+    '''
+
+    def __init__(self):
+        self.globs = {}
+        self.fields = set()
+        self.modules = {}
+
+    def files(self):
+        '''
+        :return: sorted list of the files included, directly or not
+        '''
+        return sorted(set(path for paths in self.globs.itervalues()
+                          for path in paths))
+
+
+class MacroContext(object):
+    '''
+    Memoized file system accesses of the macros.
+
+    A library included by many functions is globbed, read, tokenized and
+    has its own ``!code`` macros expanded once. Files changed during the
+    build are not seen, so it's meant to be used for one build only.
+
+    :attr graph: ``dict`` of the functions expanded, by path in the
+                 document (e.g. ``views/by_date/map``), to their
+                 :class:`MacroDeps`
+    :attr commonjs: if ``True``, the libraries included by ``!code`` are
+                    made CommonJS modules of the document where possible,
+                    see :func:`require_scope`
+    '''
+
+    def __init__(self, commonjs=False):
+        self.commonjs = commonjs
+        self.graph = {}
+        self._globs = {}
+        self._files = {}
+        self._json = {}
+        self._codes = {}
+        self._includes = {}
+        self._modules = {}
+
+    def glob(self, pattern):
+        '''
+        Memoized ``glob.glob``
+        '''
+        try:
+            return self._globs[pattern]
+        except KeyError:
+            paths = self._globs[pattern] = glob.glob(pattern)
+            return paths
+
+    def read(self, filename):
+        '''
+        Memoized ``util.read``
+        '''
+        try:
+            return self._files[filename]
+        except KeyError:
+            content = self._files[filename] = util.read(filename)
+            return content
+
+    def read_json(self, filename):
+        '''
+        Memoized ``util.read_json``, the result must not be modified
+        '''
+        try:
+            return self._json[filename]
+        except KeyError:
+            content = self._json[filename] = util.read_json(filename)
+            return content
+
+    def code(self, filename, app_dir, chain=(), scope=None):
+        '''
+        The tokens of a library included by ``!code``, with its own
+        ``!code`` macros expanded.
+
+        :param chain: the files including this one, the first item may
+                      be the name of the function
+        :param scope: the modules the library can require, see
+                      :func:`require_scope`
+        :return: tuple ``(tokens, globs, modules)``, ``globs`` and
+                 ``modules`` as in :class:`MacroDeps` for the nested
+                 macros
+        :raise MacroError: if the library includes itself
+        '''
+        key = filename, scope
+        try:
+            return self._codes[key]
+        except KeyError:
+            pass
+
+        chain = self._chain(chain, filename, app_dir)
+        deps = MacroDeps()
+        tokens = expand_code(tokenize(self.read(filename)), app_dir, deps,
+                             self, chain, scope)
+        result = self._codes[key] = tokens, deps.globs, deps.modules
+        return result
+
+    def module(self, filename, app_dir, chain=()):
+        '''
+        The CommonJS module made of a library included by ``!code``: the
+        library, requiring the modules it includes in turn, and exporting
+        its top level functions and variables.
+
+        :return: tuple ``(text, exports, globs, modules)``, or ``None`` if
+                 the library can't be a module because it has ``!json``
+                 macros
+        '''
+        try:
+            return self._modules[filename]
+        except KeyError:
+            pass
+
+        chain = self._chain(chain, filename, app_dir)
+        scope = 'views' if module_id(filename, app_dir).startswith('views/') \
+            else 'ddoc'
+        deps = MacroDeps()
+        tokens = expand_code(tokenize(self.read(filename)), app_dir, deps,
+                             self, chain, scope)
+
+        result = None
+        if not any(token[0] == 'json' for token in tokens
+                   if not isinstance(token, basestring)):
+            text = render(tokens)
+            exports = []
+            for names in RE_DECLARATION.findall(text):
+                name = names[0] or names[1]
+                if name not in exports:
+                    exports.append(name)
+            text += ''.join('\nif (typeof %s !== "undefined") '
+                            '{ exports.%s = %s; }' % (name, name, name)
+                            for name in exports)
+            result = text, exports, deps.globs, deps.modules
+        self._modules[filename] = result
+        return result
+
+    def include(self, argument, app_dir, chain=(), scope=None):
+        '''
+        The tokens of the libraries included by a ``!code`` macro: their
+        content, or the ``require()`` of their modules
+
+        :param argument: the argument of the macro
+        :param scope: see :func:`require_scope`
+        :return: tuple ``(tokens, globs, modules)``, ``globs`` and
+                 ``modules`` as in :class:`MacroDeps` for the macro and
+                 the nested ones
+        '''
+        key = app_dir, argument, scope
+        try:
+            return self._includes[key]
+        except KeyError:
+            pass
+
+        path = os.path.join(app_dir, argument.strip())
+        filenames = self.glob(path)
+        if not filenames:
+            raise MacroError("Processing code: No file matching '%s'" %
+                             argument)
+
+        tokens = []
+        globs = {path: filenames}
+        modules = {}
+        for filename in filenames:
+            logger.debug("process code macro: %s", filename)
             try:
-                cnt = util.read(filename)
-                if cnt.find("!code") >= 0:
-                    cnt = run_code_macros(cnt, app_dir)
-                library += cnt
+                module = None
+                name = module_id(filename, app_dir)
+                if can_require(name, scope):
+                    module = self.module(filename, app_dir, chain)
+                if module is None:
+                    included, nested, nested_modules = self.code(
+                        filename, app_dir, chain, scope)
+                else:
+                    included = [require(name, module[1])]
+                    nested, nested_modules = module[2:]
+                    modules[name] = filename
             except IOError, e:
                 raise MacroError(str(e))
-            filenum += 1
+            tokens.extend(included)
+            globs.update(nested)
+            modules.update(nested_modules)
+        result = self._includes[key] = tokens, globs, modules
+        return result
 
-        if not filenum:
-            raise MacroError("Processing code: No file matching '%s'" %
-                             mo.group(2))
-        return library
+    def add_modules(self, doc, modules, app_dir, objs):
+        '''
+        Add CommonJS modules to the document, in place of the content
+        of their files.
 
-    re_code = re.compile('(\/\/|#)\ ?!code (.*)')
-    return re_code.sub(rreq, f_string)
+        :param modules: ``dict`` of the modules ids to their file, as
+                        :attr:`MacroDeps.modules`
+        :param objs: the objects of the document, the source of the
+                     modules is added to it
+        '''
+        for name in sorted(modules):
+            module = self.module(modules[name], app_dir)
+            if module is None:
+                continue
+            fields = name.split('/')
+            parent = doc
+            for field in fields[:-1]:
+                parent = parent.setdefault(field, {})
+                if not isinstance(parent, dict):
+                    raise MacroError("Can't add the module %s to the "
+                                     "document" % name)
+            parent[fields[-1]] = module[0]
+            objs[md5(util.to_bytestring(module[0])).hexdigest()] = \
+                self.read(modules[name])
 
+    def _chain(self, chain, filename, app_dir):
+        '''
+        :return: ``chain`` followed by ``filename``
+        :raise MacroError: if ``filename`` is already in ``chain``
+        '''
+        chain = chain + (filename,)
+        if filename in chain[:-1]:
+            names = [os.path.relpath(item, app_dir).replace(os.sep, '/')
+                     if os.path.isabs(item) else item for item in chain]
+            raise MacroError("Processing code: include cycle: %s" %
+                             ' -> '.join(names))
+        return chain
 
-def run_json_macros(doc, f_string, app_dir):
-    included = {}
-    varstrings = []
-
-    def rjson(mo):
-        if mo.group(2).startswith('_attachments'):
-            # someone  want to include from attachments
-            path = os.path.join(app_dir, mo.group(2).strip())
-            filenum = 0
-            for filename in glob.iglob(path):
-                logger.debug("process json macro: %s" % filename)
-                library = ''
-                try:
-                    if filename.endswith('.json'):
-                        library = util.read_json(filename)
-                    else:
-                        library = util.read(filename)
-                except IOError, e:
-                    raise MacroError(str(e))
-                filenum += 1
-                current_file = filename.split(app_dir)[1]
-                fields = current_file.split('/')
-                count = len(fields)
-                include_to = included
-                for i, field in enumerate(fields):
-                    if i+1 < count:
-                        include_to[field] = {}
-                        include_to = include_to[field]
-                    else:
-                        include_to[field] = library
-            if not filenum:
-                raise MacroError("Processing code: No file matching '%s'" %
-                                 mo.group(2))
+    def dependencies(self, app_dir):
+        '''
+        :return: ``dict`` of the functions to the files, relative to
+                 ``app_dir``, and the document fields they include, as
+                 ``{'files': [...], 'fields': [...]}``
+        '''
+        files = dict((name, deps.files())
+                     for name, deps in self.graph.iteritems())
+        # the same libraries are included by many functions
+        paths = set(path for names in files.itervalues() for path in names)
+        relpaths = dict((path, os.path.relpath(path, app_dir)
+                         .replace(os.sep, '/')) for path in paths)
+
+        graph = {}
+        for name, deps in self.graph.iteritems():
+            graph[name] = {
+                'files': [relpaths[path] for path in files[name]],
+                'fields': sorted(deps.fields)
+            }
+        return graph
+
+
+def package_shows(doc, funcs, app_dir, objs, ctx=None, path=''):
+    apply_lib(doc, funcs, app_dir, objs, ctx=ctx, path=path)
+
+
+def package_views(doc, views, app_dir, objs, ctx=None, path='views'):
+    package_functions(doc, view_groups(views, path), app_dir, objs,
+                      ctx=ctx)
+
+
+def view_groups(views, path='views'):
+    '''
+    :return: list of ``(path, funcs)`` of the views of ``views``, for
+             :func:`package_functions`
+    '''
+    return [('%s/%s' % (path, view), funcs)
+            for view, funcs in views.iteritems() if hasattr(funcs, "items")]
+
+
+def apply_lib(doc, funcs, app_dir, objs, ctx=None, path=''):
+    '''
+    :param path: path of ``funcs`` in the document, see
+                 :func:`package_functions`
+    '''
+    package_functions(doc, [(path, funcs)], app_dir, objs, ctx=ctx)
+
+
+def package_functions(doc, groups, app_dir, objs, ctx=None, jobs=1):
+    '''
+    Expand the macros of the functions of a document, in place.
+
+    :param groups: list of ``(path, funcs)``, ``funcs`` being the ``dict``
+                   of functions at ``path`` in the document, e.g.
+                   ``('views/by_date', {'map': ...})``. The functions are
+                   recorded in the dependency graph of ``ctx`` under it.
+    :param objs: ``dict`` filled with the sources of the functions
+                 changed, by md5 of their expansion
+    :param ctx: the :class:`MacroContext` of the build, a new one is
+                used if it's not given
+    :param jobs: number of processes expanding the functions, ``0`` for
+                 one per CPU. The result is the same whatever the number
+                 of processes, see :func:`_package_parallel`.
+    '''
+    if ctx is None:
+        ctx = MacroContext()
+    if not jobs:
+        jobs = multiprocessing.cpu_count()
+
+    modules = {}
+    if jobs > 1:
+        _package_parallel(doc, groups, app_dir, objs, ctx, jobs, modules)
+    else:
+        for path, funcs in groups:
+            for k, v in funcs.items():
+                if not isinstance(v, basestring):
+                    continue
+                logger.debug("process function: %s", k)
+                name = '%s/%s' % (path, k) if path else k
+                expanded, deps = _expand_task((k, v, name), doc, app_dir,
+                                              ctx)
+                _update_function(funcs, k, expanded, deps, name, objs, ctx)
+                modules.update(deps.modules)
+
+    if modules:
+        ctx.add_modules(doc, modules, app_dir, objs)
+
+
+def _package_parallel(doc, groups, app_dir, objs, ctx, jobs, modules):
+    '''
+    :func:`package_functions` with a pool of ``jobs`` processes.
+
+    The functions are expanded by the pool, then all are updated in the
+    order of ``groups``, so the result doesn't depend on the pool. The
+    pool sees the document before any expansion, so the functions with
+    ``!json`` macros, which may include the functions expanded before
+    them, are expanded in order by this process, as
+    :func:`package_functions` does with one process.
+    They're found by tokenizing the functions, those which only get
+    ``!json`` macros from their libraries are expanded again.
+
+    :param modules: ``dict`` filled with the modules required
+    '''
+    functions = []
+    for path, funcs in groups:
+        for k, v in funcs.items():
+            if isinstance(v, basestring):
+                name = '%s/%s' % (path, k) if path else k
+                functions.append((funcs, k, v, name))
+
+    # expanded in order, after the pool
+    ordered = set(i for i, (_, _, v, _) in enumerate(functions)
+                  if _has_json(v))
+    results = [None] * len(functions)
+    todo = [i for i in range(len(functions)) if i not in ordered]
+    tasks = [functions[i][1:] for i in todo]
+    if len(tasks) < max(PARALLEL_MIN, 2):
+        # not worth starting the processes
+        expanded = [_expand_task(task, doc, app_dir, ctx) for task in tasks]
+    else:
+        logger.debug("expand %d functions with %d processes", len(tasks),
+                     jobs)
+        # the attachments are not used by the macros, and may not pickle
+        snapshot = dict((key, value) for key, value in doc.iteritems()
+                        if key != '_attachments')
+        pool = multiprocessing.Pool(jobs, _init_worker,
+                                    (snapshot, app_dir, ctx.commonjs))
+        try:
+            expanded = pool.map(_run_worker, tasks,
+                                len(tasks) // (jobs * 4) + 1)
+        finally:
+            pool.terminate()
+            pool.join()
+
+    for i, result in zip(todo, expanded):
+        results[i] = result
+
+    for i, (funcs, k, v, name) in enumerate(functions):
+        if i in ordered or results[i][1].fields:
+            result, deps = _expand_task((k, v, name), doc, app_dir, ctx)
         else:
-            logger.debug("process json macro: %s" % mo.group(2))
-            fields = mo.group(2).strip().split('.')
-            library = doc
+            result, deps = results[i]
+        _update_function(funcs, k, result, deps, name, objs, ctx)
+        modules.update(deps.modules)
+
+
+def _has_json(source):
+    '''
+    :return: ``True`` if ``source`` has ``!json`` macros, not counting
+             those of the libraries it includes
+    '''
+    return any(token[0] == 'json' for token in tokenize(source)
+               if not isinstance(token, basestring))
+
+
+# state of a process of the pool of _package_parallel
+_worker = {}
+
+
+def _init_worker(doc, app_dir, commonjs):
+    _worker.update(doc=doc, app_dir=app_dir,
+                   ctx=MacroContext(commonjs=commonjs))
+
+
+def _run_worker(task):
+    return _expand_task(task, _worker['doc'], _worker['app_dir'],
+                       _worker['ctx'])
+
+
+def _expand_task(task, doc, app_dir, ctx):
+    '''
+    :param task: tuple ``(key, source, name)`` of a function
+    :return: tuple ``(expanded, deps)``
+    '''
+    k, v, name = task
+    deps = MacroDeps()
+    return expand_function(doc, k, v, app_dir, deps, ctx, name), deps
+
+
+def expand_function(doc, k, v, app_dir, deps, ctx, name):
+    try:
+        return expand(doc, v, app_dir, deps, ctx, name=name)
+    except ValueError, e:
+        raise MacroError("Error running !code or !json on " +
+                         "function \"%s\": %s" % (k, e))
+
+
+def _update_function(funcs, k, expanded, deps, name, objs, ctx):
+    old_v = funcs[k]
+    ctx.graph[name] = deps
+    funcs[k] = expanded
+    if old_v != expanded:
+        objs[md5(util.to_bytestring(expanded)).hexdigest()] = old_v
+
+
+def tokenize(source):
+    '''
+    Split ``source`` on its ``!code`` and ``!json`` macros, in one pass.
+
+    :return: list of strings, the text between the macros, and of tuples
+             ``(macro, argument, text)`` for the macros
+    '''
+    parts = RE_MACRO.split(source)
+    tokens = []
+    for i in xrange(0, len(parts) - 1, 5):
+        if parts[i]:
+            tokens.append(parts[i])
+        tokens.append((parts[i + 3], parts[i + 4], parts[i + 1]))
+    if parts[-1]:
+        tokens.append(parts[-1])
+    return tokens
+
+
+def render(tokens):
+    '''
+    Join tokens back into a string, the macros left as they were
+    '''
+    return ''.join(token if isinstance(token, basestring) else token[2]
+                   for token in tokens)
+
+
+def expand(doc, source, app_dir, deps=None, ctx=None, name=None):
+    '''
+    Expand the ``!code`` macros of ``source``, recursively, then its
+    ``!json`` macros, including those of the included libraries. The
+    source and each library are scanned once.
+
+    :param name: path of the function in the document, reported in the
+                 include chain of a cycle. With a CommonJS ``ctx``, it
+                 tells which modules the function can require.
+    '''
+    if ctx is None:
+        ctx = MacroContext()
+    chain = (name,) if name is not None else ()
+    scope = require_scope(name) if ctx.commonjs else None
+    tokens = expand_code(tokenize(source), app_dir, deps, ctx, chain, scope)
+    return expand_json(doc, tokens, app_dir, deps, ctx)
+
+
+def expand_code(tokens, app_dir, deps, ctx, chain=(), scope=None):
+    '''
+    :param scope: the modules that can be required, see
+                  :func:`require_scope`
+    :return: ``tokens`` with the ``!code`` macros replaced by the tokens
+             of the files they include, or the ``require()`` of their
+             modules
+    '''
+    result = []
+    for token in tokens:
+        if isinstance(token, basestring) or token[0] != 'code':
+            result.append(token)
+            continue
+
+        included, globs, modules = ctx.include(token[1], app_dir, chain,
+                                               scope)
+        if deps is not None:
+            deps.globs.update(globs)
+            deps.modules.update(modules)
+        result.extend(included)
+    return result
+
+
+def require_scope(name):
+    '''
+    :param name: path of a function in the design document
+    :return: the modules the function can require: ``'ddoc'`` for the
+             modules of the whole document (shows, lists, updates,
+             filters and validate_doc_update), ``'views'`` for those of
+             ``views/lib`` only (views), ``None`` for none
+    '''
+    if name is None:
+        return None
+    if name.startswith('views/'):
+        return 'views'
+    if name == 'validate_doc_update' or \
+            name.split('/', 1)[0] in ('shows', 'lists', 'updates', 'filters'):
+        return 'ddoc'
+    return None
+
+
+def can_require(name, scope):
+    '''
+    :param name: the id of a module, see :func:`module_id`
+    :return: ``True`` if the module can be required in ``scope``
+    '''
+    if scope == 'views':
+        return name.startswith('views/lib/')
+    if scope == 'ddoc':
+        field = name.split('/', 1)[0]
+        if field.startswith(('_', '.')):
+            return False
+        return field not in FUNCTION_FIELDS or name.startswith('views/lib/')
+    return False
+
+
+def module_id(filename, app_dir):
+    '''
+    :return: the id of the module made of ``filename``, its path in the
+             document, e.g. ``lib/helpers/dates`` for
+             ``<app_dir>/lib/helpers/dates.js``
+    '''
+    path = os.path.relpath(os.path.splitext(filename)[0], app_dir)
+    return path.replace(os.sep, '/')
+
+
+def require(name, exports):
+    '''
+    :return: the statements importing ``exports`` from the module ``name``
+    '''
+    if not exports:
+        return "require('%s');" % name
+    return '\n'.join("var %s = require('%s').%s;" % (export, name, export)
+                     for export in exports)
+
+
+def expand_json(doc, tokens, app_dir, deps, ctx):
+    '''
+    :return: ``tokens`` rendered, with each ``!json`` macro replaced by
+             the declarations of all the variables they include
+    '''
+    included = {}
+    parts = []
+    macros = []
+    for token in tokens:
+        if isinstance(token, basestring):
+            parts.append(token)
+            continue
+        if token[0] == 'json':
+            include_json(doc, token[1], included, app_dir, deps, ctx)
+            macros.append(len(parts))
+        parts.append(token[2])
+
+    if included:
+        varstrings = '\n'.join(
+            "var %s = %s;" % (k, util.json.dumps(v).encode('utf-8'))
+            for k, v in included.iteritems())
+        for i in macros:
+            parts[i] = varstrings
+    return ''.join(parts)
+
+
+def include_json(doc, source, included, app_dir, deps, ctx):
+    '''
+    Add the value of the ``!json`` macro of argument ``source`` to
+    ``included``
+    '''
+    if source.startswith('_attachments'):
+        # someone  want to include from attachments
+        path = os.path.join(app_dir, source.strip())
+        filenum = 0
+        filenames = ctx.glob(path)
+        if deps is not None:
+            deps.globs[path] = filenames
+        for filename in filenames:
+            logger.debug("process json macro: %s", filename)
+            library = ''
+            try:
+                if filename.endswith('.json'):
+                    library = ctx.read_json(filename)
+                else:
+                    library = ctx.read(filename)
+            except IOError, e:
+                raise MacroError(str(e))
+            filenum += 1
+            current_file = filename.split(app_dir)[1]
+            fields = current_file.split('/')
             count = len(fields)
             include_to = included
             for i, field in enumerate(fields):
-                if not field in library:
-                    logger.warning("process json macro: unknown json "
-                                   + "source: %s" % mo.group(2))
-                    break
-                library = library[field]
                 if i+1 < count:
-                    include_to[field] = include_to.get(field, {})
+                    include_to[field] = {}
                     include_to = include_to[field]
                 else:
                     include_to[field] = library
+        if not filenum:
+            raise MacroError("Processing code: No file matching '%s'" %
+                             source)
+    else:
+        logger.debug("process json macro: %s", source)
+        field_path = source.strip()
+        if deps is not None:
+            deps.fields.add(field_path)
+        fields = field_path.split('.')
+        library = doc
+        count = len(fields)
+        include_to = included
+        for i, field in enumerate(fields):
+            if not field in library:
+                logger.warning("process json macro: unknown json "
+                               + "source: %s" % source)
+                break
+            library = library[field]
+            if i+1 < count:
+                include_to[field] = include_to.get(field, {})
+                include_to = include_to[field]
+            else:
+                include_to[field] = library
 
-        return f_string
-
-    def rjson2(mo):
-        return '\n'.join(varstrings)
-
-    re_json = re.compile('(\/\/|#)\ ?!json (.*)')
-    re_json.sub(rjson, f_string)
 
-    if not included:
-        return f_string
+def run_code_macros(f_string, app_dir, deps=None, ctx=None):
+    '''
+    Expand the ``!code`` macros of ``f_string`` only, see :func:`expand`
+    '''
+    if ctx is None:
+        ctx = MacroContext()
+    return render(expand_code(tokenize(f_string), app_dir, deps, ctx))
 
-    for k, v in included.iteritems():
-        varstrings.append("var %s = %s;" %
-                          (k, util.json.dumps(v).encode('utf-8')))
 
-    return re_json.sub(rjson2, f_string)
+def run_json_macros(doc, f_string, app_dir, deps=None, ctx=None):
+    '''
+    Expand the ``!json`` macros of ``f_string`` only, see :func:`expand`
+    '''
+    if ctx is None:
+        ctx = MacroContext()
+    return expand_json(doc, tokenize(f_string), app_dir, deps, ctx)
@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of couchapp released under the Apache 2 license.
+# See the NOTICE for more information.
+'''
+Pull the documents of a database into a ``_docs`` directory, the layout
+``pushdocs`` reads: ``<docid>.json`` for a document, a directory with an
+``_id`` file, a ``<field>.json`` file by field and an ``_attachments``
+directory for a document with attachments.
+
+``_all_docs`` is read a page at a time, each page written before the
+next one is requested, and the key of the last document written is kept
+in a ``.pulldocs`` file of the directory to resume an interrupted pull.
+'''
+
+from __future__ import with_statement
+
+import logging
+import os
+import urllib
+
+from couchapp import util
+from couchapp.errors import AppError
+
+# number of documents of an ``_all_docs`` request
+PAGE_SIZE = 1000
+
+# number of attachments downloaded at the same time
+WORKERS = 4
+
+# the state of the last pull of a directory, ignored by pushdocs
+STATE_FILE = '.pulldocs'
+
+# size of the chunks of the attachments written to disk
+STREAM_BUFSIZE = 64 * 1024
+
+logger = logging.getLogger(__name__)
+
+
+def doc_filename(docid):
+    '''
+    :return: the name of the file or directory of the document ``docid``,
+             ``docid`` quoted so it's a valid file name and not hidden
+    '''
+    name = urllib.quote(docid.encode('utf-8'), safe='')
+    if name.startswith('.'):
+        name = '%2E' + name[1:]
+    return name
+
+
+def pages(db, page_size=PAGE_SIZE, startkey=None):
+    '''
+    The rows of ``_all_docs`` with their documents, ``page_size`` at a
+    time. Each request asks one more row than a page, the first row of
+    the next page, and starts at its key: the pages don't depend on an
+    offset, which CouchDB would have to skip row by row.
+
+    :param startkey: the key of the first row
+    :return: iterator of lists of rows
+    '''
+    params = {'include_docs': 'true', 'limit': page_size + 1}
+    if startkey is not None:
+        params['startkey'] = util.json.dumps(startkey)
+    while True:
+        rows = db.all_docs(**params)['rows']
+        yield rows[:page_size]
+        if len(rows) <= page_size:
+            return
+        params['startkey'] = util.json.dumps(rows[page_size]['key'])
+
+
+def write_doc(dest, doc):
+    '''
+    Write ``doc`` in the directory ``dest``, without its revision.
+
+    :return: list of ``(docid, name, path)``, the attachments of ``doc``
+             to download
+    '''
+    doc = dict(doc)
+    doc.pop('_rev', None)
+    docid = doc['_id']
+    attachments = doc.pop('_attachments', None)
+    name = doc_filename(docid)
+    if not attachments:
+        util.write_json(os.path.join(dest, name + '.json'), doc)
+        return []
+
+    docdir = os.path.join(dest, name)
+    util.setup_dir(docdir, require_empty=False)
+    util.write(os.path.join(docdir, '_id'), doc.pop('_id'))
+    for field, value in doc.iteritems():
+        # ignored by pushdocs, like the other special files
+        if field.startswith('_'):
+            continue
+        elif field.startswith('.') or '/' in field or os.sep in field:
+            logger.warning("%s: field %s skipped, not a valid file name",
+                           docid, field)
+            continue
+        util.write_json(os.path.join(docdir, field + '.json'), value)
+
+    attdir = os.path.abspath(os.path.join(docdir, '_attachments'))
+    downloads = []
+    for attname in attachments:
+        path = os.path.abspath(os.path.join(attdir, *attname.split('/')))
+        if not path.startswith(attdir + os.sep):
+            logger.warning("%s: attachment %s skipped, not a valid path",
+                           docid, attname)
+            continue
+        downloads.append((docid, attname, path))
+    return downloads
+
+
+def download(db, docid, name, path):
+    '''
+    Write the attachment ``name`` of ``docid`` to ``path``, as it's
+    received.
+    '''
+    dirname = os.path.dirname(path)
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    resp = db.fetch_attachment(docid, name)
+    stream = resp.body_stream()
+    with open(path, 'wb') as f:
+        for data in iter(lambda: stream.read(STREAM_BUFSIZE), ''):
+            f.write(data)
+
+
+def read_state(dest):
+    '''
+    :return: the state of the last pull into ``dest``, or ``None``
+    '''
+    path = os.path.join(dest, STATE_FILE)
+    if not os.path.isfile(path):
+        return None
+    return util.read_json(path)
+
+
+def write_state(dest, state):
+    path = os.path.join(dest, STATE_FILE)
+    tmp = '%s.tmp' % path
+    util.write_json(tmp, state)
+    if util.is_windows() and os.path.exists(path):
+        os.remove(path)
+    os.rename(tmp, path)
+
+
+def pulldocs(db, dest, page_size=PAGE_SIZE, workers=WORKERS, resume=False,
+             design=False):
+    '''
+    Pull the documents of ``db`` into the directory ``dest``.
+
+    :param workers: number of attachments downloaded at the same time
+    :param resume: start after the last document written by the last
+                   pull of ``db`` into ``dest``
+    :param design: also pull the design documents, left out by default,
+                   see ``clone``
+    :return: number of documents written
+    '''
+    util.setup_dir(dest, require_empty=False)
+
+    startkey = None
+    state = read_state(dest) if resume else None
+    if state is not None:
+        if state.get('db') != db.dbname:
+            raise AppError("{0} was pulled from {1}, not {2}.".format(
+                dest, state.get('db'), db.dbname))
+        startkey = state['last_key']
+        logger.info("resuming after %s", startkey)
+
+    def fetch(attachment):
+        download(db, *attachment)
+
+    count = 0
+    for rows in pages(db, page_size, startkey):
+        if startkey is not None and rows and rows[0]['key'] == startkey:
+            # written by the last pull
+            rows = rows[1:]
+        startkey = None
+        downloads = []
+        for row in rows:
+            doc = row.get('doc')
+            if doc is None or \
+                    (not design and row['id'].startswith('_design/')):
+                continue
+            downloads.extend(write_doc(dest, doc))
+            count += 1
+
+        if workers > 1:
+            list(util.prefetch(fetch, downloads, workers))
+        else:
+            for attachment in downloads:
+                fetch(attachment)
+
+        if rows:
+            write_state(dest, {'db': db.dbname, 'last_key': rows[-1]['key']})
+            logger.info("%d docs written, up to %s", count, rows[-1]["key"])
+    return count
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of couchapp released under the Apache 2 license.
+# See the NOTICE for more information.
+
+import logging
+import os
+import stat
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+logger = logging.getLogger(__name__)
+
+
+class _DirEntry(object):
+    '''
+    Minimal ``os.DirEntry`` work-alike, used when neither ``os.scandir``
+    nor the ``scandir`` package is available.
+    '''
+    __slots__ = ('name', 'path', '_stat')
+
+    def __init__(self, dirpath, name):
+        self.name = name
+        self.path = os.path.join(dirpath, name)
+        self._stat = None
+
+    def stat(self):
+        if self._stat is None:
+            self._stat = os.stat(self.path)
+        return self._stat
+
+    def is_dir(self):
+        try:
+            return stat.S_ISDIR(self.stat().st_mode)
+        except OSError:
+            return False
+
+    def is_symlink(self):
+        return os.path.islink(self.path)
+
+
+def _scandir(path):
+    if scandir is not None:
+        return scandir(path)
+    return (_DirEntry(path, name) for name in os.listdir(path))
+
+
+class Snapshot(object):
+    '''
+    A scan of a document directory.
+
+    Every directory is listed at most once, and the entries are kept
+    with their cached ``stat`` result, so building the fields, the
+    manifest and the attachments of a document never hits the
+    filesystem twice for the same path.
+
+    :param docdir: the document directory
+    :param ignore: callable taking a path relative to ``docdir``,
+                   returns ``True`` if the path must be skipped
+    '''
+
+    def __init__(self, docdir, ignore=None):
+        self.docdir = docdir
+        self.ignore = ignore or (lambda path: False)
+        self._listings = {}
+        self._attachments = None
+
+    def listdir(self, path):
+        '''
+        :return: the entries of ``path``, sorted by name
+        '''
+        try:
+            return self._listings[path]
+        except KeyError:
+            pass
+
+        entries = sorted(_scandir(path), key=lambda e: e.name)
+        self._listings[path] = entries
+        return entries
+
+    def find(self, path, name):
+        '''
+        :return: the entry ``name`` of directory ``path`` or ``None``
+        '''
+        for entry in self.listdir(path):
+            if entry.name == name:
+                return entry
+        return None
+
+    def attachments(self):
+        '''
+        :return: list of ``(name, entry)``, one for each attachment
+                 (vendor ones included) of the document.
+        '''
+        if self._attachments is None:
+            self._attachments = list(self._scan_attachments())
+        return self._attachments
+
+    def _scan_attachments(self):
+        attachdir = self.find(self.docdir, '_attachments')
+        if attachdir is not None and attachdir.is_dir():
+            for att in self._walk(attachdir.path, '', '_attachments/'):
+                yield att
+
+        vendordir = self.find(self.docdir, 'vendor')
+        if vendordir is None or not vendordir.is_dir():
+            logger.debug("%s don't exist",
+                         os.path.join(self.docdir, 'vendor'))
+            return
+
+        for vendor in self.listdir(vendordir.path):
+            if not vendor.is_dir():
+                continue
+            attachdir = self.find(vendor.path, '_attachments')
+            if attachdir is None or not attachdir.is_dir():
+                continue
+            prefix = 'vendor/%s/' % vendor.name
+            for att in self._walk(attachdir.path, prefix,
+                                  '%s_attachments/' % prefix):
+                yield att
+
+    def _walk(self, path, name_prefix, rel_prefix):
+        for entry in self.listdir(path):
+            rel_path = rel_prefix + entry.name
+            if self.ignore(rel_path):
+                continue
+
+            name = name_prefix + entry.name
+            if entry.is_dir():
+                # like ``os.walk``, don't follow symlinked dirs
+                if not entry.is_symlink():
+                    for att in self._walk(entry.path, name + '/',
+                                          rel_path + '/'):
+                        yield att
+            else:
+                yield (name, entry)
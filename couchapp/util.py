@@ -10,27 +10,24 @@ import imp
 import inspect
 import logging
 import os
+import Queue
 import re
 import string
 import subprocess
 import sys
+import threading
 
+from collections import deque
 from hashlib import md5
+from itertools import islice
+from multiprocessing.pool import ThreadPool
 
 from couchapp.errors import AppError, ScriptError
+from couchapp.jsonbackend import JSON
 
-try:
-    import json
-except ImportError:
-    try:
-        import simplejson as json
-    except ImportError:
-        raise ImportError("""
-        simplejson isn't installed on your system. Install it by running
-        the command line:
-
-        pip install simplejson
-        """)
+# ``dumps`` and ``loads`` of the selected backend, see
+# :mod:`couchapp.jsonbackend`
+json = JSON()
 
 logger = logging.getLogger(__name__)
 
@@ -315,6 +312,96 @@ def sign(fpath):
     return ''
 
 
+def prefetch(func, iterable, workers=4):
+    """ Like ``itertools.imap(func, iterable)``, but ``func`` is run by a
+    pool of ``workers`` threads, at most ``2 * workers`` items ahead of
+    the consumer.
+
+    The results are yielded in order; an exception raised by ``func``
+    is raised again when its result is reached.
+    """
+    pool = ThreadPool(workers)
+    items = iter(iterable)
+    try:
+        pending = deque(pool.apply_async(func, (item,))
+                        for item in islice(items, 2 * workers))
+        while pending:
+            result = pending.popleft().get()
+            for item in islice(items, 1):
+                pending.append(pool.apply_async(func, (item,)))
+            yield result
+    finally:
+        pool.terminate()
+
+
+def read_ahead(paths, workers=4, chunks=16, bufsize=64 * 1024):
+    """ Yield an iterator of the content of each file of ``paths``, in
+    order, ``bufsize`` bytes at a time, while a pool of ``workers`` threads
+    reads the next files. Each file is read at most ``chunks`` chunks ahead
+    of the consumer, so unlike :func:`prefetch` the memory used doesn't
+    depend on the size of the files.
+
+    An iterator is abandoned when the next one is taken, and raises
+    ``IOError`` if it's used afterwards; an error reading a file is raised
+    by its iterator.
+    """
+    pool = ThreadPool(workers)
+    paths = iter(paths)
+    pending = deque()
+
+    def read(path, queue, cancel):
+        try:
+            with open(path, 'rb') as f:
+                while True:
+                    if cancel.is_set():
+                        raise IOError("read of %s abandoned" % path)
+                    data = f.read(bufsize)
+                    queue.put((data, None))
+                    if not data:
+                        break
+        except (IOError, OSError), e:
+            queue.put((None, e))
+
+    def drain(queue, cancel):
+        # the reader, if blocked on the full queue, puts one more chunk,
+        # then the error
+        cancel.set()
+        try:
+            while True:
+                queue.get_nowait()
+        except Queue.Empty:
+            pass
+
+    def iterate(queue):
+        while True:
+            data, error = queue.get()
+            if error is not None:
+                raise error
+            if not data:
+                return
+            yield data
+
+    def submit():
+        for path in islice(paths, 1):
+            queue, cancel = Queue.Queue(max(chunks, 2)), threading.Event()
+            pool.apply_async(read, (path, queue, cancel))
+            pending.append((queue, cancel))
+
+    try:
+        for _ in range(workers):
+            submit()
+        while pending:
+            queue, cancel = pending[0]
+            yield iterate(queue)
+            pending.popleft()
+            drain(queue, cancel)
+            submit()
+    finally:
+        for queue, cancel in pending:
+            drain(queue, cancel)
+        pool.terminate()
+
+
 def read(fname, utf8=True, force_read=False):
     """ read file content"""
     if utf8:
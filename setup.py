@@ -124,6 +124,11 @@ def main():
     except ImportError:
         INSTALL_REQUIRES.append('simplejson')
 
+    try:
+        from os import scandir
+    except ImportError:
+        INSTALL_REQUIRES.append('scandir')
+
     options = dict(
         name='Couchapp',
         version=couchapp.__version__,
@@ -144,6 +149,7 @@ def main():
         include_package_data=True,
         zip_safe=False,
         install_requires=INSTALL_REQUIRES,
+        extras_require={'speedups': ['ujson']},
         scripts=get_scripts(),
         options=dict(
             py2exe={
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from couchapp import cache
+from couchapp.cache import BuildCache, SignatureCache
+
+from mock import patch
+
+
+class TestSignatureCache(object):
+    def setUp(self):
+        self.dir = mkdtemp()
+        self.file = os.path.join(self.dir, 'app.js')
+        self.write('alert(42);')
+
+    def tearDown(self):
+        rmtree(self.dir)
+
+    def write(self, content, mtime=1000000000):
+        with open(self.file, 'w') as f:
+            f.write(content)
+        if mtime is not None:
+            os.utime(self.file, (mtime, mtime))
+
+    def test_hit(self):
+        c = SignatureCache(self.dir)
+        sig = c.sign('app.js', self.file)
+        c.save()
+
+        c = SignatureCache(self.dir)
+        with patch('couchapp.cache.util.sign') as sign:
+            assert c.sign('app.js', self.file) == sig
+            assert not sign.called
+
+    def test_invalidate(self):
+        c = SignatureCache(self.dir)
+        sig = c.sign('app.js', self.file)
+        c.save()
+
+        self.write('alert(43);', mtime=1000000001)
+        c = SignatureCache(self.dir)
+        assert c.sign('app.js', self.file) != sig
+
+    def test_racy_file_not_cached(self):
+        self.write('alert(42);', mtime=None)
+        c = SignatureCache(self.dir)
+        c.sign('app.js', self.file)
+        assert 'app.js' not in c.entries
+
+    def test_prune(self):
+        c = SignatureCache(self.dir)
+        c.sign('app.js', self.file)
+        c.save()
+
+        c = SignatureCache(self.dir)
+        c.save()
+        assert SignatureCache(self.dir).entries == {}
+
+    def test_disabled(self):
+        c = SignatureCache(self.dir, enabled=False)
+        c.sign('app.js', self.file)
+        c.save()
+        assert not os.path.exists(os.path.join(self.dir, cache.CACHE_DIR))
+
+    def test_corrupted(self):
+        c = SignatureCache(self.dir)
+        c.sign('app.js', self.file)
+        c.save()
+
+        with open(c.path, 'w') as f:
+            f.write('{not json')
+        assert SignatureCache(self.dir).entries == {}
+
+
+class TestBuildCache(object):
+    def setUp(self):
+        self.dir = mkdtemp()
+
+    def tearDown(self):
+        rmtree(self.dir)
+
+    def write(self, name, content, mtime=1000000000):
+        path = os.path.join(self.dir, name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as f:
+            f.write(content)
+        os.utime(path, (mtime, mtime))
+        return path
+
+    def test_content(self):
+        path = self.write('views/foo/map.json', '{"a": [1]}')
+        load = lambda: ({'a': [1]}, True)
+
+        c = BuildCache(self.dir)
+        assert c.content('views/foo/map.json', os.stat(path), load) == \
+            {'a': [1]}
+        c.save()
+
+        c = BuildCache(self.dir)
+        content = c.content('views/foo/map.json', os.stat(path),
+                            lambda: 1 / 0)
+        assert content == {'a': [1]}
+        # the cached value is a copy
+        content['a'].append(2)
+        assert c.fields['views/foo/map.json'][1] == {'a': [1]}
+
+    def test_content_not_cacheable(self):
+        path = self.write('foo.json', '{')
+        c = BuildCache(self.dir)
+        assert c.content('foo.json', os.stat(path), lambda: ('', False)) == ''
+        assert 'foo.json' not in c.fields
+
+    def test_racy_not_cached(self):
+        path = self.write('foo.js', 'bar', mtime=time.time())
+        c = BuildCache(self.dir)
+        assert c.content('foo.js', os.stat(path), lambda: ('bar', True)) == \
+            'bar'
+        assert 'foo.js' not in c.fields
+
+    def test_prune(self):
+        a = self.write('a.js', 'a')
+        b = self.write('b.js', 'b')
+        c = BuildCache(self.dir)
+        c.content('a.js', os.stat(a), lambda: ('a', True))
+        c.content('b.js', os.stat(b), lambda: ('b', True))
+        c.save()
+
+        c = BuildCache(self.dir)
+        c.content('a.js', os.stat(a), lambda: 1 / 0)
+        c.save()
+        assert BuildCache(self.dir).fields.keys() == ['a.js']
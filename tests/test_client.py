@@ -0,0 +1,394 @@
+# -*- coding: utf-8 -*-
+
+import base64
+import json
+import os
+import socket
+
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from couchapp.client import Database, FileAttachment, NoDelayConnection, \
+    StreamBody, clear_registry, escape_docid, get_db
+from couchapp.errors import BulkSaveError
+
+import socketpool.util
+
+from mock import Mock, patch
+
+
+class TestFileAttachment(object):
+    def setUp(self):
+        self.dir = mkdtemp()
+
+    def tearDown(self):
+        rmtree(self.dir)
+
+    def make_file(self, content, name='att'):
+        path = os.path.join(self.dir, name)
+        with open(path, 'wb') as f:
+            f.write(content)
+        return path
+
+    def test_b64_chunks(self):
+        f = self.check_b64_chunks
+        for size in (0, 1, 2, 3, 4, 100, 1000):
+            for bufsize in (1, 3, 4, 10, 64):
+                yield f, os.urandom(size), bufsize
+
+    def check_b64_chunks(self, content, bufsize):
+        att = FileAttachment(self.make_file(content))
+        data = ''.join(att.b64_chunks(bufsize))
+
+        assert data == base64.b64encode(content)
+        assert att.b64_length == len(data)
+        assert att.b64encode() == data
+
+
+def test_stream_body():
+    body = StreamBody([(3, 'foo'), (6, lambda: iter(['ba', 'rbaz'])),
+                       (0, '')])
+    assert body.length == 9
+    assert body.read(2) == 'fo'
+    assert body.read(5) == 'obarb'
+    assert body.read(5) == 'az'
+    assert body.read(5) == ''
+
+    body.seek(0)
+    assert body.read() == 'foobarbaz'
+
+
+def test_escape_docid():
+    assert escape_docid('foo/bar') == 'foo%2Fbar'
+    assert escape_docid('_design/app/v') == '_design/app%2Fv'
+    assert escape_docid('_local/couchapp/_design/app') == \
+        '_local/couchapp%2F_design%2Fapp'
+
+
+class TestRegistry(object):
+    def setUp(self):
+        self.patcher = patch('couchapp.client.CouchdbResource')
+        self.resource = self.patcher.start()
+
+    def tearDown(self):
+        self.patcher.stop()
+        clear_registry()
+
+    def test_same_db(self):
+        db = get_db('http://mock/db/', use_proxy=False)
+        assert get_db('http://mock/db', use_proxy=False) is db
+        # one check that the database exists
+        assert db.res.head.call_count == 1
+        assert get_db('http://mock/db', use_proxy=True) is not db
+
+    def test_server(self):
+        db1 = get_db('http://mock/db1', pool_size=3)
+        db2 = get_db('http://mock/db2')
+        other = get_db('http://other/db1')
+        assert db1.uuids is db2.uuids
+        assert db1.uuids is not other.uuids
+
+        pools = set(id(c[1]['pool'])
+                    for c in self.resource.call_args_list)
+        assert len(pools) == 2
+        assert self.resource.call_args_list[0][1]['pool'].max_size == 3
+
+    def test_create_later(self):
+        db = get_db('http://mock/db', create=False)
+        assert not db.res.head.called
+        assert get_db('http://mock/db') is db
+        assert db.res.head.called
+
+    def test_no_delay(self):
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.bind(('127.0.0.1', 0))
+        server.listen(1)
+        try:
+            conn = NoDelayConnection('127.0.0.1', server.getsockname()[1],
+                                     backend_mod=socketpool.util.load_backend(
+                                         'thread'))
+            assert conn.socket().getsockopt(socket.IPPROTO_TCP,
+                                            socket.TCP_NODELAY)
+            conn.invalidate()
+        finally:
+            server.close()
+        get_db('http://mock/db')
+        assert self.resource.call_args[1]['pool'].factory is \
+            NoDelayConnection
+
+
+class TestEncodeBody(object):
+    def setUp(self):
+        self.dir = mkdtemp()
+        self.path = os.path.join(self.dir, 'index.html')
+        with open(self.path, 'wb') as f:
+            f.write('<html>' * 1000)
+
+        with patch('couchapp.client.CouchdbResource'):
+            self.db = Database('http://mock/db', create=False, bufsize=30)
+
+    def tearDown(self):
+        rmtree(self.dir)
+
+    def test_plain(self):
+        headers = {}
+        doc = {'_id': 'foo', 'bar': 42}
+        assert json.loads(self.db.encode_body(doc, headers)) == doc
+        assert 'Content-Length' not in headers
+
+    def test_stream(self):
+        headers = {}
+        att = {'content_type': 'text/html',
+               'data': FileAttachment(self.path)}
+        doc = {'_id': 'foo', '_attachments': {'index.html': att}}
+
+        body = self.db.encode_body(doc, headers)
+        payload = body.read()
+
+        assert len(payload) == int(headers['Content-Length'])
+        ans = {'_id': 'foo',
+               '_attachments': {'index.html': {
+                   'content_type': 'text/html',
+                   'data': base64.b64encode('<html>' * 1000)}}}
+        assert json.loads(payload) == ans
+        # the doc isn't modified
+        assert doc['_attachments']['index.html'] is att
+
+    def test_stream_bulk(self):
+        headers = {}
+        att = {'data': FileAttachment(self.path)}
+        docs = [{'_id': 'foo'}, {'_id': 'bar', '_attachments': {'a': att}}]
+
+        body = self.db.encode_body({'docs': docs}, headers)
+        payload = json.loads(body.read())
+
+        assert payload['docs'][0] == {'_id': 'foo'}
+        assert payload['docs'][1]['_attachments']['a']['data'] == \
+            base64.b64encode('<html>' * 1000)
+
+    def test_multipart(self):
+        headers = {'Content-Type': 'application/json'}
+        other = os.path.join(self.dir, 'app.js')
+        with open(other, 'wb') as f:
+            f.write('\0\1\2' * 50)
+        doc = {'_id': 'foo',
+               '_attachments': {
+                   'index.html': {'content_type': 'text/html',
+                                  'data': FileAttachment(self.path)},
+                   'app.js': {'data': FileAttachment(other)},
+                   'inline.txt': {'data': 'aGk='}}}
+
+        body = self.db.encode_multipart(doc, headers)
+        payload = body.read()
+        assert len(payload) == int(headers['Content-Length'])
+
+        ctype = headers['Content-Type']
+        assert ctype.startswith('multipart/related; boundary="')
+        boundary = ctype.split('"')[1]
+        parts = payload.split('\r\n--%s' % boundary)
+        assert parts[0].startswith('--%s\r\n' % boundary)
+        assert parts[-1] == '--'
+
+        ans = json.loads(parts[0].split('\r\n\r\n', 1)[1],
+                         object_pairs_hook=list)
+        atts = dict(ans)['_attachments']
+        follows = [name for name, att in atts if dict(att).get('follows')]
+        assert sorted(follows) == ['app.js', 'index.html']
+        assert dict(dict(atts)['index.html']) == {
+            'content_type': 'text/html', 'follows': True, 'length': 6000}
+        assert dict(dict(atts)['inline.txt']) == {'data': 'aGk='}
+
+        files = {'index.html': '<html>' * 1000, 'app.js': '\0\1\2' * 50}
+        raw = [part.split('\r\n\r\n', 1)[1] for part in parts[1:-1]]
+        assert raw == [files[name] for name in follows]
+
+    def test_multipart_no_files(self):
+        headers = {'Content-Type': 'application/json'}
+        doc = {'_id': 'foo', '_attachments': {'a': {'data': 'aGk='}}}
+        assert json.loads(self.db.encode_multipart(doc, headers)) == doc
+        assert headers == {'Content-Type': 'application/json'}
+
+
+class TestAttachmentRev(object):
+    def setUp(self):
+        with patch('couchapp.client.CouchdbResource'):
+            self.db = Database('http://mock/db', create=False)
+        self.res = self.db.res
+
+    def test_bytes_sent(self):
+        self.db.res.put.return_value.json_body = {'ok': True, 'rev': '2-b'}
+        self.db.res.post.return_value.json_body = []
+        self.db.save_doc({'_id': 'foo', 'a': 1})
+        assert self.db.bytes_sent == len(json.dumps({'_id': 'foo', 'a': 1}))
+        self.db.put_attachment({'_id': 'foo', '_rev': '1-a'}, 'x' * 10,
+                               name='att')
+        self.db.save_docs([{'_id': 'bar'}])
+        assert self.db.bytes_sent == 22 + 10 + len('{"docs": [{"_id": '
+                                                   '"bar"}]}')
+
+    def test_put_attachment(self):
+        self.res.put.return_value.json_body = {'ok': True, 'id': 'foo',
+                                               'rev': '2-b'}
+        doc = {'_id': 'foo', '_rev': '1-a'}
+
+        ret = self.db.put_attachment(doc, 'hi', name='a b.txt',
+                                     headers={'Content-Type': 'text/plain'})
+
+        assert ret is doc
+        assert doc == {'_id': 'foo', '_rev': '2-b',
+                       '_attachments': {'a b.txt': {'stub': True}}}
+        self.res.put.assert_called_once_with(
+            'foo/a%20b.txt', payload='hi',
+            headers={'Content-Type': 'text/plain'}, rev='1-a')
+        assert not self.res.get.called
+
+    def test_put_attachment_refresh(self):
+        self.res.put.return_value.json_body = {'ok': True, 'id': 'foo',
+                                               'rev': '2-b'}
+        self.res.get.return_value.json_body = {'_id': 'foo', '_rev': '2-b',
+                                               'x': 1}
+        doc = {'_id': 'foo', '_rev': '1-a'}
+
+        self.db.put_attachment(doc, 'hi', name='a', refresh=True)
+        assert doc == {'_id': 'foo', '_rev': '2-b', 'x': 1}
+        self.res.get.assert_called_once_with('foo')
+
+    def test_delete_attachment(self):
+        self.res.delete.return_value.json_body = {'ok': True, 'id': 'foo',
+                                                  'rev': '3-c'}
+        doc = {'_id': 'foo', '_rev': '2-b',
+               '_attachments': {'a': {'stub': True}, 'b': {'stub': True}}}
+
+        assert self.db.delete_attachment(doc, 'a') is doc
+        assert doc == {'_id': 'foo', '_rev': '3-c',
+                       '_attachments': {'b': {'stub': True}}}
+        self.res.delete.assert_called_once_with('foo/a', rev='2-b')
+        assert not self.res.get.called
+
+
+class TestLastRevs(object):
+    def setUp(self):
+        with patch('couchapp.client.CouchdbResource'):
+            self.db = Database('http://mock/db', create=False)
+        self.res = self.db.res
+
+    def test_batches(self):
+        self.res.post.return_value.json_body = {'rows': [
+            {'id': 'a', 'key': 'a', 'value': {'rev': '1-a'}},
+            {'key': 'b', 'error': 'not_found'},
+            {'id': 'c', 'key': 'c', 'value': {'rev': '2-c', 'deleted': True},
+             'doc': None},
+        ]}
+        assert self.db.last_revs(['a', 'b', 'c'], batch=2) == {'a': '1-a'}
+        assert [json.loads(args[1]['payload'])
+                for args in self.res.post.call_args_list] == \
+            [{'keys': ['a', 'b']}, {'keys': ['c']}]
+        self.res.post.assert_called_with(
+            '_all_docs', payload='{"keys": ["c"]}',
+            headers={'Content-Type': 'application/json'})
+        assert not self.res.head.called
+
+    def test_view_keys(self):
+        self.res.post.return_value.json_body = {'rows': []}
+        self.db.view('app/by_date', keys=[1, 2], include_docs=True)
+        self.res.post.assert_called_once_with(
+            '/_design/app/_view/by_date', payload='{"keys": [1, 2]}',
+            headers={'Content-Type': 'application/json'}, include_docs=True)
+
+    def test_save_docs_conflict(self):
+        self.res.post.return_value.json_body = [
+            {'id': 'a', 'rev': '2-a'},
+            {'id': 'b', 'error': 'conflict', 'reason': 'Document update '
+                                                       'conflict.'}]
+        docs = [{'_id': 'a', '_rev': '1-a'}, {'_id': 'b', '_rev': '1-b'}]
+        try:
+            self.db.save_docs(docs)
+        except BulkSaveError, e:
+            assert e.errors == [{'_id': 'b', '_rev': '1-b'}]
+        else:
+            raise AssertionError('conflict not raised')
+        assert docs[0]['_rev'] == '2-a'
+
+
+class TestBulkDocs(object):
+    def setUp(self):
+        with patch('couchapp.client.CouchdbResource'):
+            self.db = Database('http://mock/db', create=False, bulk_size=2)
+        self.requests = []
+        self.db.res.post.side_effect = self.post
+        self.dir = mkdtemp()
+
+    def tearDown(self):
+        rmtree(self.dir)
+
+    def post(self, path, payload, headers):
+        if not isinstance(payload, basestring):
+            assert int(headers['Content-Length']) == payload.length
+            payload = payload.read()
+        body = json.loads(payload)
+        self.requests.append(body)
+        res = Mock()
+        res.json_body = [{'id': doc['_id'], 'error': 'conflict'}
+                         if doc.get('conflict') else
+                         {'id': doc['_id'], 'rev': '1-%s' % doc['_id']}
+                         for doc in body['docs']]
+        return res
+
+    def docs(self, n):
+        return [{'_id': 'd%d' % i} for i in range(n)]
+
+    def test_count(self):
+        docs = self.docs(5)
+        self.db.save_docs(docs)
+        assert [[doc['_id'] for doc in body['docs']]
+                for body in self.requests] == \
+            [['d0', 'd1'], ['d2', 'd3'], ['d4']]
+        assert [doc['_rev'] for doc in docs] == \
+            ['1-d%d' % i for i in range(5)]
+        assert self.db.bytes_sent == sum(
+            len(json.dumps({'docs': [{'_id': 'd%d' % i} for i in ids]}))
+            for ids in ((0, 1), (2, 3), (4,)))
+
+    def test_bytes(self):
+        self.db.bulk_size = 10
+        docs = self.docs(4)
+        docs[1]['big'] = 'x' * 100
+        self.db.bulk_bytes = 80
+        self.db.save_docs(docs)
+        # the big doc is sent alone
+        assert [len(body['docs']) for body in self.requests] == [1, 1, 2]
+
+    def test_errors(self):
+        docs = self.docs(5)
+        docs[0]['conflict'] = docs[4]['conflict'] = True
+        try:
+            self.db.save_docs(docs)
+        except BulkSaveError, e:
+            assert e.errors == [docs[0], docs[4]]
+        else:
+            raise AssertionError('conflicts not raised')
+        assert [doc.get('_rev') for doc in docs] == \
+            [None, '1-d1', '1-d2', '1-d3', None]
+
+    def test_workers(self):
+        self.db.bulk_workers = 3
+        docs = self.docs(7)
+        self.db.save_docs(docs)
+        assert len(self.requests) == 4
+        assert [doc['_rev'] for doc in docs] == \
+            ['1-d%d' % i for i in range(7)]
+
+    def test_all_or_nothing(self):
+        self.db.save_docs(self.docs(5), all_or_nothing=True)
+        assert len(self.requests) == 1
+        assert len(self.requests[0]['docs']) == 5
+
+    def test_stream(self):
+        path = os.path.join(self.dir, 'att')
+        with open(path, 'wb') as f:
+            f.write('hello')
+        docs = self.docs(3)
+        docs[2]['_attachments'] = {'att': {'data': FileAttachment(path)}}
+        self.db.save_docs(docs)
+        assert self.requests[1]['docs'][0]['_attachments'] == \
+            {'att': {'data': base64.b64encode('hello')}}
@@ -1,9 +1,9 @@
 # -*- coding: utf-8 -*-
 
 from couchapp.clone_app import clone
-from couchapp.errors import AppError, MissingContent
+from couchapp.errors import AppError, MissingContent, ResourceNotFound
 
-from mock import MagicMock, call, patch
+from mock import MagicMock, Mock, call, patch
 from nose.tools import  raises
 
 
@@ -97,6 +97,41 @@ class TestCloneMethod():
         assert 'mock' in self.clone.signatures
         assert 'obj_hash' in self.clone.objects
 
+    def test_init_metadata_local(self):
+        '''
+        Test case for extract metadata from the ``_local`` document
+        '''
+        self.clone.doc = {
+            'couchapp': {'metadata': '_local/couchapp/_design/app'}
+        }
+        self.clone.db = Mock()
+        self.clone.db.open_doc.return_value = {
+            '_id': '_local/couchapp/_design/app',
+            'manifest': ['views/'],
+            'signatures': {'mock': 'strange_value'},
+            'objects': {'obj_hash': 'obj'}
+        }
+
+        self.clone.init_metadata()
+
+        self.clone.db.open_doc.assert_called_once_with(
+            '_local/couchapp/_design/app')
+        assert self.clone.manifest == ['views/']
+        assert 'mock' in self.clone.signatures
+        assert 'obj_hash' in self.clone.objects
+
+    def test_init_metadata_local_missing(self):
+        self.clone.doc = {
+            'couchapp': {'metadata': '_local/couchapp/_design/app'}
+        }
+        self.clone.db = Mock()
+        self.clone.db.open_doc.side_effect = ResourceNotFound
+
+        self.clone.init_metadata()
+
+        assert self.clone.manifest == []
+        assert self.clone.objects == {}
+
     def test_init_metadata_default(self):
         '''
         Test case for extract metadata from an empty ddoc
@@ -497,6 +532,8 @@ class TestCloneMethod():
                 'objects': {},
                 'manifest': [],
                 'length': 42,
+                'metadata': '_local/couchapp/_design/foo',
+                'hash': 'mock',
                 'truth': 42,
             },
         }
@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 
+from couchapp.client import BULK_BYTES, BULK_SIZE, POOL_SIZE, STREAM_BUFSIZE
 from couchapp.config import Config
 from couchapp.errors import AppError
 
@@ -237,28 +238,34 @@ class TestConfig():
         assert hooks == {'pre-push': ['mock_module']}, hooks
         hook_uri.assert_called_with('mock_path', self.config)
 
-    @patch('couchapp.config.Database', return_value='mockdb')
-    def test_get_dbs_full_uri(self, Database):
+    @patch('couchapp.config.get_db', return_value='mockdb')
+    def test_get_dbs_full_uri(self, get_db):
         '''
         Test case for Config.get_dbs() with full uri
         '''
         db_string = 'https://foo.bar'
 
         assert self.config.get_dbs(db_string) == ['mockdb']
-        Database.assert_called_with(db_string, use_proxy=False)
+        get_db.assert_called_with(db_string, use_proxy=False,
+                                  bufsize=STREAM_BUFSIZE,
+                                  pool_size=POOL_SIZE, bulk_size=BULK_SIZE,
+                                  bulk_bytes=BULK_BYTES, bulk_workers=1)
 
-    @patch('couchapp.config.Database', return_value='mockdb')
-    def test_get_dbs_short_uri(self, Database):
+    @patch('couchapp.config.get_db', return_value='mockdb')
+    def test_get_dbs_short_uri(self, get_db):
         '''
         Test case for Config.get_dbs() with short uri
         '''
         full_uri = 'http://127.0.0.1:5984/foo'
 
         assert self.config.get_dbs('foo') == ['mockdb']
-        Database.assert_called_with(full_uri, use_proxy=False)
+        get_db.assert_called_with(full_uri, use_proxy=False,
+                                  bufsize=STREAM_BUFSIZE,
+                                  pool_size=POOL_SIZE, bulk_size=BULK_SIZE,
+                                  bulk_bytes=BULK_BYTES, bulk_workers=1)
 
-    @patch('couchapp.config.Database', return_value='mockdb')
-    def test_get_dbs_env(self, Database):
+    @patch('couchapp.config.get_db', return_value='mockdb')
+    def test_get_dbs_env(self, get_db):
         '''
         Test case for Config.get_dbs() with env set
         '''
@@ -266,29 +273,35 @@ class TestConfig():
         self.config.conf['env'] = {'default': {'db': db_string}}
 
         assert self.config.get_dbs() == ['mockdb']
-        Database.assert_called_with(db_string, use_proxy=False)
+        get_db.assert_called_with(db_string, use_proxy=False,
+                                  bufsize=STREAM_BUFSIZE,
+                                  pool_size=POOL_SIZE, bulk_size=BULK_SIZE,
+                                  bulk_bytes=BULK_BYTES, bulk_workers=1)
 
     @raises(AppError)
-    @patch('couchapp.config.Database')
-    def test_get_dbs_empty_env(self, Database):
+    @patch('couchapp.config.get_db')
+    def test_get_dbs_empty_env(self, get_db):
         '''
         Test case for Config.get_dbs() without env set
         '''
         self.config.get_dbs()
-        assert not Database.called
+        assert not get_db.called
 
-    @patch('couchapp.config.Database', return_value='mockdb')
-    def test_get_dbs_short_env(self, Database):
+    @patch('couchapp.config.get_db', return_value='mockdb')
+    def test_get_dbs_short_env(self, get_db):
         '''
         Test case for Config.get_dbs() with a short name in env
         '''
         self.config.conf['env'] = {'foo': {'db': 'http://foo.bar'}}
 
         assert self.config.get_dbs('foo') == ['mockdb']
-        Database.assert_called_with('http://foo.bar', use_proxy=False)
+        get_db.assert_called_with('http://foo.bar', use_proxy=False,
+                                  bufsize=STREAM_BUFSIZE,
+                                  pool_size=POOL_SIZE, bulk_size=BULK_SIZE,
+                                  bulk_bytes=BULK_BYTES, bulk_workers=1)
 
-    @patch('couchapp.config.Database', return_value='mockdb')
-    def test_get_dbs_env_fake(self, Database):
+    @patch('couchapp.config.get_db', return_value='mockdb')
+    def test_get_dbs_env_fake(self, get_db):
         '''
         Test case for Config.get_dbs() with an useless env
 
@@ -307,18 +320,51 @@ class TestConfig():
         default_uri = 'http://127.0.0.1:5984/foo'
 
         assert self.config.get_dbs('foo') == ['mockdb']
-        Database.assert_called_with(default_uri, use_proxy=False)
+        get_db.assert_called_with(default_uri, use_proxy=False,
+                                  bufsize=STREAM_BUFSIZE,
+                                  pool_size=POOL_SIZE, bulk_size=BULK_SIZE,
+                                  bulk_bytes=BULK_BYTES, bulk_workers=1)
 
 
-    @patch('couchapp.config.Database', return_value='mockdb')
-    def test_get_dbs_proxy(self, Database):
+    @patch('couchapp.config.get_db', return_value='mockdb')
+    def test_get_dbs_proxy(self, get_db):
         '''
         Test case for Config.get_dbs() with https_proxy env
         '''
         with patch.dict('couchapp.config.os.environ', {'https_proxy': 'foo'}):
             assert self.config.get_dbs('https://bar') == ['mockdb']
 
-        Database.assert_called_with('https://bar', use_proxy=True)
+        get_db.assert_called_with('https://bar', use_proxy=True,
+                                  bufsize=STREAM_BUFSIZE,
+                                  pool_size=POOL_SIZE, bulk_size=BULK_SIZE,
+                                  bulk_bytes=BULK_BYTES, bulk_workers=1)
+
+    @patch('couchapp.config.get_db', return_value='mockdb')
+    def test_get_dbs_pool_size(self, get_db):
+        '''
+        Test case for Config.get_dbs() with ``pool_size`` set
+        '''
+        self.config.conf['pool_size'] = 4
+
+        assert self.config.get_dbs('http://foo.bar') == ['mockdb']
+        get_db.assert_called_with('http://foo.bar', use_proxy=False,
+                                  bufsize=STREAM_BUFSIZE, pool_size=4,
+                                  bulk_size=BULK_SIZE,
+                                  bulk_bytes=BULK_BYTES, bulk_workers=1)
+
+    @patch('couchapp.config.get_db', return_value='mockdb')
+    def test_get_dbs_bulk(self, get_db):
+        '''
+        Test case for Config.get_dbs() with the ``bulk_*`` fields set
+        '''
+        self.config.conf.update(bulk_size=100, bulk_bytes=1024,
+                                bulk_workers=2)
+
+        assert self.config.get_dbs('http://foo.bar') == ['mockdb']
+        get_db.assert_called_with('http://foo.bar', use_proxy=False,
+                                  bufsize=STREAM_BUFSIZE,
+                                  pool_size=POOL_SIZE, bulk_size=100,
+                                  bulk_bytes=1024, bulk_workers=2)
 
     def test_get_app_name_default(self):
         '''
@@ -20,6 +20,7 @@ import tempfile
 import os
 from shutil import rmtree
 
+from couchapp.ignores import IgnoreMatcher
 from couchapp.localdoc import LocalDoc as doc
 import json
 
@@ -70,5 +71,48 @@ class IgnoresTests(unittest.TestCase):
         for i in self.testdata.keys():
             assert self.doc.check_ignore(i) == self.testdata[i]
 
+    def testMatcherReused(self):
+        """
+        The patterns are compiled once, and again only if the list of
+        ignores changes.
+        """
+        self.doc.check_ignore('CVS')
+        matcher = self.doc._ignore_matcher
+        self.doc.check_ignore('foo/ignore_me')
+        assert self.doc._ignore_matcher is matcher
+
+        self.doc.ignores = ['foo']
+        assert self.doc.check_ignore('foo/CVS')
+        assert not self.doc.check_ignore('CVS')
+        assert self.doc._ignore_matcher is not matcher
+
+
+class IgnoreMatcherTests(unittest.TestCase):
+
+    def testMerged(self):
+        matcher = IgnoreMatcher(['.*~', 'tmp', '^CVS'])
+        assert len(matcher.regexes) == 1
+        assert matcher.match('foo/bar.js~')
+        assert matcher.match('foo/tmp/bar.js')
+        assert matcher.match('CVS/Root')
+        assert not matcher.match('fooCVS')
+
+    def testStandalone(self):
+        # back references and inline flags can't be merged
+        matcher = IgnoreMatcher(['tmp', r'(a)\1', '(?i)readme'])
+        assert len(matcher.regexes) == 3
+        assert matcher.match('foo/aa')
+        assert matcher.match('README')
+        assert not matcher.match('ab')
+
+    def testParentIgnored(self):
+        matcher = IgnoreMatcher(['tmp'])
+        assert matcher.match('tmp/foo/bar.js')
+        assert matcher._verdicts['tmp/foo'] is True
+
+    def testEmpty(self):
+        assert not IgnoreMatcher([]).match('foo')
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+
+import json
+
+from couchapp.errors import AppError
+from couchapp.jsonbackend import BACKENDS, JSON, available_backends
+
+from mock import patch
+from nose.tools import raises
+
+DOC = {
+    '_id': '_design/app',
+    'views': {'by_date': {'map': u'function(doc) { emit("caf\xe9/1"); }'}},
+    'numbers': [0.1, 1.0 / 3, 1e300, 2 ** 70, -1, True, None],
+}
+
+
+def test_backends_output():
+    '''
+    Every backend decodes and encodes like the ``json`` module
+    '''
+    payload = json.dumps(DOC)
+    for cls in BACKENDS:
+        if cls.name not in available_backends():
+            continue
+        backend = cls()
+        assert backend.loads(payload) == DOC, cls.name
+        assert backend.dumps(DOC, sort_keys=True) == \
+            json.dumps(DOC, sort_keys=True), cls.name
+
+
+def test_fastest():
+    with patch.dict('os.environ', clear=True):
+        assert JSON().name == available_backends()[0]
+
+
+@patch.dict('os.environ', clear=True)
+def test_use():
+    backend = JSON()
+    backend.use('json')
+    assert backend.name == 'json'
+    assert backend.loads('{"a": [1]}') == {'a': [1]}
+
+
+@patch.dict('os.environ', {'COUCHAPP_JSON': 'json'})
+def test_use_env():
+    backend = JSON()
+    assert backend.name == 'json'
+    backend.use('simplejson')
+    assert backend.name == 'json'
+
+
+@raises(AppError)
+@patch.dict('os.environ', clear=True)
+def test_use_unknown():
+    JSON().use('yaml')
+
+
+@patch.dict('os.environ', {'COUCHAPP_JSON': 'yaml'})
+def test_unknown_env():
+    assert JSON().name == 'json'
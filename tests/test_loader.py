@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+
+import gzip
+import json
+import os
+
+from StringIO import StringIO
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from couchapp.errors import AppError, BulkSaveError
+from couchapp.loader import BatchSizer, batches, gunzip_lines, load, \
+    open_source, read_docs
+
+from mock import Mock
+from nose.tools import raises
+
+
+def test_read_docs():
+    lines = ['{"_id": "a"}\n', '\n', '{"n": 1}']
+    assert list(read_docs(lines)) == [{'_id': 'a'}, {'n': 1}]
+
+
+@raises(AppError)
+def test_read_docs_invalid():
+    list(read_docs(['{"_id": "a"}\n', '[1]\n']))
+
+
+def test_batches():
+    sizer = BatchSizer(2)
+    docs = iter(range(7))
+    gen = batches(docs, sizer)
+    assert next(gen) == [0, 1]
+    sizer.size = 3
+    assert list(gen) == [[2, 3, 4], [5, 6]]
+
+
+def test_batch_sizer():
+    sizer = BatchSizer(100, target=1.0, min_size=10, max_size=1000)
+    # fast requests: the batches grow, by a factor of 2 at most
+    sizer.update(100, 0.01)
+    assert sizer.size == 150
+    for i in range(10):
+        sizer.update(sizer.size, 0.01)
+    assert sizer.size == 1000
+    # slow ones: they shrink
+    sizer.update(1000, 4.0)
+    assert sizer.size == 750
+    for i in range(20):
+        sizer.update(sizer.size, 100.0)
+    assert sizer.size == 10
+
+    fixed = BatchSizer(100, adaptive=False)
+    fixed.update(100, 0.01)
+    assert fixed.size == 100
+
+
+class TestGzip(object):
+    def setUp(self):
+        self.dir = mkdtemp()
+
+    def tearDown(self):
+        rmtree(self.dir)
+
+    def write(self, name, content):
+        path = os.path.join(self.dir, name)
+        f = gzip.open(path, 'wb')
+        try:
+            f.write(content)
+        finally:
+            f.close()
+        return path
+
+    def test_lines(self):
+        path = self.write('docs.ndjson.gz', '{"n": 1}\n{"n": 2}')
+        assert list(open_source(path)) == ['{"n": 1}\n', '{"n": 2}']
+
+    def test_small_reads(self):
+        path = self.write('a.gz', '{"n": 1}\n' * 100)
+        with open(path, 'rb') as f:
+            assert list(gunzip_lines(f, bufsize=7)) == ['{"n": 1}\n'] * 100
+
+    def test_concatenated(self):
+        content = ''
+        for name in ('a.gz', 'b.gz'):
+            with open(self.write(name, '{"n": 1}\n'), 'rb') as f:
+                content += f.read()
+        assert list(gunzip_lines(StringIO(content))) == ['{"n": 1}\n'] * 2
+
+    @raises(AppError)
+    def test_invalid(self):
+        list(gunzip_lines(StringIO('{"n": 1}\n')))
+
+    def test_plain(self):
+        path = os.path.join(self.dir, 'docs.ndjson')
+        with open(path, 'w') as f:
+            f.write('{"n": 1}\n')
+        assert list(open_source(path)) == ['{"n": 1}\n']
+
+
+class TestLoad(object):
+    def setUp(self):
+        self.db = Mock(bytes_sent=0, bulk_size=1000)
+        self.saved = []
+        self.db.save_docs.side_effect = self.save_docs
+
+    def save_docs(self, docs, use_uuids=True):
+        assert not use_uuids
+        self.saved.append([doc.get('n') for doc in docs])
+        self.db.bytes_sent += 10
+        failed = [doc for doc in docs if doc.get('conflict')]
+        if failed:
+            raise BulkSaveError(docs, failed)
+
+    def lines(self, n, **fields):
+        return [json.dumps(dict(fields, n=i)) + '\n' for i in range(n)]
+
+    def test_load(self):
+        stats = load(self.db, self.lines(25), writers=2, batch_size=10,
+                     adaptive=False)
+        assert self.saved == [range(10), range(10, 20), range(20, 25)]
+        assert (stats.docs, stats.failed, stats.batches, stats.bytes) == \
+            (25, 0, 3, 30)
+        assert repr(stats).startswith('25 docs loaded in ')
+
+    def test_failed(self):
+        lines = self.lines(5) + self.lines(2, conflict=True)
+        stats = load(self.db, lines, batch_size=4, adaptive=False)
+        assert (stats.docs, stats.failed) == (5, 2)
+
+    def test_max_batch(self):
+        # a batch is sent in one request
+        self.db.bulk_size = 12
+        load(self.db, self.lines(100), writers=1, batch_size=10)
+        assert max(len(batch) for batch in self.saved) == 12
+
+    @raises(AppError)
+    def test_invalid(self):
+        load(self.db, self.lines(5) + ['{\n'])
@@ -1,12 +1,23 @@
 # -*- coding: utf-8 -*-
 
+import base64
 import json
 import os
+import threading
+
+from hashlib import md5
 
 from shutil import rmtree
 from tempfile import mkdtemp
 
-from couchapp.localdoc import LocalDoc
+from couchapp import scanner
+from couchapp.client import Database, FileAttachment
+from couchapp.errors import RequestFailed, ResourceNotFound
+from couchapp.localdoc import LocalDoc, attachment_digest, push_targets, \
+    report
+
+from mock import Mock, patch
+from nose.tools import raises
 
 
 def test_load_ignores_non_exist():
@@ -603,3 +614,500 @@ class TestDirToFieds(object):
             f.write(json.dumps(content))
 
         self.check(*args)
+
+
+class TestAttachments(object):
+    def setUp(self):
+        self.dir = mkdtemp()
+
+    def tearDown(self):
+        rmtree(self.dir)
+
+    def touch(self, *files):
+        for f in files:
+            path = os.path.join(self.dir, f)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            open(path, 'a').close()
+
+    def test_attachments(self):
+        self.touch('_attachments/index.html',
+                   '_attachments/style/main.css',
+                   '_attachments/.htaccess',
+                   'vendor/couchapp/_attachments/md5.js',
+                   'vendor/couchapp/metadata.json',
+                   'd/_attachments/skipped.js')
+
+        doc = LocalDoc(self.dir)
+        atts = dict(doc.attachments())
+
+        assert sorted(atts) == ['.htaccess', 'index.html', 'style/main.css',
+                                'vendor/couchapp/md5.js']
+        assert atts['style/main.css'] == \
+            os.path.join(self.dir, '_attachments', 'style', 'main.css')
+
+    def test_attachments_ignore(self):
+        self.touch('_attachments/index.html',
+                   '_attachments/index.html~',
+                   '_attachments/tmp/foo.js',
+                   'vendor/couchapp/_attachments/tmp/md5.js')
+        with open(os.path.join(self.dir, '.couchappignore'), 'w') as f:
+            f.write(json.dumps(['.*~', 'tmp']))
+
+        doc = LocalDoc(self.dir)
+        assert [name for name, _ in doc.attachments()] == ['index.html']
+
+    def test_fallback_scandir(self):
+        self.touch('_attachments/index.html', 'views/foo/map.js')
+
+        with patch('couchapp.scanner.scandir', None):
+            doc = LocalDoc(self.dir)
+            assert dict(doc.attachments()).keys() == ['index.html']
+            assert doc.dir_to_fields() == {'views': {'foo': {'map': ''}}}
+
+    def test_snapshot_lists_once(self):
+        self.touch('_attachments/index.html', 'views/foo/map.js')
+
+        with patch('couchapp.scanner._scandir',
+                   side_effect=scanner._scandir) as scandir:
+            doc = LocalDoc(self.dir)
+            doc.doc()
+            listed = [c[0][0] for c in scandir.call_args_list]
+
+        assert len(listed) == len(set(listed)), listed
+
+    def test_send_attachments(self):
+        self.touch('_attachments/index.html', '_attachments/main.css',
+                   '_attachments/data')
+        for name in ('index.html', 'main.css', 'data'):
+            with open(os.path.join(self.dir, '_attachments', name), 'w') as f:
+                f.write(name * 100)
+
+        for workers in (1, 2):
+            bodies = []
+            db = Mock()
+            # the body is read while it's sent
+            db.put_attachment.side_effect = \
+                lambda doc, body, **kwargs: bodies.append(body.read())
+            doc = LocalDoc(self.dir)
+            doc.send_attachments(db, {'_id': 'foo'}, list(doc.attachments()),
+                                 workers=workers)
+
+            calls = [(c[1]['name'], c[1]['headers']['Content-Type'],
+                      c[1]['headers']['Content-Length'])
+                     for c in db.put_attachment.call_args_list]
+            assert calls == [
+                ('data', 'application/octet-stream', '400'),
+                ('index.html', 'text/html', '1000'),
+                ('main.css', 'text/css', '800')], calls
+            assert bodies == ['data' * 100, 'index.html' * 100,
+                              'main.css' * 100]
+
+    def test_send_attachments_again(self):
+        # a body sent again, e.g. on a retry, is read from the file
+        self.touch('_attachments/data')
+        with open(os.path.join(self.dir, '_attachments', 'data'), 'w') as f:
+            f.write('x' * 1000)
+
+        bodies = []
+
+        def put_attachment(doc, body, **kwargs):
+            bodies.append(body.read(10))
+            body.seek(0)
+            bodies.append(body.read())
+
+        db = Mock()
+        db.put_attachment.side_effect = put_attachment
+        doc = LocalDoc(self.dir)
+        doc.send_attachments(db, {'_id': 'foo'}, list(doc.attachments()),
+                             workers=2)
+        assert bodies == ['x' * 10, 'x' * 1000]
+
+    def test_noatomic_push_requests(self):
+        names = ['f%03d.txt' % i for i in range(100)]
+        self.touch(*['_attachments/%s' % name for name in names])
+
+        with patch('couchapp.client.CouchdbResource'):
+            db = Database('http://mock/db', create=False)
+        db.res.get.side_effect = ResourceNotFound
+        db.res.head.side_effect = ResourceNotFound
+        db.res.put.return_value.json_body = {'ok': True, 'id': '_design/app',
+                                             'rev': '1-a'}
+
+        doc = LocalDoc(self.dir, docid='_design/app')
+        doc.push([db], noatomic=True, noindex=True)
+
+        # one lookup of the remote doc, one PUT for the doc, and one PUT
+        # for each attachment: no fetch of the doc after every upload
+        assert db.res.get.call_count == 1
+        assert db.res.put.call_count == 101
+        assert len(db.res.method_calls) == 102, db.res.method_calls
+
+
+class TestPushUnchanged(object):
+    def setUp(self):
+        self.dir = mkdtemp()
+        with open(os.path.join(self.dir, 'language'), 'w') as f:
+            f.write('javascript')
+
+    def tearDown(self):
+        rmtree(self.dir)
+
+    def push(self, olddoc, force=False):
+        db = Mock(dbname='db', raw_uri='http://mock/db', bytes_sent=0)
+        if olddoc is None:
+            db.open_doc.side_effect = ResourceNotFound
+        else:
+            db.open_doc.return_value = olddoc
+        LocalDoc(self.dir, docid='_design/app').push([db], force=force,
+                                                     noindex=True)
+        return db
+
+    def test_hash(self):
+        doc = LocalDoc(self.dir, docid='_design/app').doc()
+        assert doc['couchapp']['hash'] == LocalDoc.doc_hash(doc)
+        assert LocalDoc.doc_hash(dict(doc, _rev='1-a', _attachments={})) == \
+            doc['couchapp']['hash']
+        assert LocalDoc.doc_hash(dict(doc, language='erlang')) != \
+            doc['couchapp']['hash']
+
+    def test_unchanged(self):
+        db = self.push(None)
+        assert db.save_doc.called
+        olddoc = dict(db.save_doc.call_args[0][0], _rev='1-a')
+
+        assert not self.push(olddoc).save_doc.called
+        assert self.push(olddoc, force=True).save_doc.called
+
+        with open(os.path.join(self.dir, 'language'), 'w') as f:
+            f.write('erlang')
+        assert self.push(olddoc).save_doc.called
+
+    def test_attachments(self):
+        files = {'index.html': '<html>', 'main.css': 'body {}'}
+        os.makedirs(os.path.join(self.dir, '_attachments'))
+        for name, content in files.items():
+            with open(os.path.join(self.dir, '_attachments', name), 'w') as f:
+                f.write(content)
+        doc = LocalDoc(self.dir, docid='_design/app').doc()
+        stubs = dict((name, {'stub': True, 'length': len(content),
+                             'digest': attachment_digest(
+                                 md5(content).hexdigest())})
+                     for name, content in files.items())
+        olddoc = dict(doc, _rev='1-a', _attachments=stubs)
+        assert not self.push(olddoc).save_doc.called
+
+        # deleted in the database, with the same hash
+        del stubs['main.css']
+        db = self.push(olddoc)
+        assert db.save_doc.called
+        attachments = db.save_doc.call_args[0][0]['_attachments']
+        assert attachments['index.html'] == stubs['index.html']
+        assert 'main.css' in attachments and \
+            not attachments['main.css'].get('stub')
+
+
+class TestLocalMetadata(object):
+    def setUp(self):
+        self.dir = mkdtemp()
+        for name, content in (('language', 'javascript'),
+                              ('lib/a.js', 'var a = 1;'),
+                              ('shows/s.js', '// !code lib/a.js'),
+                              ('_attachments/index.html', '<html>')):
+            path = os.path.join(self.dir, name)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'w') as f:
+                f.write(content)
+
+    def tearDown(self):
+        rmtree(self.dir)
+
+    def push(self, stored=None, force=False):
+        '''
+        :param stored: ``dict`` of the documents in the database
+        '''
+        stored = stored or {}
+
+        def open_doc(docid):
+            if docid not in stored:
+                raise ResourceNotFound
+            return stored[docid]
+
+        db = Mock(dbname='db', raw_uri='http://mock/db', bytes_sent=0)
+        db.open_doc.side_effect = open_doc
+        LocalDoc(self.dir, docid='_design/app',
+                 local_metadata=True).push([db], force=force, noindex=True)
+        return db
+
+    def saved(self, db):
+        return dict((c[0][0]['_id'], dict(c[0][0], _rev='1-a'))
+                    for c in db.save_doc.call_args_list)
+
+    def test_doc(self):
+        localdoc = LocalDoc(self.dir, docid='_design/app', local_metadata=True)
+        doc = localdoc.doc()
+        meta = localdoc.metadoc
+
+        assert doc['couchapp'] == {
+            'metadata': '_local/couchapp/_design/app',
+            'hash': meta['hash'],
+        }
+        assert meta['_id'] == '_local/couchapp/_design/app'
+        assert sorted(meta['signatures']) == ['index.html']
+        assert meta['objects'].values() == ['// !code lib/a.js']
+        assert 'lib/a.js' in meta['manifest']
+
+    def test_push(self):
+        db = self.push()
+        # the document, then its metadata
+        assert [c[0][0]['_id'] for c in db.save_doc.call_args_list] == \
+            ['_design/app', '_local/couchapp/_design/app']
+
+        stored = self.saved(db)
+        assert not self.push(stored).save_doc.called
+
+        # an interrupted push, the metadata wasn't saved
+        del stored['_local/couchapp/_design/app']
+        db = self.push(stored)
+        assert db.save_doc.call_count == 2
+        # the attachments are sent again, their signatures are unknown
+        assert 'data' in db.save_doc.call_args_list[0][0][0][
+            '_attachments']['index.html']
+
+    def test_old_signatures(self):
+        stored = self.saved(self.push())
+        with open(os.path.join(self.dir, 'language'), 'w') as f:
+            f.write('erlang')
+        stored['_design/app']['_attachments'] = {
+            'index.html': {'stub': True}}
+
+        db = self.push(stored)
+        doc = db.save_doc.call_args_list[0][0][0]
+        assert doc['_attachments'] == {'index.html': {'stub': True}}
+        assert db.save_doc.call_args_list[1][0][0]['_rev'] == '1-a'
+
+
+class TestDependencyGraph(object):
+    def setUp(self):
+        self.dir = mkdtemp()
+        for name, content in (('language', 'javascript'),
+                              ('tpl/page.html', '<p></p>'),
+                              ('lib/a.js', 'var a = 1;'),
+                              ('shows/s.js', '// !code lib/a.js\n'
+                                             '// !json tpl'),
+                              ('_attachments/index.html', '<html>')):
+            path = os.path.join(self.dir, name)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'w') as f:
+                f.write(content)
+
+    def tearDown(self):
+        rmtree(self.dir)
+
+    def test_graph(self):
+        doc = LocalDoc(self.dir, docid='_design/app')
+        with patch('couchapp.localdoc.SignatureCache') as sigcache:
+            graph = doc.dependency_graph()
+            assert not sigcache.called
+        # nothing written
+        assert not os.path.exists(os.path.join(self.dir, '.couchapp'))
+
+        assert graph['shows/s'] == {
+            'files': [os.path.join('lib', 'a.js')], 'fields': ['tpl']}
+        doc.doc()
+        assert graph == doc.dependencies
+
+
+class TestAttachmentDigests(object):
+    def setUp(self):
+        self.dir = mkdtemp()
+        self.files = {'index.html': '<html>', 'main.css': 'body {}',
+                      'app.js': 'var app;'}
+        for name, content in self.files.items():
+            path = os.path.join(self.dir, '_attachments', name)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'w') as f:
+                f.write(content)
+
+    def tearDown(self):
+        rmtree(self.dir)
+
+    def stub(self, content):
+        return {'stub': True, 'length': len(content), 'revpos': 1,
+                'digest': attachment_digest(md5(content).hexdigest())}
+
+    def build(self, olddoc, **kwargs):
+        db = Mock()
+        db.open_doc.return_value = olddoc
+        doc = LocalDoc(self.dir, docid='_design/app').doc(db, **kwargs)
+        return doc['_attachments']
+
+    def test_digest(self):
+        assert attachment_digest(md5('<html>').hexdigest()) == \
+            'md5-' + base64.b64encode(md5('<html>').digest())
+
+    def test_no_signatures(self):
+        # pushed by another tool: no couchapp metadata
+        olddoc = {'_id': '_design/app', '_rev': '1-a', '_attachments': {
+            'index.html': self.stub('<html>'),
+            'main.css': self.stub('body { color: red }'),
+            'gone.png': self.stub('png'),
+        }}
+        attachments = self.build(olddoc)
+        assert attachments['index.html'] == self.stub('<html>')
+        assert 'data' in attachments['main.css']
+        assert 'data' in attachments['app.js']
+        assert 'gone.png' not in attachments
+
+        # sent one by one, only the stubs of the unchanged ones are kept
+        attachments = self.build(olddoc, with_attachments=False)
+        assert attachments == {'index.html': self.stub('<html>')}
+
+    def test_stale_signatures(self):
+        olddoc = {'_id': '_design/app', '_rev': '1-a',
+                  'couchapp': {'signatures': dict(
+                      (name, md5(content).hexdigest())
+                      for name, content in self.files.items())},
+                  '_attachments': dict(
+                      (name, self.stub(content))
+                      for name, content in self.files.items())}
+        # changed in the database, not in the signatures
+        olddoc['_attachments']['main.css'] = self.stub('p {}')
+
+        attachments = self.build(olddoc)
+        assert 'data' in attachments['main.css']
+        assert attachments['index.html'] == self.stub('<html>')
+
+        assert all('data' in att
+                   for att in self.build(olddoc, force=True).values())
+
+    def test_is_uploaded(self):
+        signature = md5('<html>').hexdigest()
+        stub = self.stub('<html>')
+        assert LocalDoc.is_uploaded(stub, signature, 6)
+        assert not LocalDoc.is_uploaded(stub, signature, 7)
+        assert not LocalDoc.is_uploaded(None, signature, 6, signature)
+        # no digest: the signature of the last push
+        assert LocalDoc.is_uploaded({'stub': True}, signature, 6, signature)
+        assert not LocalDoc.is_uploaded({'stub': True}, signature, 6)
+
+    def test_encoded(self):
+        # stored compressed: the digest is the one of the gzip data
+        signatures = dict((name, md5(content).hexdigest())
+                          for name, content in self.files.items())
+        stubs = dict((name, {'stub': True, 'length': len(content),
+                             'revpos': 1, 'encoding': 'gzip',
+                             'encoded_length': 30,
+                             'digest': attachment_digest(md5(
+                                 'gzip ' + content).hexdigest())})
+                     for name, content in self.files.items())
+        olddoc = {'_id': '_design/app', '_rev': '1-a',
+                  'couchapp': {'signatures': signatures},
+                  '_attachments': stubs}
+
+        assert self.build(olddoc) == stubs
+        signatures['main.css'] = md5('p {}').hexdigest()
+        attachments = self.build(olddoc)
+        assert 'data' in attachments['main.css']
+        assert attachments['index.html'] == stubs['index.html']
+
+        signature = md5('<html>').hexdigest()
+        stub = stubs['index.html']
+        assert LocalDoc.is_uploaded(stub, signature, 6, signature)
+        assert not LocalDoc.is_uploaded(stub, signature, 6)
+        assert not LocalDoc.is_uploaded(stub, signature, 7, signature)
+
+    def test_build_once(self):
+        stubs = dict((name, self.stub(content))
+                     for name, content in self.files.items())
+        dbs = [Mock(), Mock(), Mock()]
+        dbs[0].open_doc.side_effect = ResourceNotFound
+        dbs[1].open_doc.return_value = {
+            '_id': '_design/app', '_rev': '1-b',
+            '_attachments': {'index.html': stubs['index.html']}}
+        dbs[2].open_doc.return_value = {
+            '_id': '_design/app', '_rev': '2-c', '_attachments': stubs}
+
+        localdoc = LocalDoc(self.dir, docid='_design/app')
+        with patch.object(LocalDoc, 'scan', autospec=True,
+                          side_effect=LocalDoc.scan) as scan, \
+                patch('couchapp.localdoc.FileAttachment',
+                      wraps=FileAttachment) as attachment:
+            localdoc.build()
+            docs = [localdoc.prepare(db)[0] for db in dbs]
+        assert scan.call_count == 1
+        # each attachment is encoded once, for the first db
+        assert attachment.call_count == 3
+
+        assert '_rev' not in docs[0]
+        assert [doc.get('_rev') for doc in docs[1:]] == ['1-b', '2-c']
+        assert all('data' in att for att in docs[0]['_attachments'].values())
+        assert sorted(name for name, att in docs[1]['_attachments'].items()
+                      if 'data' in att) == ['app.js', 'main.css']
+        assert docs[2]['_attachments'] == stubs
+        # the build is left as is
+        assert '_rev' not in localdoc.built.doc
+        assert '_attachments' not in localdoc.built.doc
+        del docs[0]['couchapp']['hash']
+        assert 'hash' in docs[1]['couchapp']
+
+
+class TestPushTargets(object):
+    def setUp(self):
+        self.dir = mkdtemp()
+        with open(os.path.join(self.dir, 'language'), 'w') as f:
+            f.write('javascript')
+
+    def tearDown(self):
+        rmtree(self.dir)
+
+    def db(self, name, fail=False):
+        db = Mock(dbname=name, raw_uri='http://mock/%s' % name,
+                  bytes_sent=0)
+        db.open_doc.side_effect = ResourceNotFound
+
+        def save_doc(doc, **kwargs):
+            if fail:
+                raise RequestFailed('down')
+            db.bytes_sent += 100
+            doc['_rev'] = '1-%s' % name
+        db.save_doc.side_effect = save_doc
+        return db
+
+    def test_push(self):
+        dbs = [self.db('a'), self.db('b', fail=True), self.db('c')]
+        results = LocalDoc(self.dir, docid='_design/app').push(
+            dbs, noindex=True, parallel=2)
+
+        assert [r.db for r in results] == dbs
+        assert [r.rev for r in results] == ['1-a', None, '1-c']
+        assert [r.bytes for r in results] == [100, 0, 100]
+        assert str(results[1].error) == 'down'
+        assert repr(results[0]).startswith('a: rev 1-a, 100 bytes in ')
+        assert repr(results[1]) == 'b: failed: down'
+        assert report(results) == 1
+
+    @raises(RequestFailed)
+    def test_all_failed(self):
+        dbs = [self.db('a', fail=True), self.db('b', fail=True)]
+        report(LocalDoc(self.dir, docid='_design/app').push(dbs,
+                                                             noindex=True))
+
+    def test_concurrent(self):
+        started = []
+        barrier = threading.Event()
+
+        def func(db, result):
+            started.append(db)
+            if len(started) == 3:
+                barrier.set()
+            # all the pushes run at the same time
+            assert barrier.wait(5)
+
+        dbs = [self.db(name) for name in 'abc']
+        results = push_targets(func, dbs, parallel=3)
+        assert [r.error for r in results] == [None] * 3
+        assert report(results) == 0
@@ -0,0 +1,349 @@
+# -*- coding: utf-8 -*-
+
+import copy
+import os
+
+from hashlib import md5
+
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from couchapp.errors import MacroError
+from couchapp.macros import MacroContext, MacroDeps, apply_lib, \
+    can_require, expand, package_functions, package_views, render, \
+    require, require_scope, run_code_macros, run_json_macros, tokenize, \
+    view_groups
+
+from mock import patch
+from nose.tools import raises
+
+
+class TestMacroContext(object):
+    def setUp(self):
+        self.dir = mkdtemp()
+        self.write('lib/a.js', 'var a = 1;')
+        self.write('lib/b.js', '// !code vendor/c.js\nvar b = 2;')
+        self.write('vendor/c.js', 'var c = 3;')
+
+    def tearDown(self):
+        rmtree(self.dir)
+
+    def write(self, name, content):
+        path = os.path.join(self.dir, name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as f:
+            f.write(content)
+        return path
+
+    def path(self, name):
+        return os.path.join(self.dir, name)
+
+    def test_glob(self):
+        ctx = MacroContext()
+        assert ctx.glob(self.path('lib/*.js')) == \
+            [self.path('lib/a.js'), self.path('lib/b.js')]
+
+        with patch('couchapp.macros.glob.glob') as glob:
+            ctx.glob(self.path('lib/*.js'))
+            assert not glob.called
+
+    def test_code(self):
+        ctx = MacroContext()
+        tokens, globs, modules = ctx.code(self.path('lib/b.js'), self.dir)
+        assert render(tokens) == 'var c = 3;\nvar b = 2;'
+        assert globs == {self.path('vendor/c.js'): [self.path('vendor/c.js')]}
+        assert modules == {}
+
+        with patch('couchapp.macros.util.read') as read:
+            assert ctx.code(self.path('lib/b.js'), self.dir) == \
+                (tokens, globs, modules)
+            assert not read.called
+
+    def test_read_once(self):
+        funcs = dict(('f%d' % i, 'function() {\n// !code lib/*.js\n}')
+                     for i in range(10))
+        with patch('couchapp.macros.util.read',
+                   side_effect=lambda path: open(path).read()) as read:
+            apply_lib({}, funcs, self.dir, {})
+            assert read.call_count == 3
+
+        for source in funcs.values():
+            assert source == 'function() {\nvar a = 1;var c = 3;\n' \
+                             'var b = 2;\n}'
+
+    def test_deps(self):
+        deps = MacroDeps()
+        ctx = MacroContext()
+        # the nested dependencies are kept, even when they're memoized
+        for i in range(2):
+            run_code_macros('// !code lib/b.js', self.dir, deps, ctx)
+            assert deps.globs == {
+                self.path('lib/b.js'): [self.path('lib/b.js')],
+                self.path('vendor/c.js'): [self.path('vendor/c.js')],
+            }
+
+    def test_graph(self):
+        ctx = MacroContext()
+        funcs = {'by_date': {'map': 'function() {\n// !code lib/b.js\n'
+                                    '// !json tpl.page\n}',
+                             'reduce': '_count'}}
+        package_views({'tpl': {'page': 'x'}}, funcs, self.dir, {}, ctx=ctx)
+        apply_lib({}, {'validate_doc_update': 'function() {}'}, self.dir, {},
+                  ctx=ctx)
+
+        assert ctx.dependencies(self.dir) == {
+            'views/by_date/map': {'files': ['lib/b.js', 'vendor/c.js'],
+                                  'fields': ['tpl.page']},
+            'views/by_date/reduce': {'files': [], 'fields': []},
+            'validate_doc_update': {'files': [], 'fields': []},
+        }
+
+    @raises(MacroError)
+    def test_no_file(self):
+        run_code_macros('// !code lib/*.coffee', self.dir, ctx=MacroContext())
+
+
+def test_tokenize():
+    source = 'function() {\n  // !code lib/a.js\n  #!json tpl.page\n}'
+    tokens = tokenize(source)
+    assert tokens == ['function() {\n  ',
+                      ('code', 'lib/a.js', '// !code lib/a.js'), '\n  ',
+                      ('json', 'tpl.page', '#!json tpl.page'), '\n}']
+    assert render(tokens) == source
+    assert tokenize('') == []
+
+
+def test_json_macros():
+    doc = {'tpl': {'page': 'x', 'list': [1]}, 'name': 'app'}
+    source = '// !json tpl.page\nfoo();\n// !json name\n// !code lib/a.js'
+    assert run_json_macros(doc, source, '/app') == \
+        'var tpl = {"page": "x"};\nvar name = "app";\nfoo();\n' \
+        'var tpl = {"page": "x"};\nvar name = "app";\n// !code lib/a.js'
+    # nothing included: the macros are left as they are
+    assert run_json_macros(doc, '// !json nothere', '/app') == \
+        '// !json nothere'
+
+
+class TestIncludeCycle(object):
+    def setUp(self):
+        self.dir = mkdtemp()
+        os.makedirs(os.path.join(self.dir, 'lib'))
+        for name, content in (('a.js', '// !code lib/b.js\n'),
+                              ('b.js', '// !code lib/*.js\n'),
+                              ('c.js', 'var c = 3;\n')):
+            with open(os.path.join(self.dir, 'lib', name), 'w') as f:
+                f.write(content)
+
+    def tearDown(self):
+        rmtree(self.dir)
+
+    def test_cycle(self):
+        try:
+            expand({}, '// !code lib/a.js', self.dir, name='shows/page')
+        except MacroError, e:
+            assert str(e) == 'Processing code: include cycle: ' \
+                'shows/page -> lib/a.js -> lib/b.js -> lib/a.js', str(e)
+        else:
+            raise AssertionError('include cycle not detected')
+
+    @raises(MacroError)
+    def test_self_include(self):
+        run_code_macros('// !code lib/b.js', self.dir)
+
+    def test_no_cycle(self):
+        # the same file included twice, but not by itself
+        assert expand({}, '// !code lib/c.js\n// !code lib/c.js',
+                      self.dir) == 'var c = 3;\n\nvar c = 3;\n'
+
+
+class TestParallel(object):
+    def setUp(self):
+        self.dir = mkdtemp()
+        os.makedirs(os.path.join(self.dir, 'lib'))
+        for i in range(3):
+            path = os.path.join(self.dir, 'lib', '%d.js' % i)
+            with open(path, 'w') as f:
+                f.write('var l%d = %d;\n' % (i, i))
+        self.doc = {
+            'tpl': {'page': '<p></p>'},
+            'shows': dict(('s%d' % i, 'function() {\n// !code lib/%d.js\n'
+                                      '// !json tpl\n}' % (i % 3))
+                          for i in range(20)),
+            'views': {'v': {'map': 'function() {\n// !code lib/*.js\n}',
+                            'reduce': '_sum'}},
+        }
+
+    def tearDown(self):
+        rmtree(self.dir)
+
+    def build(self, jobs, doc=None):
+        doc = copy.deepcopy(doc or self.doc)
+        objs = {}
+        ctx = MacroContext()
+        groups = [('shows', doc['shows'])] + view_groups(doc['views'])
+        package_functions(doc, groups, self.dir, objs, ctx=ctx, jobs=jobs)
+        return doc, objs, ctx.dependencies(self.dir)
+
+    @patch('couchapp.macros.PARALLEL_MIN', 0)
+    def test_same_as_sequential(self):
+        assert self.build(2) == self.build(1)
+
+    @patch('couchapp.macros.PARALLEL_MIN', 0)
+    def test_json_of_functions(self):
+        # !json of functions expanded before, with !code and !json
+        doc = copy.deepcopy(self.doc)
+        doc['views']['v']['map'] = 'function() {\n// !json shows\n}'
+        doc['views']['w'] = {'map': 'function() {\n// !json views.v\n}'}
+        ref = self.build(1, doc=doc)
+        assert 'var l0 = 0;' in ref[0]['views']['v']['map']
+        assert self.build(2, doc=doc) == ref
+
+    @patch('couchapp.macros.PARALLEL_MIN', 0)
+    def test_json_out_of_pool(self):
+        tasks = []
+
+        class Pool(object):
+            ''' runs the tasks in this process '''
+
+            def __init__(self, jobs, initializer, initargs):
+                initializer(*initargs)
+
+            def map(self, func, items, chunksize):
+                tasks.extend(name for _, _, name in items)
+                return [func(item) for item in items]
+
+            def terminate(self):
+                pass
+
+            def join(self):
+                pass
+
+        doc = copy.deepcopy(self.doc)
+        doc['shows']['plain'] = 'function() {\n// !code lib/0.js\n}'
+        with patch('couchapp.macros.multiprocessing.Pool', Pool):
+            assert self.build(2, doc=doc) == self.build(1, doc=doc)
+        # the shows have !json macros
+        assert sorted(tasks) == ['shows/plain', 'views/v/map',
+                                 'views/v/reduce']
+
+    def test_few_functions(self):
+        with patch('couchapp.macros.multiprocessing.Pool') as pool:
+            assert self.build(4) == self.build(1)
+            assert not pool.called
+
+    @raises(MacroError)
+    @patch('couchapp.macros.PARALLEL_MIN', 0)
+    def test_error(self):
+        doc = copy.deepcopy(self.doc)
+        doc['shows']['s0'] = '// !code lib/nothere.js'
+        self.build(2, doc=doc)
+
+
+class TestCommonJS(object):
+    def setUp(self):
+        self.dir = mkdtemp()
+        self.write('lib/dates.js', '// !code lib/util.js\n'
+                                   'function format(d) { return pad(d); }\n'
+                                   'var SEP = "-";\n')
+        self.write('lib/util.js', 'function pad(n) { return n; }\n')
+        self.write('lib/tpl.js', '// !json tpl\nfunction page() {}\n')
+        self.write('views/lib/emit.js', 'function key(doc) { return 1; }\n')
+        self.doc = {
+            'tpl': {'page': '<p></p>'},
+            'lib': {'dates': 'raw', 'util': 'raw', 'tpl': 'raw'},
+            'shows': {'a': 'function() {\n// !code lib/dates.js\n}',
+                      'b': 'function() {\n// !code lib/tpl.js\n}'},
+            'views': {'v': {'map': 'function() {\n// !code lib/util.js\n'
+                                   '// !code views/lib/emit.js\n}'}},
+        }
+
+    def tearDown(self):
+        rmtree(self.dir)
+
+    def write(self, name, content):
+        path = os.path.join(self.dir, name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as f:
+            f.write(content)
+
+    def build(self, commonjs):
+        doc = copy.deepcopy(self.doc)
+        objs = {}
+        groups = [('shows', doc['shows'])] + view_groups(doc['views'])
+        package_functions(doc, groups, self.dir, objs,
+                          ctx=MacroContext(commonjs=commonjs))
+        return doc, objs
+
+    def test_require(self):
+        doc, objs = self.build(True)
+        # the names included by a library stay visible, as when inlined
+        assert doc['shows']['a'] == "function() {\n" \
+            "var pad = require('lib/dates').pad;\n" \
+            "var format = require('lib/dates').format;\n" \
+            "var SEP = require('lib/dates').SEP;\n}"
+        assert doc['lib']['dates'].startswith(
+            "var pad = require('lib/util').pad;\n"
+            "function format(d) { return pad(d); }\nvar SEP = \"-\";\n")
+        assert doc['lib']['util'] == 'function pad(n) { return n; }\n' \
+            '\nif (typeof pad !== "undefined") { exports.pad = pad; }'
+        # the source of the modules, for clone
+        assert sorted(objs[md5(doc['lib'][name]).hexdigest()]
+                      for name in ('dates', 'util')) == \
+            ['// !code lib/util.js\nfunction format(d) { return pad(d); }\n'
+             'var SEP = "-";\n', 'function pad(n) { return n; }\n']
+
+    def test_json_inlined(self):
+        doc, objs = self.build(True)
+        assert doc['shows']['b'] == 'function() {\n' \
+            'var tpl = {"page": "<p></p>"};\nfunction page() {}\n\n}'
+        assert doc['lib']['tpl'] == 'raw'
+
+    def test_views(self):
+        doc, objs = self.build(True)
+        # views only see the modules of views/lib
+        assert doc['views']['v']['map'] == 'function() {\n' \
+            "function pad(n) { return n; }\n\n" \
+            "var key = require('views/lib/emit').key;\n}"
+        assert 'exports.key = key;' in doc['views']['lib']['emit']
+
+    def test_inline(self):
+        doc, objs = self.build(False)
+        assert 'require(' not in doc['shows']['a']
+        assert doc['lib'] == self.doc['lib']
+
+    def test_same_source(self):
+        # the same source requires the module in a show, and inlines it
+        # in a view, which can't require it
+        source = 'function() {\n// !code lib/util.js\n}'
+        self.doc['shows'] = {'a': source}
+        self.doc['views'] = {'v': {'map': source}}
+        doc, objs = self.build(True)
+        assert doc['shows']['a'] == 'function() {\n' \
+            "var pad = require('lib/util').pad;\n}"
+        assert doc['views']['v']['map'] == 'function() {\n' \
+            'function pad(n) { return n; }\n\n}'
+
+    def test_cycle(self):
+        self.write('lib/util.js', '// !code lib/dates.js\n')
+        try:
+            self.build(True)
+        except MacroError, e:
+            assert 'include cycle' in str(e)
+        else:
+            raise AssertionError('include cycle not detected')
+
+
+def test_require_scope():
+    assert require_scope('shows/page') == 'ddoc'
+    assert require_scope('validate_doc_update') == 'ddoc'
+    assert require_scope('views/by_date/map') == 'views'
+    assert require_scope('fulltext/by_title/index') is None
+    assert can_require('lib/dates', 'ddoc')
+    assert can_require('views/lib/emit', 'ddoc')
+    assert not can_require('shows/page', 'ddoc')
+    assert not can_require('_attachments/app', 'ddoc')
+    assert not can_require('lib/dates', 'views')
+    assert not can_require('lib/dates', None)
+    assert require('lib/a', []) == "require('lib/a');"
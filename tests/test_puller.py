@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+
+import json
+import os
+
+from StringIO import StringIO
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from couchapp.errors import AppError
+from couchapp.localdoc import LocalDoc
+from couchapp.puller import doc_filename, pages, pulldocs, read_state, \
+    write_doc
+
+from mock import Mock
+from nose.tools import raises
+
+
+def test_doc_filename():
+    assert doc_filename('foo') == 'foo'
+    assert doc_filename('_design/foo') == '_design%2Ffoo'
+    assert doc_filename('.a b') == '%2Ea%20b'
+    assert doc_filename(u'caf\xe9') == 'caf%C3%A9'
+
+
+class FakeDb(object):
+    ''' ``_all_docs`` and attachments of a list of docs '''
+
+    dbname = 'db'
+
+    def __init__(self, docs):
+        self.docs = sorted(docs, key=lambda doc: doc['_id'])
+        self.requests = []
+
+    def all_docs(self, include_docs, limit, startkey=None):
+        self.requests.append(startkey)
+        rows = [{'id': doc['_id'], 'key': doc['_id'], 'doc': doc}
+                for doc in self.docs
+                if startkey is None or doc['_id'] >= json.loads(startkey)]
+        return {'rows': rows[:limit]}
+
+    def fetch_attachment(self, docid, name):
+        resp = Mock()
+        resp.body_stream.return_value = StringIO('%s of %s' % (name, docid))
+        return resp
+
+
+class TestPullDocs(object):
+    def setUp(self):
+        self.dir = mkdtemp()
+        self.dest = os.path.join(self.dir, '_docs')
+        self.db = FakeDb([{'_id': 'd%d' % i, '_rev': '1-a', 'n': i}
+                          for i in range(5)] +
+                         [{'_id': '_design/app', '_rev': '1-a'}])
+
+    def tearDown(self):
+        rmtree(self.dir)
+
+    def read(self, *path):
+        with open(os.path.join(self.dest, *path)) as f:
+            return f.read()
+
+    def test_pages(self):
+        assert [[row['id'] for row in rows]
+                for rows in pages(self.db, page_size=2)] == \
+            [['_design/app', 'd0'], ['d1', 'd2'], ['d3', 'd4']]
+        # no skip: each page starts at the key of its first row
+        assert self.db.requests == [None, '"d1"', '"d3"']
+
+    def test_pull(self):
+        assert pulldocs(self.db, self.dest, page_size=2) == 5
+        assert sorted(os.listdir(self.dest)) == \
+            ['.pulldocs'] + ['d%d.json' % i for i in range(5)]
+        assert json.loads(self.read('d3.json')) == {'_id': 'd3', 'n': 3}
+        assert read_state(self.dest) == {'db': 'db', 'last_key': 'd4'}
+
+    def test_design(self):
+        assert pulldocs(self.db, self.dest, design=True) == 6
+        assert os.path.isfile(os.path.join(self.dest, '_design%2Fapp.json'))
+
+    def test_resume(self):
+        pulldocs(self.db, self.dest, page_size=2)
+        self.db.docs.extend({'_id': 'e%d' % i, 'n': i} for i in range(3))
+        self.db.requests = []
+        assert pulldocs(self.db, self.dest, page_size=2, resume=True) == 3
+        assert self.db.requests[0] == '"d4"'
+        assert read_state(self.dest)['last_key'] == 'e2'
+        # without --resume, from the start
+        assert pulldocs(self.db, self.dest) == 8
+
+    @raises(AppError)
+    def test_resume_other_db(self):
+        pulldocs(self.db, self.dest)
+        self.db.dbname = 'other'
+        pulldocs(self.db, self.dest, resume=True)
+
+    def test_attachments(self):
+        self.db.docs = [{'_id': 'a', '_rev': '2-b', 'title': 'x',
+                         'tags': ['t'], '_attachments': {
+                             'img/a b.png': {'stub': True},
+                             '../../evil': {'stub': True}}}]
+        assert pulldocs(self.db, self.dest, workers=2) == 1
+        assert self.read('a', '_attachments', 'img', 'a b.png') == \
+            'img/a b.png of a'
+        assert not os.path.exists(os.path.join(self.dir, 'evil'))
+
+        # as pushdocs reads it
+        doc = LocalDoc(os.path.join(self.dest, 'a'), is_ddoc=False).doc()
+        assert doc['_id'] == 'a'
+        assert (doc['title'], doc['tags']) == ('x', ['t'])
+        assert list(doc['_attachments']) == ['img/a b.png']
+
+
+def test_write_doc_no_attachments():
+    dest = mkdtemp()
+    try:
+        assert write_doc(dest, {'_id': 'a/b', '_rev': '1-a', 'x': 1}) == []
+        with open(os.path.join(dest, 'a%2Fb.json')) as f:
+            assert json.load(f) == {'_id': 'a/b', 'x': 1}
+    finally:
+        rmtree(dest)
+
+
+def test_write_doc_dest():
+    '''
+    The attachments are written whatever the spelling of the directory
+    '''
+    dest = mkdtemp()
+    cwd = os.getcwd()
+    doc = {'_id': 'a', '_attachments': {'index.html': {'stub': True}}}
+    try:
+        os.chdir(dest)
+        os.mkdir('out')
+        for path in ('./out', 'out/', dest + os.sep):
+            downloads = write_doc(path, doc)
+            assert [(docid, name) for docid, name, _ in downloads] == \
+                [('a', 'index.html')], path
+            assert downloads[0][2] == os.path.join(
+                os.path.abspath(path), 'a', '_attachments', 'index.html')
+    finally:
+        os.chdir(cwd)
+        rmtree(dest)
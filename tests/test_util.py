@@ -7,7 +7,7 @@ import os
 from couchapp.errors import AppError
 from couchapp.util import discover_apps, iscouchapp, rcpath, split_path
 from couchapp.util import sh_open, remove_comments, is_empty_dir, setup_dir
-from couchapp.util import setup_dirs
+from couchapp.util import setup_dirs, prefetch, read_ahead
 
 from mock import patch
 from nose.tools import raises
@@ -276,3 +276,54 @@ def test_setup_dirs_args(setup_dir):
     setup_dir.assert_any_call('/fake', require_empty=True)
     setup_dir.assert_any_call('/mock/app', require_empty=True)
     setup_dir.assert_any_call('/42', require_empty=True)
+
+
+def test_prefetch():
+    assert list(prefetch(lambda x: x * 2, xrange(100), workers=3)) == \
+        range(0, 200, 2)
+
+
+@raises(ValueError)
+def test_prefetch_error():
+    def func(x):
+        if x == 5:
+            raise ValueError(x)
+        return x
+
+    for i, x in enumerate(prefetch(func, xrange(10), workers=2)):
+        assert i == x
+
+
+class TestReadAhead(object):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.paths = []
+        for i in range(5):
+            path = os.path.join(self.tmpdir, str(i))
+            with open(path, 'wb') as f:
+                # more than the chunks read ahead
+                f.write(str(i) * 100 * (i + 1))
+            self.paths.append(path)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_read_ahead(self):
+        contents = [''.join(chunks) for chunks in
+                    read_ahead(self.paths, workers=2, chunks=2, bufsize=30)]
+        assert contents == [str(i) * 100 * (i + 1) for i in range(5)]
+
+    @raises(IOError)
+    def test_error(self):
+        self.paths[2] = os.path.join(self.tmpdir, 'nothere')
+        for i, chunks in enumerate(read_ahead(self.paths, workers=2)):
+            assert ''.join(chunks) == str(i) * 100 * (i + 1)
+
+    @raises(IOError)
+    def test_abandoned(self):
+        streams = read_ahead(self.paths, workers=2, chunks=2, bufsize=30)
+        first = next(streams)
+        assert next(first) == '0' * 30
+        assert ''.join(next(streams)) == '1' * 200
+        streams.close()
+        list(first)